@@ -4,29 +4,109 @@ import os
 import sys
 import argparse
 
+from . import settings
 from .appinit.appinit import initialize_config
 
 
 LOGLEVEL_CHOICES = ['debug', 'info', 'warning', 'error', 'critical']
 
+def _patch_async_workers(args):
+    '''
+    Monkey patch the standard library for gevent or eventlet server workers
+    before the app and database are loaded, so that database connections
+    are kept per greenlet rather than per worker process
+
+    '''
+    worker_class = args.worker_class
+    if worker_class is None:
+        from flask import Config
+        config = Config(os.path.dirname(args.configfile))
+        config.from_object(settings)
+        config.from_pyfile(args.configfile)
+        worker_class = config['SERVER_WORKER_CLASS']
+    # A missing package is reported when the server options are checked
+    if worker_class == 'gevent':
+        try:
+            from gevent import monkey
+        except ImportError:
+            return
+        monkey.patch_all()
+    elif worker_class == 'eventlet':
+        try:
+            import eventlet
+        except ImportError:
+            return
+        eventlet.monkey_patch()
+
+def _check_database(args):
+    # App must be loaded before database routines, as in initialization
+    from .web import app
+    from .db.database import check_database_schema
+    check_database_schema(args.configfile)
+
 def _run_server(args):
     os.environ['AMPT_MANAGER_SETTINGS'] = args.configfile
+    # Server processes share metrics through files (see metrics module)
+    os.environ['AMPT_MANAGER_SERVER'] = '1'
     if args.debug:
         os.environ['FLASK_DEBUG'] = '1'
+    _patch_async_workers(args)
+    _check_database(args)
     from .web.runserver import run_server
     run_server(args)
 
 def _verify_probe_events(args):
     os.environ['AMPT_MANAGER_SETTINGS'] = args.configfile
+    _check_database(args)
     from .verifier import verify_probe_events
+    from .metrics import push_metrics
     # We exit with the status code of the verification function in order
     # to signal success or any failure in segment verification
-    sys.exit(verify_probe_events(args))
+    retval = verify_probe_events(args)
+    push_metrics('verify')
+    sys.exit(retval)
 
 def _send_probe_requests(args):
     os.environ['AMPT_MANAGER_SETTINGS'] = args.configfile
+    _check_database(args)
     from .dispatcher import send_probe_requests
+    from .metrics import push_metrics
     send_probe_requests(args)
+    push_metrics('dispatch')
+
+def _run_scheduler(args):
+    os.environ['AMPT_MANAGER_SETTINGS'] = args.configfile
+    _check_database(args)
+    from .scheduler import run_scheduler
+    run_scheduler(args)
+
+def _prune_probe_logs(args):
+    os.environ['AMPT_MANAGER_SETTINGS'] = args.configfile
+    _check_database(args)
+    from .retention import prune_probe_logs
+    prune_probe_logs(args)
+
+def _export_probe_logs(args):
+    os.environ['AMPT_MANAGER_SETTINGS'] = args.configfile
+    _check_database(args)
+    # App must be loaded before export routines, which the app views use
+    from .web import app
+    from .export import export_probe_logs
+    export_probe_logs(args)
+
+def _upgrade_database(args):
+    os.environ['AMPT_MANAGER_SETTINGS'] = args.configfile
+    # App must be loaded before database routines, as in initialization
+    from .web import app
+    from .db.database import upgrade_database
+    upgrade_database(args)
+
+def _show_database_info(args):
+    os.environ['AMPT_MANAGER_SETTINGS'] = args.configfile
+    # App must be loaded before database routines, as in initialization
+    from .web import app
+    from .db.database import show_database_info
+    show_database_info(args)
 
 def valid_configfile(s):
     'Validate that specified argument is a file path that can be opened'
@@ -55,6 +135,24 @@ def main():
                                   'existing directory')
     parser_init.set_defaults(func=initialize_config)
 
+    upgrade_description = ('Upgrade database of existing AMPT manager '
+                           'configuration to current schema')
+    parser_upgrade = subparsers.add_parser('upgrade',
+                                           description=upgrade_description,
+                                           help='upgrade app database')
+    parser_upgrade.add_argument('configfile', type=valid_configfile,
+                                help='load app configuration from specified file')
+    parser_upgrade.set_defaults(func=_upgrade_database)
+
+    dbinfo_description = ('Show database location and active database '
+                          'performance settings')
+    parser_dbinfo = subparsers.add_parser('dbinfo',
+                                          description=dbinfo_description,
+                                          help='show database settings')
+    parser_dbinfo.add_argument('configfile', type=valid_configfile,
+                               help='load app configuration from specified file')
+    parser_dbinfo.set_defaults(func=_show_database_info)
+
     run_description = 'Run AMPT manager server'
     parser_run = subparsers.add_parser('run', description=run_description,
                                         help='run manager server ')
@@ -69,6 +167,50 @@ def main():
     parser_run.add_argument('-l', '--loglevel', choices=LOGLEVEL_CHOICES,
                             help='set logging verbosity level '
                                  '(default: from config file)')
+    parser_run.add_argument('-k', '--worker-class',
+                            choices=sorted(settings.gunicorn_worker_classes),
+                            help='set server worker type '
+                                 '(default: from config file)')
+    parser_run.add_argument('-w', '--workers', type=int,
+                            help='set number of server worker processes '
+                                 '(default: from config file)')
+    parser_run.add_argument('-t', '--threads', type=int,
+                            help='set number of threads per gthread worker '
+                                 '(default: from config file)')
+    parser_run.add_argument('-c', '--worker-connections', type=int,
+                            help='set maximum concurrent connections per '
+                                 'gevent/eventlet worker '
+                                 '(default: from config file)')
+    parser_run.add_argument('--keepalive', type=int,
+                            help='set seconds to wait for requests on '
+                                 'keep-alive connections '
+                                 '(default: from config file)')
+    parser_run.add_argument('--backlog', type=int,
+                            help='set maximum number of pending connections '
+                                 '(default: from config file)')
+    parser_run.add_argument('--max-requests', type=int,
+                            help='restart workers after serving this many '
+                                 'requests, 0 to disable '
+                                 '(default: from config file)')
+    parser_run.add_argument('--max-requests-jitter', type=int,
+                            help='add random jitter up to this many requests '
+                                 'to --max-requests '
+                                 '(default: from config file)')
+    parser_run.add_argument('--timeout', type=int,
+                            help='restart workers silent for this many '
+                                 'seconds (default: from config file)')
+    parser_run.add_argument('--graceful-timeout', type=int,
+                            help='set seconds workers are given to finish '
+                                 'requests on restart '
+                                 '(default: from config file)')
+    parser_run.add_argument('--preload', dest='preload', action='store_true',
+                            default=None,
+                            help='load app in master process before '
+                                 'starting workers (default: from config '
+                                 'file)')
+    parser_run.add_argument('--no-preload', dest='preload',
+                            action='store_false',
+                            help='load app in each worker process')
     parser_run.add_argument('-d', '--debug', action='store_true',
                             help='run app in debug mode (enable Flask DEBUG '
                                  '- never run this in production or '
@@ -85,8 +227,72 @@ def main():
     parser_generate.add_argument('-l', '--loglevel', choices=LOGLEVEL_CHOICES,
                                  help='set logging verbosity level '
                                       '(default: from config file)')
+    parser_generate.add_argument('-c', '--concurrency', type=int,
+                                 help='maximum number of probe requests to '
+                                      'dispatch concurrently '
+                                      '(default: from config file)')
     parser_generate.set_defaults(func=_send_probe_requests)
 
+    schedule_description = ('Run scheduler dispatching probes to generators '
+                            'for monitored segments at regular intervals')
+    parser_schedule = subparsers.add_parser('schedule',
+                                            description=schedule_description,
+                                            help='run probe dispatch '
+                                                 'scheduler daemon')
+    parser_schedule.add_argument('configfile', type=valid_configfile,
+                                 help='load app configuration from specified file')
+    parser_schedule.add_argument('-l', '--loglevel', choices=LOGLEVEL_CHOICES,
+                                 help='set logging verbosity level '
+                                      '(default: from config file)')
+    parser_schedule.add_argument('-c', '--concurrency', type=int,
+                                 help='maximum number of probe requests to '
+                                      'dispatch concurrently '
+                                      '(default: from config file)')
+    parser_schedule.set_defaults(func=_run_scheduler)
+
+    prune_description = ('Prune received and generated probe logs exceeding '
+                         'configured retention limits')
+    parser_prune = subparsers.add_parser('prune',
+                                         description=prune_description,
+                                         help='prune old probe logs')
+    parser_prune.add_argument('configfile', type=valid_configfile,
+                              help='load app configuration from specified file')
+    parser_prune.add_argument('-l', '--loglevel', choices=LOGLEVEL_CHOICES,
+                              help='set logging verbosity level '
+                                   '(default: from config file)')
+    parser_prune.add_argument('-b', '--batch-size', type=int,
+                              help='maximum number of logs deleted per '
+                                   'transaction (default: from config file)')
+    parser_prune.add_argument('-n', '--dry-run', action='store_true',
+                              help='report number of logs that would be '
+                                   'pruned without deleting them')
+    parser_prune.set_defaults(func=_prune_probe_logs)
+
+    export_description = ('Export received or generated probe logs as CSV '
+                          'or newline-delimited JSON')
+    parser_export = subparsers.add_parser('export',
+                                          description=export_description,
+                                          help='export probe logs')
+    parser_export.add_argument('configfile', type=valid_configfile,
+                               help='load app configuration from specified file')
+    parser_export.add_argument('log_type', choices=['received', 'generated'],
+                               help='type of probe logs to export')
+    parser_export.add_argument('-f', '--format', choices=['csv', 'ndjson'],
+                               default='csv',
+                               help='export format (default: %(default)s)')
+    parser_export.add_argument('-o', '--output',
+                               help='write export to specified file '
+                                    '(default: standard output)')
+    parser_export.add_argument('-z', '--gzip', action='store_true',
+                               help='gzip compress export')
+    parser_export.add_argument('-s', '--start',
+                               help='export logs timestamped at or after '
+                                    'YYYY-MM-DDTHH:MM:SS (UTC)')
+    parser_export.add_argument('-e', '--end',
+                               help='export logs timestamped at or before '
+                                    'YYYY-MM-DDTHH:MM:SS (UTC)')
+    parser_export.set_defaults(func=_export_probe_logs)
+
     verify_description = ('Verify monitored segments by checking for '
                          'received probe alerts from sensors')
     parser_verify = subparsers.add_parser('verify',
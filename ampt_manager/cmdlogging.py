@@ -0,0 +1,32 @@
+'''
+AMPT manager command line logging.
+
+Logging configuration shared by command line processes (dispatch, schedule
+and prune).
+'''
+
+import logging
+
+from flask.logging import default_handler
+
+from .web import app
+
+
+def setup_logging(args):
+    'Configure app logging for command line processes'
+    # TODO: fix how this is duplicating the Flask app logging configuration from
+    # the runserver module; need moar DRY
+    app.logger.removeHandler(default_handler)
+    app_formatter = app.config['LOG_FORMATTER']
+    stream_handler = logging.StreamHandler()
+    stream_handler.setLevel((args.loglevel or app.config.get('LOGLEVEL')).upper())
+    stream_handler.setFormatter(app_formatter)
+    app.logger.addHandler(stream_handler)
+    app.logger.setLevel((args.loglevel or app.config.get('LOGLEVEL')).upper())
+
+    if app.config.get('LOGFILE'):
+        file_handler = logging.FileHandler(app.config['LOGFILE'])
+        file_handler.setLevel((args.loglevel or app.config.get('LOGLEVEL')).upper())
+        file_handler.setFormatter(app_formatter)
+        app.logger.addHandler(file_handler)
+        app.logger.setLevel((args.loglevel or app.config.get('LOGLEVEL')).upper())
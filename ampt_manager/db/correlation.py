@@ -0,0 +1,192 @@
+'''
+AMPT manager probe correlation
+
+Matches received probe logs to the generated probes that caused them, by
+monitored segment (destination address, port and protocol) and the
+randomly chosen probe source port, within CORRELATION_WINDOW seconds of
+dispatch. Matching happens as received probe logs are stored, and is
+retried against stored logs for probes still unmatched after the window
+(whose logs may have been stored before the probe was), before they are
+periodically marked as lost. Each
+match or loss is added to the health summary of the probe's segment, so
+delivery latency and loss rate are maintained incrementally instead of by
+joining the log tables.
+
+'''
+import datetime
+from collections import defaultdict
+
+from .models import (ampt_db, GeneratedProbeLog, ReceivedProbeLog,
+                     SegmentHealth, PROBE_PENDING, PROBE_RECEIVED, PROBE_LOST)
+from ..web import app
+
+
+def correlate_probe_logs(logs):
+    '''
+    Match received probe logs to pending generated probes and record
+    matches in segment health summaries.
+
+    :param logs:
+        Iterable of (segment ID, source port, receipt time) tuples of
+        received probe logs, which must be stored in the same transaction.
+
+    Returns number of probes matched. Each probe is matched by at most one
+    received probe log (the first received, if several event monitors
+    observed it).
+
+    '''
+    window = datetime.timedelta(seconds=app.config['CORRELATION_WINDOW'])
+    by_segment = defaultdict(list)
+    for segment_id, src_port, recv_time in logs:
+        by_segment[segment_id].append((src_port, recv_time))
+
+    matched = 0
+    for segment_id, segment_logs in sorted(by_segment.items()):
+        earliest = min(recv_time for _, recv_time in segment_logs) - window
+        # Candidate probes for all logs of the segment, earliest first
+        candidates = defaultdict(list)
+        query = (GeneratedProbeLog
+                 .select(GeneratedProbeLog.id,
+                         GeneratedProbeLog.src_port,
+                         GeneratedProbeLog.send_time)
+                 .where((GeneratedProbeLog.monitored_segment == segment_id)
+                        & GeneratedProbeLog.src_port.in_(
+                            list(set(p for p, _ in segment_logs)))
+                        & (GeneratedProbeLog.correlation == PROBE_PENDING)
+                        & (GeneratedProbeLog.send_time >= earliest))
+                 .order_by(GeneratedProbeLog.send_time)
+                 .tuples())
+        for id, src_port, send_time in query:
+            candidates[src_port].append((id, send_time))
+
+        latencies = []
+        for src_port, recv_time in sorted(segment_logs, key=lambda l: l[1]):
+            for i, (id, send_time) in enumerate(candidates[src_port]):
+                if send_time <= recv_time <= send_time + window:
+                    del candidates[src_port][i]
+                    updated = (GeneratedProbeLog
+                               .update(correlation=PROBE_RECEIVED,
+                                       recv_time=recv_time)
+                               .where((GeneratedProbeLog.id == id)
+                                      & (GeneratedProbeLog.correlation
+                                         == PROBE_PENDING))
+                               .execute())
+                    if updated:
+                        latencies.append(
+                            (recv_time - send_time).total_seconds())
+                    break
+        if latencies:
+            SegmentHealth.record(segment_id,
+                                 matched_count=len(latencies),
+                                 latency_total=sum(latencies),
+                                 last_latency=latencies[-1])
+            matched += len(latencies)
+    return matched
+
+
+def correlate_pending_probes(cutoff):
+    '''
+    Match pending generated probes dispatched before `cutoff` to stored
+    received probe logs and record matches in segment health summaries.
+
+    Probe logs are matched to probes as they are stored, which misses logs
+    received before the generated probe log was stored (the generator
+    responds after sending the probe). Each probe is given a final chance
+    to be matched before it is marked lost.
+
+    Returns number of probes matched.
+
+    '''
+    window = datetime.timedelta(seconds=app.config['CORRELATION_WINDOW'])
+    pending = (GeneratedProbeLog
+               .select(GeneratedProbeLog.id,
+                       GeneratedProbeLog.monitored_segment,
+                       GeneratedProbeLog.src_port,
+                       GeneratedProbeLog.send_time)
+               .where((GeneratedProbeLog.correlation == PROBE_PENDING)
+                      & (GeneratedProbeLog.send_time < cutoff))
+               .order_by(GeneratedProbeLog.send_time)
+               .tuples())
+    by_segment = defaultdict(list)
+    for id, segment_id, src_port, send_time in pending:
+        by_segment[segment_id].append((id, src_port, send_time))
+
+    matched = 0
+    for segment_id, probes in sorted(by_segment.items()):
+        # Received logs of the segment within the windows of its probes,
+        # earliest first
+        logs = defaultdict(list)
+        query = (ReceivedProbeLog
+                 .select(ReceivedProbeLog.src_port, ReceivedProbeLog.recv_time)
+                 .where((ReceivedProbeLog.segment == segment_id)
+                        & (ReceivedProbeLog.recv_time >= probes[0][2])
+                        & (ReceivedProbeLog.recv_time
+                           <= probes[-1][2] + window))
+                 .order_by(ReceivedProbeLog.recv_time)
+                 .tuples())
+        for src_port, recv_time in query:
+            logs[src_port].append(recv_time)
+
+        latencies = []
+        with ampt_db.atomic():
+            for id, src_port, send_time in probes:
+                for recv_time in logs[src_port]:
+                    if send_time <= recv_time <= send_time + window:
+                        logs[src_port].remove(recv_time)
+                        updated = (GeneratedProbeLog
+                                   .update(correlation=PROBE_RECEIVED,
+                                           recv_time=recv_time)
+                                   .where((GeneratedProbeLog.id == id)
+                                          & (GeneratedProbeLog.correlation
+                                             == PROBE_PENDING))
+                                   .execute())
+                        if updated:
+                            latencies.append(
+                                (recv_time - send_time).total_seconds())
+                        break
+            if latencies:
+                SegmentHealth.record(segment_id,
+                                     matched_count=len(latencies),
+                                     latency_total=sum(latencies),
+                                     last_latency=latencies[-1])
+        matched += len(latencies)
+    if matched:
+        app.logger.info('matched {cnt} pending probes to stored probe '
+                        'logs'.format(cnt=matched))
+    return matched
+
+
+def expire_pending_probes():
+    '''
+    Mark generated probes not matched within the correlation window as
+    lost and record losses in segment health summaries. Probes are first
+    matched to stored received probe logs, if they were not when the logs
+    were stored.
+
+    Returns number of probes marked lost.
+
+    '''
+    cutoff = (datetime.datetime.utcnow()
+              - datetime.timedelta(seconds=app.config['CORRELATION_WINDOW']))
+    correlate_pending_probes(cutoff)
+    expired = ((GeneratedProbeLog.correlation == PROBE_PENDING)
+               & (GeneratedProbeLog.send_time < cutoff))
+    segment_ids = (GeneratedProbeLog
+                   .select(GeneratedProbeLog.monitored_segment)
+                   .where(expired)
+                   .distinct()
+                   .tuples())
+    lost = 0
+    for segment_id, in list(segment_ids):
+        with ampt_db.atomic():
+            cnt = (GeneratedProbeLog
+                   .update(correlation=PROBE_LOST)
+                   .where(expired
+                          & (GeneratedProbeLog.monitored_segment == segment_id))
+                   .execute())
+            if cnt:
+                SegmentHealth.record(segment_id, lost_count=cnt)
+        lost += cnt
+    if lost:
+        app.logger.info('marked {cnt} unmatched probes as lost'.format(cnt=lost))
+    return lost
@@ -1,18 +1,22 @@
 '''AMPT manager database routines'''
 
 import os.path
+import sys
 from peewee import *
 from flask import Flask
-from playhouse.flask_utils import FlaskDB
+from playhouse.migrate import SchemaMigrator, migrate
 
 from .models import *
+from .models import ampt_db, pragmas, GLOBAL_COUNTER_SCOPE
+from .connection import redact_database, is_sqlite
 from ..web import app
 from ..web.crypt import bcrypt
 from .. import settings
 
 
 MODEL_LIST = [ProbeGenerator, EventMonitor, MonitoredSegment, ReceivedProbeLog,
-              GeneratedProbeLog, User]
+              GeneratedProbeLog, User, ReplayCounter, SegmentDailySummary,
+              SegmentHealth]
 
 
 def get_generator_choices():
@@ -44,16 +48,12 @@ def initialize_database(args, admin_user, admin_pw):
     creation of new app instance/config.
 
     '''
-    ampt_db = SqliteDatabase(app.config['DATABASE'])
-    database = FlaskDB(app, ampt_db)
-
-    # Create tables from peewee models
-    for model in MODEL_LIST:
-        # If told to force initialization, drop existing tables. Fail silently
-        # if force option specified but no tables exist.
-        if args.force:
-            model.drop_table(fail_silently=True)
-        model.create_table()
+    # Create tables from peewee models, in order of their dependencies.
+    # If told to force initialization, drop existing tables. Fail silently
+    # if force option specified but no tables exist.
+    if args.force:
+        ampt_db.drop_tables(MODEL_LIST, safe=True)
+    ampt_db.create_tables(MODEL_LIST)
 
     # Create default admin user
     pw_hash = bcrypt.generate_password_hash(admin_pw)
@@ -73,3 +73,187 @@ def initialize_database(args, admin_user, admin_pw):
                           created_by=initial_user,
                           last_modified_by=initial_user)
 
+
+def get_active_pragmas():
+    '''
+    Return list of tuples of pragma name, configured value and value active
+    on the current database connection for the configured pragmas (empty
+    if the database is not a SQLite database)
+
+    '''
+    if not is_sqlite(ampt_db):
+        return []
+    return [(name, value, ampt_db.pragma(name))
+            for name, value in sorted(pragmas.items())]
+
+
+def show_database_info(args):
+    '''
+    Display database location and active performance profile pragmas.
+
+    '''
+    print('database: {db}'.format(db=redact_database(app.config['DATABASE'])))
+    print('backend: {backend}'.format(backend=type(ampt_db).__name__))
+    if not is_sqlite(ampt_db):
+        return
+    print('{:<15} {:>15} {:>15}'.format('pragma', 'configured', 'active'))
+    for name, configured, active in get_active_pragmas():
+        print('{:<15} {:>15} {:>15}'.format(name, str(configured),
+                                            str(active)))
+
+
+def upgrade_database(args):
+    '''
+    Upgrade database of existing ampt_manager instance.
+
+    Create tables, columns and indexes defined by the models that are
+    missing from an existing database (such as indexes added in newer
+    releases). Existing tables, indexes and data are left in place, so this
+    is safe to run repeatedly.
+
+    '''
+    existing_tables = set(ampt_db.get_tables())
+    existing_indexes = {table: set(i.name for i in ampt_db.get_indexes(table))
+                        for table in existing_tables}
+
+    with ampt_db.atomic():
+        # Columns must exist before indexes including them are created
+        add_missing_columns(existing_tables)
+        ampt_db.create_tables(MODEL_LIST, safe=True)
+
+    for model in MODEL_LIST:
+        table = model._meta.table_name
+        if table not in existing_tables:
+            print('created table {table}'.format(table=table))
+            if model is ReplayCounter:
+                migrate_counter_file()
+            elif model is SegmentHealth:
+                backfill_segment_health()
+            continue
+        indexes = set(i.name for i in ampt_db.get_indexes(table))
+        for index in sorted(indexes - existing_indexes[table]):
+            print('created index {index} on table {table}'.format(
+                index=index, table=table))
+    migrate_global_counter()
+    print('database {db} is up to date'.format(
+        db=redact_database(app.config['DATABASE'])))
+
+
+def get_missing_schema():
+    '''
+    Return list of tables (and `table.column` columns of existing tables)
+    defined by the models that are missing from the database
+
+    '''
+    existing_tables = set(ampt_db.get_tables())
+    missing = []
+    for model in MODEL_LIST:
+        table = model._meta.table_name
+        if table not in existing_tables:
+            missing.append(table)
+            continue
+        columns = set(c.name for c in ampt_db.get_columns(table))
+        missing.extend('{table}.{column}'.format(table=table,
+                                                 column=field.column_name)
+                       for field in model._meta.sorted_fields
+                       if field.column_name not in columns)
+    return missing
+
+
+def check_database_schema(configfile):
+    '''
+    Exit with an error if the database lacks tables or columns added in
+    newer releases, asking the user to upgrade it
+
+    '''
+    missing = get_missing_schema()
+    ampt_db.close()
+    if missing:
+        sys.exit('error: database {db} is missing {missing}; run '
+                 '`ampt-manager upgrade {configfile}` to upgrade it'.format(
+                     db=redact_database(app.config['DATABASE']),
+                     missing=', '.join(missing), configfile=configfile))
+
+
+def add_missing_columns(existing_tables):
+    '''
+    Add columns defined by the models that are missing from existing tables.
+    Columns added in newer releases are nullable or have default values.
+
+    '''
+    migrator = SchemaMigrator.from_database(ampt_db)
+    for model in MODEL_LIST:
+        table = model._meta.table_name
+        if table not in existing_tables:
+            continue
+        columns = set(c.name for c in ampt_db.get_columns(table))
+        for field in model._meta.sorted_fields:
+            if field.column_name in columns:
+                continue
+            migrate(migrator.add_column(table, field.column_name, field))
+            print('added column {column} to table {table}'.format(
+                column=field.column_name, table=table))
+
+
+def migrate_counter_file():
+    '''
+    Import replay counter from counter file used by earlier releases.
+
+    '''
+    counter_path = app.config.get('COUNTER_PATH')
+    if not counter_path or not os.path.exists(counter_path):
+        return
+    with open(counter_path, 'r') as f:
+        value = float(f.read() or settings.counter_db_init_val)
+    ReplayCounter.insert(scope=GLOBAL_COUNTER_SCOPE, value=value).execute()
+    print('imported replay counter value {value} from {path} (file is no '
+          'longer used and may be removed along with the COUNTER_PATH '
+          'setting)'.format(value=value, path=counter_path))
+
+
+def migrate_global_counter():
+    '''
+    Replace replay counter shared by all event monitors in earlier releases
+    with a counter for each event monitor, starting from the shared value.
+
+    '''
+    try:
+        counter = ReplayCounter.get(ReplayCounter.scope == GLOBAL_COUNTER_SCOPE)
+    except ReplayCounter.DoesNotExist:
+        return
+    with ampt_db.atomic():
+        for monitor in EventMonitor.select(EventMonitor.id):
+            (ReplayCounter.insert(scope=monitor.id, value=counter.value)
+                          .on_conflict_ignore()
+                          .execute())
+        counter.delete_instance()
+    print('replaced shared replay counter with per-monitor replay counters')
+
+
+def backfill_segment_health():
+    '''
+    Populate segment health summaries from stored probe logs.
+
+    '''
+    received = (ReceivedProbeLog
+                .select(ReceivedProbeLog.segment,
+                        fn.COUNT(ReceivedProbeLog.id),
+                        fn.MAX(ReceivedProbeLog.recv_time),
+                        fn.MAX(ReceivedProbeLog.alert_time))
+                .group_by(ReceivedProbeLog.segment)
+                .tuples())
+    generated = (GeneratedProbeLog
+                 .select(GeneratedProbeLog.monitored_segment,
+                         fn.COUNT(GeneratedProbeLog.id),
+                         fn.MAX(GeneratedProbeLog.send_time))
+                 .group_by(GeneratedProbeLog.monitored_segment)
+                 .tuples())
+    with ampt_db.atomic():
+        for segment_id, cnt, last_recv_time, last_alert_time in received:
+            SegmentHealth.record(segment_id, received_count=cnt,
+                                 last_recv_time=last_recv_time,
+                                 last_alert_time=last_alert_time)
+        for segment_id, cnt, last_dispatch_time in generated:
+            SegmentHealth.record(segment_id, generated_count=cnt,
+                                 last_dispatch_time=last_dispatch_time)
+    print('populated segment health summaries from stored probe logs')
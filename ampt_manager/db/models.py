@@ -9,9 +9,11 @@ from playhouse.flask_utils import FlaskDB
 from ..web import app
 from .. import settings
 from ..web.crypt import bcrypt
+from .connection import create_database
 
 __all__ = ['User', 'ProbeGenerator', 'EventMonitor', 'MonitoredSegment',
-           'ReceivedProbeLog', 'GeneratedProbeLog']
+           'ReceivedProbeLog', 'GeneratedProbeLog', 'ReplayCounter',
+           'SegmentDailySummary', 'SegmentHealth']
 
 # List of supported EventMonitor types
 MONITOR_TYPES = [
@@ -26,8 +28,30 @@ PROBE_PROTOCOLS = [
 ]
 # Support logs from event monitors that don't include IP protocol
 LOG_PROBE_PROTOCOLS = PROBE_PROTOCOLS + [('unspecified', 'Unspecified')]
+# Scope of the replay counter shared by all event monitors in earlier
+# releases. Replay counters are now scoped to the ID of each event monitor.
+GLOBAL_COUNTER_SCOPE = 0
+# Correlation states of generated probes: awaiting a matching received probe
+# log, matched by a received probe log, or not matched within the
+# correlation window. Probes dispatched by earlier releases have no state.
+PROBE_PENDING = 0
+PROBE_RECEIVED = 1
+PROBE_LOST = 2
+PROBE_CORRELATION_STATES = [
+    (PROBE_PENDING, 'Pending'),
+    (PROBE_RECEIVED, 'Received'),
+    (PROBE_LOST, 'Lost'),
+]
 
-ampt_db = SqliteDatabase(app.config['DATABASE'])
+# Apply database performance profile, with configured pragmas overriding
+# the defaults (SQLite only)
+pragmas = dict(settings.DATABASE_PRAGMAS)
+pragmas.update(app.config['DATABASE_PRAGMAS'])
+ampt_db = create_database(app.config['DATABASE'],
+                          pragmas=pragmas,
+                          pool_size=app.config['DATABASE_POOL_SIZE'],
+                          stale_timeout=app.config['DATABASE_POOL_STALE_TIMEOUT'],
+                          pool_timeout=app.config['DATABASE_POOL_TIMEOUT'])
 database = FlaskDB(app, ampt_db)
 
 class BaseModel(database.Model):
@@ -146,6 +170,19 @@ class ReceivedProbeLog(BaseModel):
     alert_time = DateTimeField(help_text='Timestamp for probe alert creation on reporting sensor device')
     segment = ForeignKeyField(MonitoredSegment, help_text='Monitored Segment match for probe log')
 
+    class Meta:
+        # Multi-column indexes supporting segment verification by alert time,
+        # latest received log per segment, log listing by receipt time and
+        # log search by monitor, source address and alert time
+        indexes = (
+            (('segment', 'alert_time'), False),
+            (('segment', 'recv_time'), False),
+            (('recv_time',), False),
+            (('alert_time',), False),
+            (('monitor', 'alert_time'), False),
+            (('src_addr', 'alert_time'), False),
+        )
+
     def get_protocol_label(self):
         'Return display value for protocol choice field'
         return dict(LOG_PROBE_PROTOCOLS)[self.protocol]
@@ -154,4 +191,130 @@ class GeneratedProbeLog(BaseModel):
     probe_generator = ForeignKeyField(ProbeGenerator)
     monitored_segment = ForeignKeyField(MonitoredSegment)
     send_time = DateTimeField(default=datetime.datetime.utcnow)
+    src_port = IntegerField(null=True, help_text='Source port requested for probe packet')
+    correlation = IntegerField(null=True, choices=PROBE_CORRELATION_STATES, help_text='Correlation state of probe with received probe logs')
+    recv_time = DateTimeField(null=True, help_text='Receipt timestamp of first received probe log matching probe')
+
+    class Meta:
+        # Indexes supporting log listing by dispatch time, matching of
+        # received probe logs to probes and expiry of unmatched probes
+        indexes = (
+            (('send_time',), False),
+            (('monitored_segment', 'src_port', 'correlation'), False),
+            (('correlation', 'send_time'), False),
+        )
+
+
+class SegmentHealth(BaseModel):
+    segment = ForeignKeyField(MonitoredSegment, primary_key=True, help_text='Monitored Segment summarized')
+    last_recv_time = DateTimeField(null=True, help_text='Receipt timestamp of latest received probe log')
+    last_alert_time = DateTimeField(null=True, help_text='Alert timestamp of latest received probe log')
+    last_dispatch_time = DateTimeField(null=True, help_text='Timestamp of latest probe request dispatch')
+    received_count = IntegerField(default=0, help_text='Number of stored received probe logs')
+    generated_count = IntegerField(default=0, help_text='Number of stored generated probe logs')
+    matched_count = IntegerField(default=0, help_text='Number of probes matched by received probe logs')
+    lost_count = IntegerField(default=0, help_text='Number of probes not matched within correlation window')
+    latency_total = DoubleField(default=0, help_text='Sum of dispatch to receipt latencies (seconds) of matched probes')
+    last_latency = DoubleField(null=True, help_text='Dispatch to receipt latency (seconds) of latest matched probe')
+
+    def get_mean_latency(self):
+        'Return mean dispatch to receipt latency of matched probes in seconds'
+        if not self.matched_count:
+            return None
+        return self.latency_total / self.matched_count
+
+    def get_loss_rate(self):
+        'Return fraction of correlated probes that were not received'
+        correlated = self.matched_count + self.lost_count
+        if not correlated:
+            return None
+        return self.lost_count / correlated
+
+    @classmethod
+    def record(cls, segment, received_count=0, generated_count=0,
+               last_recv_time=None, last_alert_time=None,
+               last_dispatch_time=None, matched_count=0, lost_count=0,
+               latency_total=0, last_latency=None):
+        '''
+        Add received/generated probe log counts, probe correlation results
+        and latest timestamps to the health summary of a monitored segment.
 
+        The summary is created or updated with a single upsert statement.
+        Counts are added to the stored counts and timestamps only replace
+        stored timestamps that are older, so concurrent server processes
+        may record logs for the same segment in any order.
+
+        '''
+        def latest(field):
+            excluded = getattr(EXCLUDED, field.column_name)
+            return Case(None, [(excluded.is_null(False)
+                                & (field.is_null() | (field < excluded)),
+                                excluded)],
+                        field)
+
+        update = {
+            cls.received_count: cls.received_count + received_count,
+            cls.generated_count: cls.generated_count + generated_count,
+            cls.matched_count: cls.matched_count + matched_count,
+            cls.lost_count: cls.lost_count + lost_count,
+            cls.latency_total: cls.latency_total + latency_total,
+            cls.last_recv_time: latest(cls.last_recv_time),
+            cls.last_alert_time: latest(cls.last_alert_time),
+            cls.last_dispatch_time: latest(cls.last_dispatch_time),
+        }
+        if last_latency is not None:
+            update[cls.last_latency] = last_latency
+        (cls.insert(segment=segment,
+                    received_count=received_count,
+                    generated_count=generated_count,
+                    matched_count=matched_count,
+                    lost_count=lost_count,
+                    latency_total=latency_total,
+                    last_latency=last_latency,
+                    last_recv_time=last_recv_time,
+                    last_alert_time=last_alert_time,
+                    last_dispatch_time=last_dispatch_time)
+            .on_conflict(conflict_target=[cls.segment], update=update)
+            .execute())
+
+
+class ReplayCounter(BaseModel):
+    scope = IntegerField(primary_key=True,
+                         help_text='Scope of replay counter (Event Monitor ID)')
+    value = DoubleField(default=settings.counter_db_init_val,
+                        help_text='Counter value of last accepted message')
+
+    @classmethod
+    def advance(cls, scope, value):
+        '''
+        Advance replay counter for scope to value if it is greater than the
+        stored counter.
+
+        A counter is first seeded with the initial counter value for scopes
+        without one (ignoring a counter seeded concurrently), so that the
+        comparison and update are always a single conditional UPDATE and
+        concurrent server processes can never both accept the same value.
+        Returns True if the counter was advanced, False otherwise.
+
+        '''
+        (cls
+         .insert(scope=scope, value=settings.counter_db_init_val)
+         .on_conflict_ignore()
+         .execute())
+        updated = (cls.update(value=value)
+                      .where((cls.scope == scope) & (cls.value < value))
+                      .execute())
+        return bool(updated)
+
+
+class SegmentDailySummary(BaseModel):
+    segment = ForeignKeyField(MonitoredSegment, help_text='Monitored Segment summarized')
+    day = DateField(help_text='Day (UTC) summarized')
+    received_count = IntegerField(default=0, help_text='Number of received probe logs pruned for the day')
+    generated_count = IntegerField(default=0, help_text='Number of generated probe logs pruned for the day')
+
+    class Meta:
+        # Unique multi-column index on summary segment/day
+        indexes = (
+            (('segment', 'day'), True),
+        )
@@ -8,11 +8,21 @@ import hmac
 import json
 import time
 import random
-import logging
+import datetime
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from .web import app
 from .db.models import *
+from .db.models import ampt_db, PROBE_PENDING
+from .db.connection import is_sqlite
+from .db.correlation import expire_pending_probes
+from .web.cache import invalidate_dashboard_cache
+from .metrics import PROBE_DISPATCHES, PROBE_DISPATCH_SECONDS
+from .cmdlogging import setup_logging
 
 
 from flask.logging import default_handler
@@ -20,6 +30,15 @@ app.logger.removeHandler(default_handler)
 
 app.config.from_envvar('AMPT_MANAGER_SETTINGS')
 
+# HTTP status codes from the batch endpoint indicating that a generator does
+# not support batched probe requests
+BATCH_UNSUPPORTED_STATUS = (404, 405, 501)
+# IDs of generators found not to support batched probe requests
+_batch_unsupported = set()
+# Pooled HTTP sessions keyed by generator address and port
+_sessions = {}
+_sessions_lock = threading.Lock()
+
 class ProbeRequest(object):
     '''
     Probe dispatch request.
@@ -31,6 +50,8 @@ class ProbeRequest(object):
     def __init__(self, segment):
         self.segment = segment
         self.generator = segment.generator
+        self.src_port = None
+        self.send_time = None
 
     def dispatch_probe_request(self):
         'Send probe request for monitored segment to generator'
@@ -44,31 +65,26 @@ class ProbeRequest(object):
             return
 
         # Define base parameters providing info needed by generator to
-        # validate request and dispatch packet. The four-tuple of destination
-        # address, source and destination port and protocol are required to
-        # dispatch probes, and the timestamp field provides an incrementing
-        # counter of sorts for some replay protection.
-        params = {
-            'dest_addr': self.segment.dest_addr,
-            'dest_port': self.segment.dest_port,
-            'src_port': random.randrange(49152, 65535),
-            'proto': self.segment.protocol,
-            'ts': time.time(),
-        }
-        # HMAC: build message from unindented, key-sorted JSON of parameters
-        j = json.dumps(params, sort_keys=True)
-        # HMAC: compute with generator auth key and message digest
-        # from configuration
-        h = hmac.new(bytes(self.generator.auth_key.encode('utf-8')),
-                     j.encode('utf-8'), app.config['HMAC_DIGEST'])
-        # HMAC: append hex digest to request parameters
-        params.update(h=h.hexdigest())
+        # validate request and dispatch packet. The timestamp field provides
+        # an incrementing counter of sorts for some replay protection.
+        params = self.get_probe_params()
+        params.update(ts=time.time())
+        sign_request(params, self.generator.auth_key)
 
         generator = 'http://{address}:{port}/api/generate_probe'.format(
             address=self.generator.address, port=self.generator.port)
+        timeout = (app.config['DISPATCH_CONNECT_TIMEOUT'],
+                   app.config['DISPATCH_READ_TIMEOUT'])
         try:
-            r = requests.get(generator, params=params)
-        except requests.exceptions.ConnectionError as e:
+            session = get_generator_session(self.generator)
+            # Probes may be received before the generator responds, so the
+            # dispatch is timed from sending the request
+            self.send_time = datetime.datetime.utcnow()
+            with PROBE_DISPATCH_SECONDS.time():
+                r = session.get(generator, params=params, timeout=timeout)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            PROBE_DISPATCHES.labels(result='failed').inc()
             errmsg = ('failure dispatching probe request to {generator} '
                       '(ID: {generator_id}) for {segment} '
                       '(ID: {segment_id}): {err}')
@@ -88,49 +104,323 @@ class ProbeRequest(object):
                                        generator_id=self.generator.id,
                                        detail=response_data,
                                        segment=self.segment.name))
+            PROBE_DISPATCHES.labels(result='accepted').inc()
             self.log_probe_dispatch()
         else:
             # Likely HTTP error, raise exception for caller
+            PROBE_DISPATCHES.labels(result='rejected').inc()
             r.raise_for_status()
 
+    def get_probe_params(self):
+        '''
+        Return probe parameters for monitored segment
+
+        The four-tuple of destination address, source and destination port and
+        protocol are required by the generator to dispatch probes. The
+        randomly chosen source port is kept to correlate received probe logs
+        with the probe.
+
+        '''
+        self.src_port = random.randrange(49152, 65535)
+        return {
+            'dest_addr': self.segment.dest_addr,
+            'dest_port': self.segment.dest_port,
+            'src_port': self.src_port,
+            'proto': self.segment.protocol,
+        }
+
     def log_probe_dispatch(self):
         'Log probe request dispatch to generator'
         pl = GeneratedProbeLog()
         pl.probe_generator = self.generator
         pl.monitored_segment = self.segment
-        pl.save()
+        pl.src_port = self.src_port
+        pl.send_time = self.send_time or datetime.datetime.utcnow()
+        pl.correlation = PROBE_PENDING
+        with ampt_db.atomic():
+            pl.save()
+            SegmentHealth.record(self.segment.id, generated_count=1,
+                                 last_dispatch_time=pl.send_time)
+        invalidate_dashboard_cache(logs=True)
+
+class BatchProbeRequest(object):
+    '''
+    Batched probe dispatch request.
+
+    Encapsulates a set of monitored segments sharing the same probe generator
+    so that probes for all of them can be requested from the generator in a
+    single signed request. The generator replies with one result per
+    requested probe, in request order.
+
+    '''
+    def __init__(self, generator, segments):
+        self.generator = generator
+        self.probe_requests = [ProbeRequest(segment) for segment in segments]
+
+    def dispatch_probe_requests(self):
+        '''
+        Send batched probe request for monitored segments to generator
+
+        Returns False if the generator does not support batched probe
+        requests, in which case the caller should fall back to dispatching
+        individual probe requests.
+
+        '''
+        if not self.generator.active:
+            errmsg = ('aborting probe generation for {cnt} segments - '
+                      '{generator} (ID: {generator_id}) is inactive')
+            app.logger.warning(errmsg.format(cnt=len(self.probe_requests),
+                                             generator=self.generator.name,
+                                             generator_id=self.generator.id))
+            return True
+
+        # A single HMAC covers the whole batch of probe parameters as well as
+        # the timestamp counter
+        params = {
+            'probes': [pr.get_probe_params() for pr in self.probe_requests],
+            'ts': time.time(),
+        }
+        sign_request(params, self.generator.auth_key)
+
+        generator = 'http://{address}:{port}/api/generate_probes'.format(
+            address=self.generator.address, port=self.generator.port)
+        timeout = (app.config['DISPATCH_CONNECT_TIMEOUT'],
+                   app.config['DISPATCH_READ_TIMEOUT'])
+        try:
+            session = get_generator_session(self.generator)
+            send_time = datetime.datetime.utcnow()
+            for pr in self.probe_requests:
+                pr.send_time = send_time
+            with PROBE_DISPATCH_SECONDS.time():
+                r = session.post(generator, json=params, timeout=timeout)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            PROBE_DISPATCHES.labels(result='failed').inc(
+                len(self.probe_requests))
+            errmsg = ('failure dispatching batched probe request to '
+                      '{generator} (ID: {generator_id}) for {cnt} segments: '
+                      '{err}')
+            app.logger.error(errmsg.format(generator=self.generator.name,
+                                           generator_id=self.generator.id,
+                                           cnt=len(self.probe_requests),
+                                           err=e))
+            return True
+
+        if r.status_code in BATCH_UNSUPPORTED_STATUS:
+            # Generator does not advertise the batch endpoint, remember this
+            # so that further dispatches go straight to the per-probe endpoint
+            msg = ('ProbeGenerator {generator} (ID: {generator_id}) does not '
+                   'support batched probe requests (HTTP {status})')
+            app.logger.info(msg.format(generator=self.generator.name,
+                                       generator_id=self.generator.id,
+                                       status=r.status_code))
+            _batch_unsupported.add(self.generator.id)
+            return False
+        # Likely HTTP error, raise exception for caller
+        if not r.ok:
+            PROBE_DISPATCHES.labels(result='rejected').inc(
+                len(self.probe_requests))
+        r.raise_for_status()
+
+        results = r.json().get('results', [])
+        if len(results) != len(self.probe_requests):
+            errmsg = ('ProbeGenerator {generator} (ID: {generator_id}) '
+                      'returned {res_cnt} results for batch of {cnt} probes')
+            app.logger.error(errmsg.format(generator=self.generator.name,
+                                           generator_id=self.generator.id,
+                                           res_cnt=len(results),
+                                           cnt=len(self.probe_requests)))
+            # Probes without a result are not logged as dispatched, count
+            # them as rejected rather than dropping them from the metrics
+            missing = len(self.probe_requests) - len(results)
+            if missing > 0:
+                PROBE_DISPATCHES.labels(result='rejected').inc(missing)
+        for pr, result in zip(self.probe_requests, results):
+            if result.get('accepted'):
+                msg = ('ProbeGenerator {generator} (ID: {generator_id}) '
+                       'accepted probe submission for {segment} '
+                       '(detail: {detail})')
+                app.logger.info(msg.format(generator=self.generator.name,
+                                           generator_id=self.generator.id,
+                                           detail=result,
+                                           segment=pr.segment.name))
+                PROBE_DISPATCHES.labels(result='accepted').inc()
+                pr.log_probe_dispatch()
+            else:
+                PROBE_DISPATCHES.labels(result='rejected').inc()
+                errmsg = ('ProbeGenerator {generator} (ID: {generator_id}) '
+                          'rejected probe submission for {segment} '
+                          '(detail: {detail})')
+                app.logger.warning(errmsg.format(generator=self.generator.name,
+                                                 generator_id=self.generator.id,
+                                                 detail=result,
+                                                 segment=pr.segment.name))
+        return True
+
+def get_generator_session(generator):
+    '''
+    Return pooled HTTP session for probe generator
+
+    One session is kept per generator address and port for the life of the
+    process so that repeated requests to a generator reuse established
+    (keep-alive) connections. Connection attempts are retried with
+    exponential backoff; requests are never retried once sent, since a
+    resent request would carry an already used timestamp counter.
+
+    '''
+    key = (generator.address, generator.port)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            retries = Retry(total=app.config['DISPATCH_RETRIES'],
+                            connect=app.config['DISPATCH_RETRIES'],
+                            read=0, status=0, redirect=0,
+                            backoff_factor=app.config['DISPATCH_RETRY_BACKOFF'])
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=app.config['DISPATCH_POOL_SIZE'],
+                                  max_retries=retries)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            if not app.config['DISPATCH_KEEPALIVE']:
+                session.headers['Connection'] = 'close'
+            _sessions[key] = session
+    return session
+
+def close_generator_sessions():
+    'Close pooled HTTP sessions and their connections to probe generators'
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+def sign_request(params, auth_key):
+    '''
+    Add HMAC digest to generator request parameters
+
+    The message is built from unindented, key-sorted JSON of the parameters
+    and the digest is computed with the generator auth key and message digest
+    from configuration. The hex digest is added to the parameters as `h`.
+
+    '''
+    j = json.dumps(params, sort_keys=True)
+    h = hmac.new(bytes(auth_key.encode('utf-8')),
+                 j.encode('utf-8'), app.config['HMAC_DIGEST'])
+    params.update(h=h.hexdigest())
+    return params
+
+def run_dispatch_task(func):
+    '''
+    Run probe dispatch task in a worker thread with a database connection
+    that is closed (returned to the pool for PostgreSQL) once the task is
+    done, rather than held by the worker thread for good
+
+    '''
+    with ampt_db.connection_context():
+        return func()
+
+def get_dispatch_concurrency(concurrency=None):
+    '''
+    Return number of probe dispatch worker threads, limited so that each
+    worker thread and the main thread can hold a pooled database connection
+
+    '''
+    concurrency = max(1, concurrency or app.config['DISPATCH_CONCURRENCY'])
+    max_connections = app.config['DATABASE_POOL_SIZE']
+    if (not is_sqlite(ampt_db) and max_connections
+            and concurrency >= max_connections):
+        errmsg = ('dispatch concurrency {concurrency} exceeds database pool '
+                  'size {size} (DATABASE_POOL_SIZE), dispatching with '
+                  'concurrency {limit}')
+        limit = max(1, max_connections - 1)
+        app.logger.warning(errmsg.format(concurrency=concurrency,
+                                         size=max_connections, limit=limit))
+        concurrency = limit
+    return concurrency
+
+def dispatch_segments(segments, executor):
+    '''
+    Dispatch probe requests for monitored segments using a bounded pool of
+    worker threads (`executor`) and wait for them to complete
+
+    Segments sharing a probe generator are dispatched in batched requests
+    (one per DISPATCH_BATCH_SIZE segments) unless batching is disabled or
+    the generator is known not to support it, in which case individual
+    probe requests are sent. Each request is bounded by the configured
+    connect and read timeouts, so a full dispatch run takes roughly as long
+    as the slowest generator rather than the sum of all of them. Failures
+    for individual requests are logged and do not abort dispatch for the
+    remaining segments.
+
+    '''
+    by_generator = {}
+    for segment in segments:
+        by_generator.setdefault(segment.generator.id, []).append(segment)
+
+    batch_size = max(1, app.config['DISPATCH_BATCH_SIZE'])
+    futures = {}
+
+    def submit_individual(segments):
+        for segment in segments:
+            future = executor.submit(
+                run_dispatch_task, ProbeRequest(segment).dispatch_probe_request)
+            futures[future] = [segment]
+
+    for generator_id, generator_segments in by_generator.items():
+        generator = generator_segments[0].generator
+        if (not app.config['DISPATCH_BATCH']
+                or len(generator_segments) < 2
+                or generator_id in _batch_unsupported):
+            submit_individual(generator_segments)
+            continue
+        for i in range(0, len(generator_segments), batch_size):
+            chunk = generator_segments[i:i + batch_size]
+            br = BatchProbeRequest(generator, chunk)
+            futures[executor.submit(run_dispatch_task,
+                                    br.dispatch_probe_requests)] = chunk
+
+    while futures:
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            failed_segments = futures.pop(future)
+            try:
+                if future.result() is False:
+                    # Batch not supported by generator, fall back to
+                    # individual probe requests
+                    submit_individual(failed_segments)
+            except Exception as e:
+                errmsg = ('probe request dispatch failed for {segments}: '
+                          '{err}')
+                app.logger.error(errmsg.format(
+                    segments=', '.join(['{name} (ID: {id})'.format(
+                        name=s.name, id=s.id) for s in failed_segments]),
+                    err=e))
+
+def get_active_segments():
+    'Return list of active monitored segments with their probe generators'
+    return list(MonitoredSegment.select(MonitoredSegment, ProbeGenerator)
+                .join(ProbeGenerator)
+                .where(MonitoredSegment.active == True))
 
 def send_probe_requests(args):
     '''
     Send probe requests for monitored segments to generator nodes
 
     '''
-    # TODO: fix how this is duplicating the Flask app logging configuration from
-    # the runserver module; need moar DRY
-    app_formatter = app.config['LOG_FORMATTER']
-    stream_handler = logging.StreamHandler()
-    stream_handler.setLevel((args.loglevel or app.config.get('LOGLEVEL')).upper())
-    stream_handler.setFormatter(app_formatter)
-    app.logger.addHandler(stream_handler)
-    app.logger.setLevel((args.loglevel or app.config.get('LOGLEVEL')).upper())
-
-    if app.config.get('LOGFILE'):
-        file_handler = logging.FileHandler(app.config['LOGFILE'])
-        file_handler.setLevel((args.loglevel or app.config.get('LOGLEVEL')).upper())
-        file_handler.setFormatter(app_formatter)
-        app.logger.addHandler(file_handler)
-        app.logger.setLevel((args.loglevel or app.config.get('LOGLEVEL')).upper())
+    setup_logging(args)
 
     # Dispatch
-    active_segments = (MonitoredSegment.select()
-                       .where(MonitoredSegment.active == True))
+    active_segments = get_active_segments()
     if active_segments:
-        msg = 'preparing to dispatch probe requests for {cnt} monitored segments'
-        app.logger.info(msg.format(cnt=active_segments.count()))
-
-        for segment in active_segments:
-            pr = ProbeRequest(segment)
-            pr.dispatch_probe_request()
+        concurrency = get_dispatch_concurrency(args.concurrency)
+        msg = ('preparing to dispatch probe requests for {cnt} monitored '
+               'segments (concurrency: {concurrency})')
+        app.logger.info(msg.format(cnt=len(active_segments),
+                                   concurrency=concurrency))
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            dispatch_segments(active_segments, executor)
+        close_generator_sessions()
+        expire_pending_probes()
     else:
         msg = 'there are no active monitored segments'
         app.logger.error(msg)
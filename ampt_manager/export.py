@@ -0,0 +1,151 @@
+'''
+AMPT manager probe log export.
+
+Serializes received or generated probe logs to CSV or newline-delimited
+JSON (NDJSON), optionally gzip compressed. Logs are read from the database
+with a cursor and serialized one row at a time, so exports of any size are
+produced in constant memory, whether written to a file by the `export`
+command or streamed as an HTTP response.
+'''
+
+import io
+import csv
+import sys
+import json
+import zlib
+import datetime
+
+from .db.models import ReceivedProbeLog, GeneratedProbeLog
+from .db.connection import iterate_query
+
+
+# Probe log types that may be exported, with the model and timestamp field
+# logs are ordered and filtered by
+EXPORT_LOG_TYPES = {
+    'received': (ReceivedProbeLog, ReceivedProbeLog.recv_time),
+    'generated': (GeneratedProbeLog, GeneratedProbeLog.send_time),
+}
+EXPORT_FORMATS = ('csv', 'ndjson')
+# Format of export time range arguments
+EXPORT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# Minimum size in bytes of the chunks yielded by an export
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+def parse_export_time(s):
+    'Return datetime for time range argument formatted as YYYY-MM-DDTHH:MM:SS'
+    return datetime.datetime.strptime(s, EXPORT_TIME_FORMAT)
+
+
+def get_export_fields(log_type):
+    'Return names of exported fields for probe log type'
+    model, _ = EXPORT_LOG_TYPES[log_type]
+    return [field.name for field in model._meta.sorted_fields]
+
+
+def get_export_rows(log_type, start=None, end=None):
+    '''
+    Return iterator over probe logs of `log_type` (as dicts), oldest first,
+    optionally limited to logs timestamped between `start` and `end`.
+
+    '''
+    model, time_field = EXPORT_LOG_TYPES[log_type]
+    query = model.select()
+    if start is not None:
+        query = query.where(time_field >= start)
+    if end is not None:
+        query = query.where(time_field <= end)
+    query = query.order_by(time_field, model.id).dicts()
+    return iterate_query(query)
+
+
+def _format_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def serialize_csv(rows, fields):
+    'Yield CSV header line and one line for each row'
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(fields)
+    for row in rows:
+        writer.writerow([_format_value(row[field]) for field in fields])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    # Header only, if there were no rows
+    yield buf.getvalue()
+
+
+def serialize_ndjson(rows, fields):
+    'Yield one JSON object line for each row'
+    for row in rows:
+        yield json.dumps({field: _format_value(row[field])
+                          for field in fields}) + '\n'
+
+
+def gzip_chunks(chunks, level=6):
+    'Yield gzip compressed stream of byte chunks'
+    # wbits=31 produces a gzip (rather than zlib) header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_probe_log_chunks(log_type, fmt, start=None, end=None,
+                            compress=False):
+    '''
+    Yield export of probe logs as byte chunks of at least
+    EXPORT_CHUNK_SIZE bytes (except the last).
+
+    '''
+    fields = get_export_fields(log_type)
+    rows = get_export_rows(log_type, start=start, end=end)
+    serialize = serialize_csv if fmt == 'csv' else serialize_ndjson
+
+    def buffered():
+        buf = []
+        size = 0
+        for line in serialize(rows, fields):
+            data = line.encode('utf-8')
+            buf.append(data)
+            size += len(data)
+            if size >= EXPORT_CHUNK_SIZE:
+                yield b''.join(buf)
+                buf = []
+                size = 0
+        yield b''.join(buf)
+
+    chunks = buffered()
+    if compress:
+        chunks = gzip_chunks(chunks)
+    return chunks
+
+
+def export_probe_logs(args):
+    '''
+    Export probe logs to file or standard output
+
+    '''
+    try:
+        start = parse_export_time(args.start) if args.start else None
+        end = parse_export_time(args.end) if args.end else None
+    except ValueError:
+        sys.exit('error: time range must be formatted as YYYY-MM-DDTHH:MM:SS')
+
+    chunks = export_probe_log_chunks(args.log_type, args.format,
+                                     start=start, end=end,
+                                     compress=args.gzip)
+    if args.output:
+        with open(args.output, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+    else:
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
@@ -0,0 +1,232 @@
+'''
+AMPT manager metrics.
+
+Counters and latency histograms for probe log ingestion, message
+verification, probe dispatch and segment verification, exposed in the
+Prometheus text format at /metrics. Metrics are recorded with the optional
+prometheus_client package (`pip install ampt-manager[metrics]`); without it,
+recording metrics does nothing and /metrics is not available.
+
+Server worker processes record metrics to files in a directory shared by
+all of them (METRICS_DIR, by default a `metrics` directory alongside the
+configuration file), and /metrics reports the sum across all processes.
+The `dispatch`, `schedule` and `verify` commands keep metrics in memory and
+push them to a Prometheus Pushgateway (METRICS_PUSHGATEWAY), if configured.
+'''
+
+import os
+import glob
+import time
+
+from flask import request, Response, abort
+from flask_login import current_user
+
+from .web import app
+
+
+# Environment variable set by the `run` command, so that the server and its
+# worker processes record metrics to shared files
+SERVER_ENV = 'AMPT_MANAGER_SERVER'
+
+
+def get_metrics_path():
+    '''
+    Return directory for metrics files: METRICS_DIR if set, otherwise a
+    `metrics` directory alongside the app configuration file
+
+    '''
+    if app.config.get('METRICS_DIR'):
+        return app.config['METRICS_DIR']
+    configfile = os.environ.get('AMPT_MANAGER_SETTINGS')
+    if configfile:
+        return os.path.join(os.path.dirname(os.path.abspath(configfile)),
+                            'metrics')
+    return None
+
+
+metrics_path = (get_metrics_path() if app.config['METRICS_ENABLED']
+                and os.environ.get(SERVER_ENV) else None)
+if metrics_path:
+    # prometheus_client selects multiprocess mode when first imported
+    os.makedirs(metrics_path, exist_ok=True)
+    os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', metrics_path)
+
+try:
+    if not app.config['METRICS_ENABLED']:
+        raise ImportError('metrics are disabled')
+    from prometheus_client import (Counter, Histogram, CollectorRegistry,
+                                   REGISTRY, CONTENT_TYPE_LATEST,
+                                   generate_latest, multiprocess,
+                                   push_to_gateway)
+    metrics_available = True
+except ImportError:
+    metrics_available = False
+
+
+class _NoopMetric(object):
+    'Stand-in for metrics when prometheus_client is not available'
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, amount):
+        pass
+
+    def time(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+if not metrics_available:
+    Counter = Histogram = _NoopMetric
+
+
+PROBE_LOG_REQUESTS = Counter(
+    'ampt_probe_log_requests_total',
+    'Probe log submission requests by endpoint and response status',
+    ['endpoint', 'status'])
+PROBE_LOG_REQUEST_SECONDS = Histogram(
+    'ampt_probe_log_request_seconds',
+    'Time handling probe log submission requests',
+    ['endpoint'])
+PROBE_LOGS = Counter(
+    'ampt_probe_logs_total',
+    'Submitted probe log events by result (accepted, rejected or error)',
+    ['result'])
+HMAC_FAILURES = Counter(
+    'ampt_hmac_failures_total',
+    'Probe log submissions failing HMAC digest verification')
+COUNTER_REJECTIONS = Counter(
+    'ampt_replay_counter_rejections_total',
+    'Probe log submissions failing replay counter verification')
+DB_WRITE_SECONDS = Histogram(
+    'ampt_db_write_seconds',
+    'Time storing probe logs (including summaries) by operation',
+    ['operation'])
+PROBE_DISPATCHES = Counter(
+    'ampt_probe_dispatches_total',
+    'Probe requests to generators by result (accepted, rejected or failed)',
+    ['result'])
+PROBE_DISPATCH_SECONDS = Histogram(
+    'ampt_probe_dispatch_seconds',
+    'Time dispatching individual probe requests to generators')
+SEGMENT_VERIFICATIONS = Counter(
+    'ampt_segment_verifications_total',
+    'Monitored segment verifications by result (ok or failed)',
+    ['result'])
+VERIFY_SECONDS = Histogram(
+    'ampt_verify_seconds',
+    'Time verifying all monitored segments')
+
+# Endpoints receiving probe logs, for which request metrics are recorded
+PROBE_LOG_ENDPOINTS = {
+    'ReceivedLogView:post': 'single',
+    'ReceivedLogView:batch': 'batch',
+}
+
+
+def pid_alive(pid):
+    'Return True if process `pid` is running'
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def clear_metrics():
+    '''
+    Remove metrics files of processes that are no longer running (those of
+    earlier server runs). Called when the server starts, before worker
+    processes are started.
+
+    '''
+    if metrics_available and metrics_path:
+        for path in glob.glob(os.path.join(metrics_path, '*.db')):
+            # Files are named <type>_<pid>.db
+            name = os.path.splitext(os.path.basename(path))[0]
+            try:
+                pid = int(name.rsplit('_', 1)[1])
+            except (IndexError, ValueError):
+                continue
+            if not pid_alive(pid):
+                os.remove(path)
+
+
+def mark_process_dead(pid):
+    'Discard live metrics of exited server worker process'
+    if metrics_available and metrics_path:
+        multiprocess.mark_process_dead(pid)
+
+
+def push_metrics(job):
+    '''
+    Push metrics of command line process to the Prometheus Pushgateway at
+    METRICS_PUSHGATEWAY (if set), grouped under job `ampt_manager_<job>`
+
+    '''
+    gateway = app.config.get('METRICS_PUSHGATEWAY')
+    if not metrics_available or metrics_path or not gateway:
+        return
+    try:
+        push_to_gateway(gateway, job='ampt_manager_{job}'.format(job=job),
+                        registry=REGISTRY)
+    except Exception as e:
+        errmsg = 'failed to push metrics to {gateway}: {err}'
+        app.logger.warning(errmsg.format(gateway=gateway, err=e))
+
+
+def start_request_timer():
+    if request.endpoint in PROBE_LOG_ENDPOINTS:
+        request.metrics_start_time = time.perf_counter()
+
+
+def record_request_metrics(response):
+    endpoint = PROBE_LOG_ENDPOINTS.get(request.endpoint)
+    start_time = getattr(request, 'metrics_start_time', None)
+    if endpoint and start_time is not None:
+        PROBE_LOG_REQUEST_SECONDS.labels(endpoint=endpoint).observe(
+            time.perf_counter() - start_time)
+        PROBE_LOG_REQUESTS.labels(endpoint=endpoint,
+                                  status=response.status_code).inc()
+    return response
+
+
+def show_metrics():
+    'Expose metrics in Prometheus text format'
+    if not metrics_available:
+        abort(404)
+    if not app.config['METRICS_PUBLIC'] and not current_user.is_authenticated:
+        # Scrapers may authenticate with HTTP basic authentication, if
+        # API_BASIC_AUTH is enabled
+        return app.login_manager.unauthorized()
+    if metrics_path:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry),
+                    content_type=CONTENT_TYPE_LATEST)
+
+
+def init_app(app):
+    '''
+    Record probe log request metrics for `app` and expose metrics at
+    /metrics
+
+    '''
+    app.before_request(start_request_timer)
+    app.after_request(record_request_metrics)
+    app.add_url_rule('/metrics', view_func=show_metrics)
@@ -0,0 +1,196 @@
+'''
+AMPT manager probe log retention.
+
+Prunes received and generated probe logs older than, or in excess of, the
+configured retention limits, optionally rolling pruned logs up into
+per-segment daily summary counts. Segment health summary counts are
+reduced by the number of logs pruned.
+'''
+
+import time
+import datetime
+from collections import Counter
+
+from .web import app
+from .cmdlogging import setup_logging
+from .db.models import (ampt_db, ReceivedProbeLog, GeneratedProbeLog,
+                        SegmentDailySummary, SegmentHealth)
+
+
+class RetentionPolicy(object):
+    '''
+    Retention policy for a probe log table.
+
+    :param model:
+        Probe log model to prune.
+    :param time_field:
+        Timestamp field used to determine the age of logs.
+    :param segment_field:
+        Monitored Segment foreign key field of the logs.
+    :param count_field:
+        SegmentDailySummary field counting pruned logs of this model.
+    :param health_field:
+        SegmentHealth field counting stored logs of this model.
+    :param max_age:
+        Maximum age of logs in days (0 means unlimited).
+    :param max_rows:
+        Maximum number of logs kept (0 means unlimited).
+
+    '''
+    def __init__(self, model, time_field, segment_field, count_field,
+                 health_field, max_age, max_rows):
+        self.model = model
+        self.time_field = time_field
+        self.segment_field = segment_field
+        self.count_field = count_field
+        self.health_field = health_field
+        self.max_age = max_age
+        self.max_rows = max_rows
+
+    @property
+    def name(self):
+        return self.model._meta.table_name
+
+    def get_expired_condition(self):
+        '''
+        Return query condition matching logs to prune, or None if the
+        policy does not limit the table
+
+        '''
+        conditions = []
+        if self.max_age:
+            cutoff = (datetime.datetime.utcnow()
+                      - datetime.timedelta(days=self.max_age))
+            conditions.append(self.time_field < cutoff)
+        if self.max_rows:
+            # IDs increase with insertion, so the logs in excess of the
+            # maximum are those at or below the ID just past the newest
+            # `max_rows` logs
+            boundary = (self.model.select(self.model.id)
+                                  .order_by(self.model.id.desc())
+                                  .offset(self.max_rows)
+                                  .limit(1)
+                                  .scalar())
+            if boundary is not None:
+                conditions.append(self.model.id <= boundary)
+        if not conditions:
+            return None
+        condition = conditions[0]
+        for c in conditions[1:]:
+            condition = condition | c
+        return condition
+
+    def count_expired(self):
+        'Return number of logs the policy would prune'
+        condition = self.get_expired_condition()
+        if condition is None:
+            return 0
+        return self.model.select().where(condition).count()
+
+    def prune(self, batch_size, pause, rollup):
+        '''
+        Delete expired logs in transactions of at most `batch_size` rows,
+        pausing `pause` seconds between transactions. Returns the number of
+        logs deleted.
+
+        '''
+        condition = self.get_expired_condition()
+        if condition is None:
+            return 0
+        deleted = 0
+        while True:
+            with ampt_db.atomic():
+                rows = (self.model.select(self.model.id,
+                                          self.segment_field,
+                                          self.time_field)
+                                  .where(condition)
+                                  .order_by(self.model.id)
+                                  .limit(batch_size)
+                                  .tuples())
+                rows = list(rows)
+                if not rows:
+                    break
+                if rollup:
+                    self.rollup(rows)
+                self.update_health(rows)
+                ids = [row[0] for row in rows]
+                (self.model.delete()
+                           .where(self.model.id.in_(ids))
+                           .execute())
+            deleted += len(rows)
+            app.logger.debug('pruned {cnt} logs from {table}'.format(
+                cnt=len(rows), table=self.name))
+            if len(rows) < batch_size:
+                break
+            time.sleep(pause)
+        return deleted
+
+    def rollup(self, rows):
+        'Add counts of logs in (id, segment, time) rows to daily summaries'
+        counts = Counter((segment_id, log_time.date())
+                         for _, segment_id, log_time in rows)
+        field = self.count_field
+        for (segment_id, day), cnt in counts.items():
+            (SegmentDailySummary
+                .insert({SegmentDailySummary.segment: segment_id,
+                         SegmentDailySummary.day: day,
+                         field: cnt})
+                .on_conflict(conflict_target=[SegmentDailySummary.segment,
+                                              SegmentDailySummary.day],
+                             update={field: field + cnt})
+                .execute())
+
+    def update_health(self, rows):
+        'Deduct counts of logs in (id, segment, time) rows from segment health'
+        counts = Counter(segment_id for _, segment_id, _ in rows)
+        field = self.health_field
+        for segment_id, cnt in counts.items():
+            (SegmentHealth.update({field: field - cnt})
+                          .where(SegmentHealth.segment == segment_id)
+                          .execute())
+
+
+def get_retention_policies():
+    'Return retention policies for probe log tables from app configuration'
+    return [
+        RetentionPolicy(ReceivedProbeLog,
+                        ReceivedProbeLog.recv_time,
+                        ReceivedProbeLog.segment,
+                        SegmentDailySummary.received_count,
+                        SegmentHealth.received_count,
+                        app.config['RETENTION_RECEIVED_MAX_AGE'],
+                        app.config['RETENTION_RECEIVED_MAX_ROWS']),
+        RetentionPolicy(GeneratedProbeLog,
+                        GeneratedProbeLog.send_time,
+                        GeneratedProbeLog.monitored_segment,
+                        SegmentDailySummary.generated_count,
+                        SegmentHealth.generated_count,
+                        app.config['RETENTION_GENERATED_MAX_AGE'],
+                        app.config['RETENTION_GENERATED_MAX_ROWS']),
+    ]
+
+
+def prune_probe_logs(args):
+    '''
+    Prune probe logs exceeding configured retention limits
+
+    '''
+    setup_logging(args)
+
+    batch_size = args.batch_size or app.config['RETENTION_BATCH_SIZE']
+    for policy in get_retention_policies():
+        if not (policy.max_age or policy.max_rows):
+            app.logger.info('no retention limits configured for {table}'
+                            .format(table=policy.name))
+            continue
+        if args.dry_run:
+            print('{table}: {cnt} logs would be pruned'.format(
+                table=policy.name, cnt=policy.count_expired()))
+            continue
+        start = time.time()
+        deleted = policy.prune(batch_size,
+                               app.config['RETENTION_BATCH_PAUSE'],
+                               app.config['RETENTION_ROLLUP'])
+        msg = 'pruned {cnt} logs from {table} in {secs:.1f}s'
+        app.logger.info(msg.format(cnt=deleted, table=policy.name,
+                                   secs=time.time() - start))
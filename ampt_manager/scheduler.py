@@ -0,0 +1,188 @@
+'''
+AMPT manager probe dispatch scheduler.
+
+Long-running alternative to periodic `dispatch` invocations. Keeps the app,
+database models and generator connection pools loaded and dispatches probe
+requests for each monitored segment on its own interval.
+'''
+
+import heapq
+import random
+import itertools
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .dispatcher import (app, dispatch_segments, get_active_segments,
+                         get_dispatch_concurrency, close_generator_sessions)
+from .cmdlogging import setup_logging
+from .db.correlation import expire_pending_probes
+from .metrics import push_metrics
+
+
+class SegmentScheduler(object):
+    '''
+    Probe dispatch scheduler.
+
+    Maintains a schedule of due times for active monitored segments. Each
+    segment is first scheduled at a random offset within its interval and
+    then rescheduled one interval (plus or minus the configured jitter)
+    after each dispatch, so that probe requests are spread evenly over time
+    instead of bursting at the same moment. The set of active segments is
+    reloaded from the database periodically to pick up configuration
+    changes, and probes not matched by received probe logs within the
+    correlation window are marked lost at the same interval.
+
+    Dispatch runs are waited for by a bounded pool of threads, and a
+    segment still being dispatched when it comes due again (for instance
+    because its generator is slow to respond) is skipped until the next
+    interval.
+
+    '''
+    def __init__(self, concurrency):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+        self.runner = ThreadPoolExecutor(max_workers=max(1, concurrency))
+        self.segments = {}
+        # Schedule entries are (due time, segment ID, token) tuples; only
+        # entries with the current token of an active segment are valid
+        self.schedule = []
+        self.tokens = {}
+        self.token_counter = itertools.count()
+        self.in_flight = set()
+        self.in_flight_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.next_refresh = 0
+
+    def get_interval(self, segment):
+        'Return dispatch interval in seconds for monitored segment'
+        intervals = app.config['SCHEDULE_SEGMENT_INTERVALS']
+        return max(1, intervals.get(segment.name,
+                                    app.config['SCHEDULE_INTERVAL']))
+
+    def get_next_due(self, segment, now):
+        'Return next due time for monitored segment dispatched at `now`'
+        interval = self.get_interval(segment)
+        jitter = interval * app.config['SCHEDULE_JITTER']
+        return now + interval + random.uniform(-jitter, jitter)
+
+    def refresh_segments(self, now):
+        'Reload active monitored segments and schedule newly added ones'
+        segments = {s.id: s for s in get_active_segments()}
+        added = set(segments) - set(self.segments)
+        removed = set(self.segments) - set(segments)
+        for segment_id in added:
+            # Spread initial dispatches across the segment's interval. A new
+            # token invalidates any entry left from an earlier activation.
+            due = now + random.uniform(0, self.get_interval(segments[segment_id]))
+            self.tokens[segment_id] = next(self.token_counter)
+            heapq.heappush(self.schedule,
+                           (due, segment_id, self.tokens[segment_id]))
+        # Entries for removed segments are discarded when they come due
+        for segment_id in removed:
+            del self.tokens[segment_id]
+        self.segments = segments
+        if added or removed:
+            msg = ('scheduling probe requests for {cnt} active monitored '
+                   'segments ({added} added, {removed} removed)')
+            app.logger.info(msg.format(cnt=len(segments), added=len(added),
+                                       removed=len(removed)))
+        self.next_refresh = now + app.config['SCHEDULE_REFRESH_INTERVAL']
+
+    def pop_due_segments(self, now):
+        'Remove due segments from schedule, rescheduling them, and return them'
+        due_segments = []
+        while self.schedule and self.schedule[0][0] <= now:
+            _, segment_id, token = heapq.heappop(self.schedule)
+            segment = self.segments.get(segment_id)
+            if segment is None or self.tokens.get(segment_id) != token:
+                continue
+            due_segments.append(segment)
+            heapq.heappush(self.schedule,
+                           (self.get_next_due(segment, now), segment_id,
+                            token))
+        return due_segments
+
+    def dispatch(self, segments):
+        'Dispatch probe requests for segments and wait for them to complete'
+        try:
+            dispatch_segments(segments, self.executor)
+        finally:
+            with self.in_flight_lock:
+                self.in_flight.difference_update(s.id for s in segments)
+
+    def submit_dispatch(self, due_segments):
+        '''
+        Submit dispatch of due segments, skipping segments whose previous
+        dispatch has not completed yet
+
+        '''
+        with self.in_flight_lock:
+            busy = [s for s in due_segments if s.id in self.in_flight]
+            due_segments = [s for s in due_segments
+                            if s.id not in self.in_flight]
+            self.in_flight.update(s.id for s in due_segments)
+        if busy:
+            errmsg = ('skipping probe requests for {cnt} segments still being '
+                      'dispatched')
+            app.logger.warning(errmsg.format(cnt=len(busy)))
+        if due_segments:
+            msg = 'dispatching probe requests for {cnt} due segments'
+            app.logger.debug(msg.format(cnt=len(due_segments)))
+            # Wait for dispatch in a separate thread so that a slow
+            # generator does not hold up segments coming due meanwhile
+            self.runner.submit(self.dispatch, due_segments)
+
+    def run(self):
+        'Dispatch probe requests for due segments until stopped'
+        while not self.stopped.is_set():
+            now = time.time()
+            if now >= self.next_refresh:
+                try:
+                    self.refresh_segments(now)
+                    expire_pending_probes()
+                    push_metrics('schedule')
+                except Exception as e:
+                    errmsg = 'failed to reload monitored segments: {err}'
+                    app.logger.error(errmsg.format(err=e))
+                    self.next_refresh = (now
+                        + app.config['SCHEDULE_REFRESH_INTERVAL'])
+
+            due_segments = self.pop_due_segments(now)
+            if due_segments:
+                self.submit_dispatch(due_segments)
+
+            wakeup = self.next_refresh
+            if self.schedule:
+                wakeup = min(wakeup, self.schedule[0][0])
+            self.stopped.wait(max(0, wakeup - time.time()))
+
+        self.runner.shutdown(wait=True)
+        self.executor.shutdown(wait=True)
+        close_generator_sessions()
+        push_metrics('schedule')
+
+    def stop(self, signum=None, frame=None):
+        'Stop scheduler after any in-progress dispatches complete'
+        app.logger.info('stopping probe dispatch scheduler')
+        self.stopped.set()
+
+
+def run_scheduler(args):
+    '''
+    Run probe dispatch scheduler until interrupted
+
+    '''
+    setup_logging(args)
+
+    concurrency = get_dispatch_concurrency(args.concurrency)
+    msg = ('starting probe dispatch scheduler (interval: {interval}s, '
+           'jitter: {jitter:.0%}, concurrency: {concurrency})')
+    app.logger.info(msg.format(interval=app.config['SCHEDULE_INTERVAL'],
+                               jitter=app.config['SCHEDULE_JITTER'],
+                               concurrency=concurrency))
+
+    scheduler = SegmentScheduler(concurrency)
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+    scheduler.run()
@@ -12,12 +12,104 @@ DEBUG = False
 LOG_FORMATTER = logging.Formatter('%(asctime)s [%(levelname)s] %(module)s - %(message)s')
 DEFAULT_LOG_LEVEL = 'warning'
 PAGINATION_CNT_LOGS = 50
+# Lifetime (in seconds) of cached probe log counts on log lists. 0 disables.
+LOG_COUNT_CACHE_TTL = 60
+# PostgreSQL connection pool: connections per process (dispatch concurrency
+# is capped below it), idle recycle time and wait for a free connection (s)
+DATABASE_POOL_SIZE = 8
+DATABASE_POOL_STALE_TIMEOUT = 300
+DATABASE_POOL_TIMEOUT = 10
+# SQLite pragmas applied to each connection. Configured entries override these.
+DATABASE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -16000,
+    'mmap_size': 268435456,
+    'busy_timeout': 5000,
+    'temp_store': 'memory',
+}
 # Number of MonitoredSegment items to show on app index page. 0 means unlimited.
 SEGMENT_LIMIT_INDEX = 0
 # HMAC digest name
 # May be set to any supported digest name:
 # https://docs.python.org/3/library/hashlib.html#hashlib.new
 HMAC_DIGEST = 'sha256'
+# Lifetime (in seconds) of cached ingest monitor/segment lookups. 0 disables.
+LOOKUP_CACHE_TTL = 60
+# Dashboard cache lifetime and minimum age before refresh (in seconds; TTL 0
+# disables) and cache directory (default: `cache` beside the config file)
+DASHBOARD_CACHE_TTL = 30
+DASHBOARD_CACHE_MIN_AGE = 5
+DASHBOARD_CACHE_DIR = None
+# Prometheus metrics at /metrics (requires prometheus_client): metrics file
+# directory, unauthenticated access and Pushgateway (host:port) for commands
+METRICS_ENABLED = True
+METRICS_DIR = None
+METRICS_PUBLIC = False
+METRICS_PUSHGATEWAY = None
+# Maximum number of received probe logs returned by one log search request
+LOG_SEARCH_MAX_LIMIT = 10000
+# Allow API clients to authenticate with HTTP basic auth. Only use with TLS.
+API_BASIC_AUTH = False
+# Maximum number of probe log events accepted in one batch submission
+INGEST_BATCH_MAX = 10000
+# Validate form probe log submissions without WTForms (faster, same result)
+INGEST_FAST_VALIDATION = True
+# Write-behind ingestion: acknowledge probe logs once queued to local files
+# and store them in the background (see the configuration file template)
+WRITE_BEHIND = False
+WRITE_BEHIND_DIR = None
+WRITE_BEHIND_INTERVAL = 1.0
+WRITE_BEHIND_SYNC = True
+WRITE_BEHIND_MAX_ATTEMPTS = 5
+# Maximum number of probe requests dispatched concurrently. 1 means serially.
+DISPATCH_CONCURRENCY = 10
+# Probe generator connect and response timeouts (in seconds)
+DISPATCH_CONNECT_TIMEOUT = 5
+DISPATCH_READ_TIMEOUT = 10
+# Batch probe requests per generator, up to DISPATCH_BATCH_SIZE probes each
+DISPATCH_BATCH = True
+DISPATCH_BATCH_SIZE = 100
+# Probe generator HTTP connections: pool size per generator, keep-alive and
+# connection retries with backoff factor (in seconds)
+DISPATCH_POOL_SIZE = 10
+DISPATCH_KEEPALIVE = True
+DISPATCH_RETRIES = 2
+DISPATCH_RETRY_BACKOFF = 0.5
+# Dispatch scheduler (`schedule` command): interval (s), jitter (fraction of
+# interval), per-segment intervals by name and segment reload interval (s)
+SCHEDULE_INTERVAL = 60
+SCHEDULE_JITTER = 0.1
+SCHEDULE_SEGMENT_INTERVALS = {}
+SCHEDULE_REFRESH_INTERVAL = 60
+# Seconds from dispatch within which a probe must be received to not be lost
+CORRELATION_WINDOW = 300
+# Probe log retention (`prune` command): maximum age (days) and rows (0 means
+# unlimited), rows per transaction, pause between them (s), daily rollups
+RETENTION_RECEIVED_MAX_AGE = 0
+RETENTION_RECEIVED_MAX_ROWS = 0
+RETENTION_GENERATED_MAX_AGE = 0
+RETENTION_GENERATED_MAX_ROWS = 0
+RETENTION_BATCH_SIZE = 1000
+RETENTION_BATCH_PAUSE = 0.1
+RETENTION_ROLLUP = True
+# Gunicorn worker class, processes (0 means 2 per CPU plus 1), threads and
+# connections per async worker (see the configuration file template)
+SERVER_WORKER_CLASS = 'sync'
+SERVER_WORKERS = 0
+SERVER_THREADS = 1
+SERVER_WORKER_CONNECTIONS = 1000
+# Keep-alive timeout (in seconds) and maximum pending connections
+SERVER_KEEPALIVE = 5
+SERVER_BACKLOG = 2048
+# Worker restarts after requests (plus jitter; 0 never), silent worker and
+# graceful shutdown timeouts (in seconds)
+SERVER_MAX_REQUESTS = 0
+SERVER_MAX_REQUESTS_JITTER = 0
+SERVER_TIMEOUT = 30
+SERVER_GRACEFUL_TIMEOUT = 30
+# Load app and templates in the master process before starting workers
+SERVER_PRELOAD = True
 
 # Default name for configuration file
 default_config_name = 'ampt_manager.conf'
@@ -38,8 +130,12 @@ default_admin_pass_length = 10
 default_ssl_cert_name = 'ampt_manager.crt'
 default_ssl_key_name = 'ampt_manager.key'
 default_ssl_key_size = 2048
-# Maximum number of Gunicorn workers
-gunicorn_workers_max = 5
-# Counter database defaults
-default_counter_db_name = 'ampt_manager.ctr'
+# Supported Gunicorn worker classes, with the package each requires (if any)
+gunicorn_worker_classes = {
+    'sync': None,
+    'gthread': None,
+    'gevent': 'gevent',
+    'eventlet': 'eventlet',
+}
+# Replay counter initial value
 counter_db_init_val = 0
@@ -4,14 +4,54 @@ AMPT probe event segment health verification
 '''
 import logging
 import datetime
+from collections import namedtuple
+
+from peewee import fn, JOIN
 
 from .web import app
-from .db.models import MonitoredSegment, ReceivedProbeLog
+from .db.models import MonitoredSegment, ReceivedProbeLog, SegmentHealth
+from .metrics import SEGMENT_VERIFICATIONS, VERIFY_SECONDS
 
 
 from flask.logging import default_handler
 app.logger.removeHandler(default_handler)
 
+# Verification result for a single monitored segment: count of probe alert
+# events received within the verification window and the most recent alert
+# time among them (None if there were none)
+SegmentVerification = namedtuple('SegmentVerification',
+                                 ['segment_id', 'name', 'event_count',
+                                  'last_alert_time'])
+
+def get_segment_verifications(start_time, end_time):
+    '''
+    Return verification results for all active monitored segments
+
+    Events of all active segments are counted in one grouped query over the
+    fixed window between `start_time` and `end_time`. Probe logs are only
+    joined for segments whose health summary records an alert since
+    `start_time`; other segments cannot have events in the window and are
+    reported with a count of 0 without consulting the probe logs.
+
+    '''
+    query = (MonitoredSegment
+             .select(MonitoredSegment.id,
+                     MonitoredSegment.name,
+                     fn.COUNT(ReceivedProbeLog.id),
+                     fn.MAX(ReceivedProbeLog.alert_time))
+             .join(SegmentHealth, JOIN.LEFT_OUTER)
+             .switch(MonitoredSegment)
+             .join(ReceivedProbeLog, JOIN.LEFT_OUTER,
+                   on=((ReceivedProbeLog.segment == MonitoredSegment.id)
+                       & (SegmentHealth.last_alert_time >= start_time)
+                       & ReceivedProbeLog.alert_time.between(start_time,
+                                                             end_time)))
+             .where(MonitoredSegment.active == True)
+             .group_by(MonitoredSegment.id, MonitoredSegment.name)
+             .order_by(MonitoredSegment.name)
+             .tuples())
+    return [SegmentVerification(*row) for row in query]
+
 def verify_probe_events(args):
     '''
     Verify receipt of probe logs for monitored segments
@@ -39,57 +79,49 @@ def verify_probe_events(args):
         app.logger.addHandler(file_handler)
         app.logger.setLevel((args.loglevel or app.config.get('LOGLEVEL')).upper())
 
-    active_segments = (MonitoredSegment.select()
-                                       .where(MonitoredSegment.active == True)
-                                       .order_by(MonitoredSegment.name))
-    active_segments_count = active_segments.count()
+    # Check each segment for any probe alert events occuring between the
+    # specified period and now. Because we consult the alert time for the
+    # event (the timestamp from the sensor/device that observed the probe),
+    # factors such as time delays in event delivery may make it so that very
+    # recent alerts that are in the manager's DB but have an alert timestamp
+    # that is older than the requested period aren't returned by this query.
+    # AMPT admins should adjust (increase) requested periods accordingly.
+    end_time = datetime.datetime.utcnow()
+    start_time = end_time - datetime.timedelta(minutes=args.period)
+    with VERIFY_SECONDS.time():
+        verifications = get_segment_verifications(start_time, end_time)
+
     msg = 'active segments: {segments}'
     app.logger.debug(msg.format(segments=', '.join(['id={id}/{name}'
-                     .format(id=s.id, name=s.name) for s in active_segments])))
-    if not active_segments_count:
+                     .format(id=v.segment_id, name=v.name)
+                     for v in verifications])))
+    if not verifications:
         app.logger.warning('no active monitored segments are configured')
         return 1
     else:
         msg = ('verifying {count} monitored {s} for alerts '
                'over previous {period} {m}')
-        app.logger.info(msg.format(count=active_segments_count,
+        app.logger.info(msg.format(count=len(verifications),
                                    period=args.period,
-                                   s='segment' if active_segments_count == 1 else 'segments',
+                                   s='segment' if len(verifications) == 1 else 'segments',
                                    m='minute' if args.period == 1 else 'minutes'))
+    app.logger.debug('alert time period between {start} - {end}'
+                     .format(start=start_time, end=end_time))
 
-    # Check each segment for any probe alert events occuring between the
-    # specified period and now. Because we consult the alert time for the
-    # event (the timestamp from the sensor/device that observed the probe),
-    # factors such as time delays in event delivery may make it so that very
-    # recent alerts that are in the manager's DB but have an alert timestamp
-    # that is older than the requested period aren't returned by this query.
-    # AMPT admins should adjust (increase) requested periods accordingly.
-    #
-    # XXX: should attempt to refactor and collect all data in one query
-    # rather than querying for each segment individually.
-    #
-    for segment in active_segments:
-        start_time = (datetime.datetime.utcnow()
-                      - datetime.timedelta(minutes=args.period))
-        end_time = datetime.datetime.utcnow()
-        app.logger.debug('alert time period between {start} - {end}'
-                         .format(start=start_time, end=end_time))
-        app.logger.debug('verifying segment id={id}/{name}'
-                         .format(id=segment.id, name=segment.name))
-        recent_events = (segment.receivedprobelog_set
-                         .where(ReceivedProbeLog.alert_time
-                                .between(datetime.datetime.utcnow() - datetime.timedelta(minutes=args.period),
-                                         datetime.datetime.utcnow())))
-        if not recent_events:
+    for verification in verifications:
+        if not verification.event_count:
             msg = ('no probe logs received for {segment} segment '
                    'within previous {m} minute period')
-            app.logger.warning(msg.format(segment=segment.name,
+            app.logger.warning(msg.format(segment=verification.name,
                                           m=args.period))
+            SEGMENT_VERIFICATIONS.labels(result='failed').inc()
             retval = 1
         else:
+            SEGMENT_VERIFICATIONS.labels(result='ok').inc()
             msg = ('{count} probe logs received for {segment} segment within '
-                   'previous {period} minute period')
-            app.logger.info(msg.format(count=recent_events.count(),
-                                       segment=segment.name,
-                                       period=args.period))
+                   'previous {period} minute period (latest alert: {latest})')
+            app.logger.info(msg.format(count=verification.event_count,
+                                       segment=verification.name,
+                                       period=args.period,
+                                       latest=verification.last_alert_time))
     return retval
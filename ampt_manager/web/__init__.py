@@ -70,5 +70,23 @@ def load_user(userid):
     except User.DoesNotExist:
         return None
 
+@login_manager.request_loader
+def load_user_from_request(request):
+    'Authenticate API clients by HTTP basic authentication, if enabled'
+    if not app.config['API_BASIC_AUTH'] or not request.authorization:
+        return None
+    from ..db.models import User
+    try:
+        user = User.get(User.username==request.authorization.username)
+    except User.DoesNotExist:
+        return None
+    if user.active and user.check_password(request.authorization.password):
+        return user
+    return None
+
+
+# Record probe log request metrics and expose them at /metrics
+from ..metrics import init_app as init_metrics
+init_metrics(app)
 
 from . import views
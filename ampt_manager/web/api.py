@@ -0,0 +1,140 @@
+'''
+AMPT Manager received probe log search API
+
+Received probe logs may be queried as JSON with any combination of the
+following query string filters:
+
+    segment     Monitored Segment ID (may be repeated)
+    monitor     Event Monitor ID (may be repeated)
+    protocol    IP protocol (tcp, udp or unspecified)
+    src_addr    source IP address
+    dest_addr   destination IP address
+    start       earliest alert time (YYYY-MM-DDTHH:MM:SS, inclusive)
+    end         latest alert time (YYYY-MM-DDTHH:MM:SS, inclusive)
+    limit       maximum number of logs returned (at most LOG_SEARCH_MAX_LIMIT)
+    after       cursor token returned as `next` by a previous search
+
+Matching logs are returned newest alert first, streamed as they are read
+from the database:
+
+    {
+        "logs": [
+            {"id": 42, "monitor": 1, "segment": 3, "alert_time": ..., ...},
+            ...
+        ],
+        "count": 1000,
+        "next": "<cursor token, or null if there are no further logs>"
+    }
+
+'''
+import json
+import datetime
+
+from . import app
+from .pagination import encode_cursor, decode_cursor
+from .validators import json_serial
+from ..db.models import ReceivedProbeLog, LOG_PROBE_PROTOCOLS
+from ..exceptions import InvalidUsage
+
+
+# Format of alert time range filters
+SEARCH_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def _int_list(args, name):
+    try:
+        return [int(v) for v in args.getlist(name)]
+    except ValueError:
+        raise InvalidUsage('{name} must be an integer ID'.format(name=name))
+
+
+def _alert_time(args, name):
+    try:
+        return datetime.datetime.strptime(args[name], SEARCH_TIME_FORMAT)
+    except ValueError:
+        errmsg = '{name} must be a timestamp formatted as YYYY-MM-DDTHH:MM:SS'
+        raise InvalidUsage(errmsg.format(name=name))
+
+
+def build_search_query(args):
+    '''
+    Return received probe log query and result limit for search filters.
+
+    Raises InvalidUsage if any filter is invalid.
+
+    '''
+    query = ReceivedProbeLog.select()
+    segments = _int_list(args, 'segment')
+    if segments:
+        query = query.where(ReceivedProbeLog.segment.in_(segments))
+    monitors = _int_list(args, 'monitor')
+    if monitors:
+        query = query.where(ReceivedProbeLog.monitor.in_(monitors))
+    if 'protocol' in args:
+        if args['protocol'] not in dict(LOG_PROBE_PROTOCOLS):
+            raise InvalidUsage('protocol must be one of: {choices}'.format(
+                choices=', '.join(dict(LOG_PROBE_PROTOCOLS))))
+        query = query.where(ReceivedProbeLog.protocol == args['protocol'])
+    if 'src_addr' in args:
+        query = query.where(ReceivedProbeLog.src_addr == args['src_addr'])
+    if 'dest_addr' in args:
+        query = query.where(ReceivedProbeLog.dest_addr == args['dest_addr'])
+    if 'start' in args:
+        query = query.where(ReceivedProbeLog.alert_time
+                            >= _alert_time(args, 'start'))
+    if 'end' in args:
+        query = query.where(ReceivedProbeLog.alert_time
+                            <= _alert_time(args, 'end'))
+    if 'after' in args:
+        try:
+            alert_time, id = decode_cursor(args['after'])
+        except ValueError as e:
+            raise InvalidUsage(str(e))
+        query = query.where((ReceivedProbeLog.alert_time <= alert_time)
+                            & ((ReceivedProbeLog.alert_time < alert_time)
+                               | (ReceivedProbeLog.id < id)))
+
+    max_limit = app.config['LOG_SEARCH_MAX_LIMIT']
+    try:
+        limit = int(args.get('limit', max_limit))
+    except ValueError:
+        raise InvalidUsage('limit must be an integer')
+    if not 0 < limit <= max_limit:
+        raise InvalidUsage('limit must be between 1 and {max}'.format(
+            max=max_limit))
+
+    query = query.order_by(ReceivedProbeLog.alert_time.desc(),
+                           ReceivedProbeLog.id.desc())
+    return query, limit
+
+
+def search_received_logs(args):
+    '''
+    Search received probe logs, yielding the JSON response in chunks.
+
+    Filters are validated before the first chunk is yielded, so invalid
+    searches raise InvalidUsage from this call rather than mid-response.
+
+    '''
+    query, limit = build_search_query(args)
+    # Fetch one log past the limit to find whether there are further logs
+    rows = query.limit(limit + 1).dicts().iterator()
+
+    def generate():
+        yield '{"logs": ['
+        count = 0
+        last = None
+        for row in rows:
+            if count == limit:
+                break
+            yield (',' if count else '') + json.dumps(row, default=json_serial)
+            count += 1
+            last = row
+        else:
+            last = None
+        next_token = None
+        if last is not None:
+            next_token = encode_cursor(last['alert_time'], last['id'])
+        yield '], "count": {count}, "next": {next}}}'.format(
+            count=count, next=json.dumps(next_token))
+    return generate()
@@ -0,0 +1,275 @@
+'''
+AMPT Manager caches
+
+Event monitors and monitored segments are looked up on every probe log
+submission but change rarely, so they are cached in each server process.
+Views that create, modify or delete these objects invalidate the cache of
+the process handling the request. Other server processes pick up changes
+when their cached entries expire after LOOKUP_CACHE_TTL seconds.
+
+The dashboard is costly to compute and is viewed (and auto-refreshed) by
+many users, so its content is cached (as JSON) in files shared by all
+server processes. Cached content expires after DASHBOARD_CACHE_TTL seconds
+and is invalidated immediately when configuration objects change. Probe
+logs arrive continuously, so receiving or dispatching probes only
+invalidates content older than DASHBOARD_CACHE_MIN_AGE seconds.
+
+'''
+import os
+import json
+import time
+import fcntl
+import datetime
+import tempfile
+
+from . import app
+from ..db.models import EventMonitor, MonitoredSegment
+
+
+class TTLCache(object):
+    '''
+    Simple in-process cache with expiring entries.
+
+    :param ttl:
+        Lifetime of cache entries in seconds. Entries are not cached if
+        this is 0.
+
+    '''
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+
+    def get(self, key):
+        'Return cached value for key, or None if missing or expired'
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires < time.monotonic():
+            self._entries.pop(key, None)
+            return None
+        return value
+
+    def set(self, key, value):
+        'Cache value for key'
+        if self.ttl > 0:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+
+    def clear(self):
+        'Remove all cached entries'
+        self._entries.clear()
+
+
+class FileCache(object):
+    '''
+    Cache shared between processes, with entries stored as files.
+
+    Entries are invalidated by touching generation files: an entry is
+    stale if it was stored before the latest change to the `config`
+    generation, or before the latest change to the `logs` generation and
+    more than `min_age` seconds ago. Computation of a missing entry is
+    serialized with a file lock, so that concurrent requests for it in any
+    process wait for one computation rather than each computing it. If the
+    cache directory cannot be used, values are computed without caching.
+
+    Values are stored as JSON and must consist of dicts, lists, strings,
+    numbers, booleans, None and datetimes.
+
+    :param path:
+        Directory to store cache files in (created if missing). Entries are
+        not cached if this is None.
+    :param ttl:
+        Lifetime of cache entries in seconds. Entries are not cached if
+        this is 0.
+    :param min_age:
+        Minimum age in seconds of entries invalidated by the `logs`
+        generation.
+
+    '''
+    GENERATIONS = ('config', 'logs')
+
+    def __init__(self, path, ttl, min_age=0):
+        self.path = path
+        self.ttl = ttl
+        self.min_age = min_age
+        self._ready = False
+
+    @property
+    def enabled(self):
+        return bool(self.path and self.ttl > 0)
+
+    def _ensure_path(self):
+        if not self._ready:
+            os.makedirs(self.path, exist_ok=True)
+            for generation in self.GENERATIONS:
+                open(self._generation_file(generation), 'a').close()
+            self._ready = True
+
+    def _generation_file(self, generation):
+        return os.path.join(self.path, '{}.generation'.format(generation))
+
+    def _get_generation(self, generation):
+        return os.stat(self._generation_file(generation)).st_mtime
+
+    def _read(self, key):
+        try:
+            with open(os.path.join(self.path, key + '.cache'), 'rb') as f:
+                created, value = json.loads(f.read().decode('utf-8'),
+                                            object_hook=_decode_datetime)
+            config_generation = self._get_generation('config')
+            logs_generation = self._get_generation('logs')
+        except (OSError, ValueError, TypeError):
+            return None
+        now = time.time()
+        if (now - created > self.ttl
+                or created < config_generation
+                or (created < logs_generation
+                    and now - created > self.min_age)):
+            return None
+        return (value,)
+
+    def _write(self, key, value, created):
+        # Write to temporary file and rename it into place, so that readers
+        # never see a partially written entry
+        data = json.dumps([created, value], default=_encode_datetime)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data.encode('utf-8'))
+            os.replace(tmp_path, os.path.join(self.path, key + '.cache'))
+        except OSError:
+            os.remove(tmp_path)
+            raise
+
+    def _warn(self, err):
+        errmsg = 'not caching in {path}: {err}'
+        app.logger.warning(errmsg.format(path=self.path, err=err))
+
+    def get_or_set(self, key, func):
+        'Return cached value for key, computing it with `func` if missing'
+        if not self.enabled:
+            return func()
+        try:
+            self._ensure_path()
+            entry = self._read(key)
+            if entry is not None:
+                return entry[0]
+            lock = open(os.path.join(self.path, key + '.lock'), 'a')
+        except OSError as e:
+            self._warn(e)
+            return func()
+        with lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # Another request may have stored the entry while waiting
+                # for the lock
+                entry = self._read(key)
+                if entry is not None:
+                    return entry[0]
+                created = time.time()
+                value = func()
+                try:
+                    self._write(key, value, created)
+                except OSError as e:
+                    self._warn(e)
+                return value
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def invalidate(self, generation='config'):
+        'Invalidate entries stored before now according to generation'
+        if not self.enabled:
+            return
+        try:
+            self._ensure_path()
+            os.utime(self._generation_file(generation))
+        except OSError as e:
+            errmsg = 'failed to invalidate cache in {path}: {err}'
+            app.logger.warning(errmsg.format(path=self.path, err=e))
+
+
+def _encode_datetime(obj):
+    if isinstance(obj, datetime.datetime):
+        return {'__datetime__': obj.isoformat()}
+    raise TypeError('{type} is not JSON serializable'.format(
+        type=type(obj).__name__))
+
+
+def _decode_datetime(obj):
+    if '__datetime__' in obj:
+        value = obj['__datetime__']
+        fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S'
+        return datetime.datetime.strptime(value, fmt)
+    return obj
+
+
+def get_dashboard_cache_path():
+    '''
+    Return directory for dashboard cache files: DASHBOARD_CACHE_DIR if set,
+    otherwise a `cache` directory alongside the app configuration file
+
+    '''
+    if app.config.get('DASHBOARD_CACHE_DIR'):
+        return app.config['DASHBOARD_CACHE_DIR']
+    configfile = os.environ.get('AMPT_MANAGER_SETTINGS')
+    if configfile:
+        return os.path.join(os.path.dirname(os.path.abspath(configfile)),
+                            'cache')
+    return None
+
+
+_monitors = TTLCache(app.config['LOOKUP_CACHE_TTL'])
+_segments = TTLCache(app.config['LOOKUP_CACHE_TTL'])
+_dashboard = FileCache(get_dashboard_cache_path(),
+                       app.config['DASHBOARD_CACHE_TTL'],
+                       app.config['DASHBOARD_CACHE_MIN_AGE'])
+
+
+def get_event_monitor(monitor_id):
+    '''
+    Return Event Monitor with specified ID.
+
+    Raises EventMonitor.DoesNotExist if there is no such monitor.
+
+    '''
+    monitor = _monitors.get(monitor_id)
+    if monitor is None:
+        monitor = EventMonitor.get(EventMonitor.id == monitor_id)
+        _monitors.set(monitor_id, monitor)
+    return monitor
+
+
+def get_monitored_segment(dest_addr, dest_port):
+    '''
+    Return Monitored Segment matching probe destination address and port.
+
+    Raises MonitoredSegment.DoesNotExist if there is no such segment.
+
+    '''
+    key = (dest_addr, dest_port)
+    segment = _segments.get(key)
+    if segment is None:
+        segment = MonitoredSegment.get(MonitoredSegment.dest_addr == dest_addr,
+                                       MonitoredSegment.dest_port == dest_port)
+        _segments.set(key, segment)
+    return segment
+
+
+def invalidate_lookup_cache():
+    'Clear cached Event Monitors and Monitored Segments'
+    _monitors.clear()
+    _segments.clear()
+
+
+def get_dashboard_context(func):
+    'Return cached dashboard template context, computing it with `func`'
+    return _dashboard.get_or_set('dashboard', func)
+
+
+def invalidate_dashboard_cache(logs=False):
+    '''
+    Invalidate cached dashboard content after configuration changes, or
+    after probe logs were received or dispatched if `logs` is True
+
+    '''
+    _dashboard.invalidate('logs' if logs else 'config')
@@ -0,0 +1,396 @@
+'''
+AMPT Manager bulk probe log ingestion
+
+Event monitors may submit many probe logs at once (for instance when
+catching up after an outage) as a single signed JSON envelope:
+
+    {
+        "monitor": 1,
+        "ts": "1535678400.123456",
+        "events": [
+            {
+                "src_addr": "192.0.2.10",
+                "dest_addr": "198.51.100.1",
+                "src_port": 51234,
+                "dest_port": 80,
+                "protocol": "tcp",
+                "alert_time": "2018-08-31T01:20:00",
+                "hostname": "sensor01",
+                "plugin_name": "suricata"
+            },
+            ...
+        ],
+        "h": "<HMAC digest>"
+    }
+
+The HMAC digest is computed with the monitor's auth key over the unindented,
+key-sorted JSON serialization of the envelope without the `h` key. The
+timestamp counter is checked against the monitor's replay counter once for
+the whole envelope. Each event is then validated with the same rules as
+single probe log submissions, and accepted events are stored in a single
+transaction (or appended to the write-behind queue, if enabled).
+
+'''
+import hmac
+import json
+import datetime
+import ipaddress
+
+from peewee import chunked
+
+from . import app
+from .cache import (get_event_monitor, get_monitored_segment,
+                    invalidate_dashboard_cache)
+from .writebehind import WriteBehindQueue, get_write_behind_path
+from .validators import json_serial
+from ..db.models import (ampt_db, EventMonitor, MonitoredSegment,
+                         ReceivedProbeLog, ReplayCounter, SegmentHealth,
+                         LOG_PROBE_PROTOCOLS)
+from ..db.correlation import correlate_probe_logs
+from ..exceptions import InvalidUsage
+from ..metrics import (PROBE_LOGS, HMAC_FAILURES, COUNTER_REJECTIONS,
+                       DB_WRITE_SECONDS)
+
+
+# Format of alert timestamps in submitted probe logs
+ALERT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# Number of rows per INSERT statement, kept well within SQLite's limit on
+# bound parameters per statement
+INSERT_BATCH_ROWS = 50
+
+_protocols = set(dict(LOG_PROBE_PROTOCOLS))
+
+
+def _required(value):
+    if value is None or value == '':
+        raise ValueError('This field is required.')
+    return value
+
+
+def _string(value):
+    if not isinstance(_required(value), str):
+        raise ValueError('Not a valid string value.')
+    return value
+
+
+def _ipv4_address(value):
+    try:
+        address = ipaddress.ip_address(_string(value))
+    except ValueError:
+        raise ValueError('Invalid IP address.')
+    if not isinstance(address, ipaddress.IPv4Address):
+        raise ValueError('Invalid IP address.')
+    return value
+
+
+def _port(value):
+    if isinstance(_required(value), bool):
+        raise ValueError('Not a valid integer value.')
+    try:
+        port = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('Not a valid integer value.')
+    if isinstance(value, float) or not 0 <= port <= 65535:
+        raise ValueError('Number must be between 0 and 65535.')
+    return port
+
+
+def _protocol(value):
+    if _string(value) not in _protocols:
+        raise ValueError('Not a valid choice')
+    return value
+
+
+def _alert_time(value):
+    try:
+        return datetime.datetime.strptime(_string(value), ALERT_TIME_FORMAT)
+    except ValueError:
+        raise ValueError('Not a valid datetime value')
+
+
+# Probe log event fields and the functions converting and validating them
+EVENT_FIELDS = (
+    ('src_addr', _ipv4_address),
+    ('dest_addr', _ipv4_address),
+    ('src_port', _port),
+    ('dest_port', _port),
+    ('protocol', _protocol),
+    ('alert_time', _alert_time),
+    ('hostname', _string),
+    ('plugin_name', _string),
+)
+
+
+def validate_probe_event(event):
+    '''
+    Validate submitted probe log event.
+
+    Returns a tuple of the converted event fields and a dict of validation
+    errors keyed by field name (empty if the event is valid).
+
+    '''
+    data = {}
+    errors = {}
+    if not isinstance(event, dict):
+        return data, {'event': ['Not a valid probe log event.']}
+    for name, convert in EVENT_FIELDS:
+        try:
+            data[name] = convert(event.get(name))
+        except ValueError as e:
+            errors[name] = [str(e)]
+    return data, errors
+
+
+def _monitor_id(value):
+    try:
+        monitor_id = int(value)
+    except ValueError:
+        raise ValueError('Not a valid integer value')
+    if monitor_id < 1:
+        raise ValueError('Number must be at least 1.')
+    return monitor_id
+
+
+# Fields of form encoded (single) probe log submissions and the functions
+# converting and validating them, equivalent to ReceivedProbeLogForm
+FORM_FIELDS = (('monitor', _monitor_id),) + EVENT_FIELDS + (
+    ('h', _string),
+    ('ts', _string),
+)
+
+
+def validate_probe_log_form(formdata):
+    '''
+    Validate and verify form encoded probe log submission.
+
+    Lightweight equivalent of validating ReceivedProbeLogForm, for the
+    machine clients submitting probe logs: fields are converted by the
+    FORM_FIELDS functions, and the HMAC digest is computed over a message
+    built once from the converted fields. Accepts and rejects the same
+    submissions as the form, and likewise only advances the replay counter
+    for submissions that are otherwise valid.
+
+    Returns a tuple of the converted fields and a dict of validation errors
+    keyed by field name (empty if the submission is valid).
+
+    '''
+    data = {}
+    errors = {}
+    for name, convert in FORM_FIELDS:
+        values = formdata.getlist(name)
+        if not values or not values[0]:
+            errors[name] = ['This field is required.']
+            continue
+        try:
+            # Repeated alert times are joined, as by DateTimeField
+            data[name] = convert(' '.join(values) if name == 'alert_time'
+                                 else values[0])
+        except ValueError as e:
+            errors[name] = [str(e)]
+    if errors:
+        return data, errors
+
+    try:
+        monitor = get_event_monitor(data['monitor'])
+    except EventMonitor.DoesNotExist:
+        errors['monitor'] = ['Unknown event monitor.']
+        return data, errors
+    message = {k: v for k, v in data.items() if k != 'h'}
+    j = json.dumps(message, default=json_serial, sort_keys=True)
+    computed_digest = (hmac.new(bytes(monitor.auth_key.encode('utf-8')),
+                                j.encode('utf-8'), app.config['HMAC_DIGEST'])
+                           .hexdigest())
+    if not hmac.compare_digest(data['h'].encode('utf-8'),
+                               computed_digest.encode('utf-8')):
+        HMAC_FAILURES.inc()
+        errors['h'] = ['HMAC digest failed verification']
+        return data, errors
+
+    try:
+        advanced = ReplayCounter.advance(monitor.id, float(data['ts']))
+    except ValueError:
+        advanced = False
+    if not advanced:
+        COUNTER_REJECTIONS.inc()
+        errors['ts'] = ['Replay counter comparison failed verification']
+    return data, errors
+
+
+def verify_envelope(envelope, remote_addr):
+    '''
+    Verify structure, HMAC digest and replay counter of batch envelope.
+
+    Returns the submitting Event Monitor. Raises InvalidUsage if the
+    envelope fails verification.
+
+    '''
+    if not isinstance(envelope, dict):
+        raise InvalidUsage('probe log batch must be a JSON object')
+    missing = [k for k in ('monitor', 'ts', 'events', 'h')
+               if k not in envelope]
+    if missing:
+        errmsg = 'probe log batch missing required keys: {keys}'
+        raise InvalidUsage(errmsg.format(keys=', '.join(missing)))
+    if not isinstance(envelope['events'], list):
+        raise InvalidUsage('probe log batch events must be a list')
+    if len(envelope['events']) > app.config['INGEST_BATCH_MAX']:
+        errmsg = 'probe log batch exceeds maximum of {max} events'
+        raise InvalidUsage(errmsg.format(max=app.config['INGEST_BATCH_MAX']),
+                           status_code=413)
+
+    try:
+        monitor = get_event_monitor(int(envelope['monitor']))
+    except (TypeError, ValueError, EventMonitor.DoesNotExist):
+        logmsg = ('rejected probe log batch received from [{ip}] with '
+                  'unknown monitor ID {id}')
+        app.logger.warning(logmsg.format(ip=remote_addr,
+                                         id=envelope['monitor']))
+        errmsg = 'rejected probe log batch from unknown monitor ID {id}'
+        raise InvalidUsage(errmsg.format(id=envelope['monitor']))
+
+    message = {k: v for k, v in envelope.items() if k != 'h'}
+    j = json.dumps(message, sort_keys=True)
+    computed_digest = (hmac.new(bytes(monitor.auth_key.encode('utf-8')),
+                                j.encode('utf-8'), app.config['HMAC_DIGEST'])
+                           .hexdigest())
+    if not hmac.compare_digest(str(envelope['h']), computed_digest):
+        logmsg = ('rejected probe log batch from monitor ID {id} [{ip}]: '
+                  'HMAC digest failed verification')
+        app.logger.warning(logmsg.format(id=monitor.id, ip=remote_addr))
+        HMAC_FAILURES.inc()
+        raise InvalidUsage('HMAC digest failed verification')
+
+    try:
+        advanced = ReplayCounter.advance(monitor.id, float(envelope['ts']))
+    except (TypeError, ValueError):
+        advanced = False
+    if not advanced:
+        logmsg = ('rejected probe log batch from monitor ID {id} [{ip}]: '
+                  'replay counter comparison failed verification')
+        app.logger.warning(logmsg.format(id=monitor.id, ip=remote_addr))
+        COUNTER_REJECTIONS.inc()
+        raise InvalidUsage('Replay counter comparison failed verification')
+    return monitor
+
+
+def store_probe_logs(rows):
+    '''
+    Store validated probe logs.
+
+    All rows are inserted in one transaction using multi-row INSERT
+    statements, the health summary of each segment the logs matched is
+    updated once for the whole batch, and the logs are correlated with the
+    probes that caused them.
+
+    '''
+    health = {}
+    for row in rows:
+        cnt, last_recv_time, last_alert_time = health.get(
+            row['segment'], (0, row['recv_time'], row['alert_time']))
+        health[row['segment']] = (cnt + 1,
+                                  max(last_recv_time, row['recv_time']),
+                                  max(last_alert_time, row['alert_time']))
+    with DB_WRITE_SECONDS.labels(operation='batch').time(), ampt_db.atomic():
+        for batch in chunked(rows, INSERT_BATCH_ROWS):
+            ReceivedProbeLog.insert_many(batch).execute()
+        for segment_id, (cnt, last_recv_time, last_alert_time) in \
+                sorted(health.items()):
+            SegmentHealth.record(segment_id, received_count=cnt,
+                                 last_recv_time=last_recv_time,
+                                 last_alert_time=last_alert_time)
+        correlate_probe_logs((row['segment'], row['src_port'], row['recv_time'])
+                             for row in rows)
+
+
+def flush_probe_logs(rows):
+    '''
+    Store probe logs flushed from the write-behind queue. The database
+    connection is closed (returned to the pool for PostgreSQL) after each
+    flush, so that the flusher thread does not hold it between flushes.
+
+    '''
+    with ampt_db.connection_context():
+        store_probe_logs(rows)
+    invalidate_dashboard_cache(logs=True)
+
+
+_write_behind = None
+if app.config['WRITE_BEHIND']:
+    _write_behind = WriteBehindQueue(
+        get_write_behind_path(), flush_probe_logs,
+        interval=app.config['WRITE_BEHIND_INTERVAL'],
+        sync=app.config['WRITE_BEHIND_SYNC'],
+        max_attempts=app.config['WRITE_BEHIND_MAX_ATTEMPTS'])
+
+
+def queue_probe_logs(rows):
+    '''
+    Store validated probe logs, or append them to the write-behind queue if
+    WRITE_BEHIND is enabled.
+
+    Returns True if the logs were queued rather than stored.
+
+    '''
+    if _write_behind is None:
+        store_probe_logs(rows)
+        invalidate_dashboard_cache(logs=True)
+        return False
+    _write_behind.put(rows)
+    return True
+
+
+def recover_queued_probe_logs():
+    '''
+    Store probe logs left in the write-behind queue by server processes
+    that exited without storing them
+
+    '''
+    if _write_behind is not None:
+        _write_behind.recover()
+
+
+def ingest_probe_log_batch(envelope, remote_addr):
+    '''
+    Verify, validate and store batch of probe logs from event monitor.
+
+    Returns response data including the accept/reject status of each event
+    in submission order.
+
+    '''
+    monitor = verify_envelope(envelope, remote_addr)
+
+    recv_time = datetime.datetime.utcnow()
+    rows = []
+    results = []
+    for event in envelope['events']:
+        data, errors = validate_probe_event(event)
+        if not errors:
+            try:
+                segment = get_monitored_segment(data['dest_addr'],
+                                                data['dest_port'])
+            except MonitoredSegment.DoesNotExist:
+                errmsg = ('unknown monitored segment destination '
+                          '{dest_addr}:{dest_port}')
+                errors['segment'] = [errmsg.format(**data)]
+        if errors:
+            results.append({'status': 'rejected', 'errors': errors})
+            continue
+        data.update(monitor=monitor.id, segment=segment.id,
+                    recv_time=recv_time)
+        rows.append(data)
+        results.append({'status': 'accepted'})
+
+    if rows:
+        queue_probe_logs(rows)
+    PROBE_LOGS.labels(result='accepted').inc(len(rows))
+    PROBE_LOGS.labels(result='rejected').inc(len(results) - len(rows))
+    logmsg = ('probe log batch from monitor ID {id} [{ip}]: accepted {cnt} '
+              'of {total} events')
+    app.logger.info(logmsg.format(id=monitor.id, ip=remote_addr,
+                                  cnt=len(rows),
+                                  total=len(envelope['events'])))
+    return {
+        'message': 'accepted {cnt} of {total} event logs'.format(
+            cnt=len(rows), total=len(envelope['events'])),
+        'results': results,
+    }
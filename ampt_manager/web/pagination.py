@@ -0,0 +1,132 @@
+'''
+AMPT Manager keyset pagination for probe log listings
+
+Probe log lists are ordered newest first by timestamp and ID. Rather than
+skipping over preceding rows with OFFSET (which costs time proportional to
+the page number), each page is selected relative to the timestamp and ID of
+the last (or first) log of the adjacent page, passed between requests as an
+opaque cursor token, so that any page costs the same as the first page.
+
+'''
+import base64
+import binascii
+import datetime
+
+from . import app
+from .cache import TTLCache
+
+
+# Formats of timestamps encoded in cursor tokens
+CURSOR_TIME_FORMATS = ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S')
+
+_counts = TTLCache(app.config['LOG_COUNT_CACHE_TTL'])
+
+
+def encode_cursor(time, id):
+    'Return cursor token for log with timestamp `time` and ID `id`'
+    cursor = '{time}|{id}'.format(time=time.isoformat(' '), id=id)
+    return (base64.urlsafe_b64encode(cursor.encode('utf-8'))
+                  .decode('ascii').rstrip('='))
+
+
+def decode_cursor(token):
+    '''
+    Return tuple of timestamp and ID encoded in cursor token.
+
+    Raises ValueError if the token is not a valid cursor.
+
+    '''
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        cursor = base64.urlsafe_b64decode(padded.encode('ascii'))
+        time, id = cursor.decode('utf-8').split('|')
+        id = int(id)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError('invalid cursor token')
+    for fmt in CURSOR_TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(time, fmt), id
+        except ValueError:
+            pass
+    raise ValueError('invalid cursor token')
+
+
+def get_cached_count(model):
+    '''
+    Return total number of rows of model, counted at most once per
+    LOG_COUNT_CACHE_TTL seconds in each server process.
+
+    '''
+    key = model._meta.table_name
+    total = _counts.get(key)
+    if total is None:
+        total = model.select().count()
+        _counts.set(key, total)
+    return total
+
+
+class KeysetPagination(object):
+    '''
+    Page of probe logs selected by cursor.
+
+    :param query:
+        Probe log query to paginate.
+    :param time_field:
+        Timestamp field logs are ordered by (newest first). Ties are broken
+        by descending ID.
+    :param per_page:
+        Number of logs per page.
+    :param before:
+        Cursor token of the first log of the following (older) page; the
+        page of logs newer than it is selected.
+    :param after:
+        Cursor token of the last log of the preceding (newer) page; the
+        page of logs older than it is selected. Without either cursor the
+        first (newest) page is selected.
+
+    Raises ValueError if a cursor token is invalid.
+
+    '''
+    def __init__(self, query, time_field, per_page, before=None, after=None):
+        self.time_field = time_field
+        self.id_field = time_field.model.id
+        self.per_page = per_page
+
+        if before:
+            time, id = decode_cursor(before)
+            rows = list(query
+                        .where((time_field >= time)
+                               & ((time_field > time) | (self.id_field > id)))
+                        .order_by(time_field.asc(), self.id_field.asc())
+                        .limit(per_page + 1))
+            self.has_prev = len(rows) > per_page
+            self.has_next = True
+            self.objects = list(reversed(rows[:per_page]))
+        else:
+            if after:
+                time, id = decode_cursor(after)
+                query = query.where(
+                    (time_field <= time)
+                    & ((time_field < time) | (self.id_field < id)))
+            rows = list(query
+                        .order_by(time_field.desc(), self.id_field.desc())
+                        .limit(per_page + 1))
+            self.has_prev = bool(after)
+            self.has_next = len(rows) > per_page
+            self.objects = rows[:per_page]
+
+    def get_cursor(self, obj):
+        'Return cursor token for log'
+        return encode_cursor(getattr(obj, self.time_field.name), obj.id)
+
+    @property
+    def prev_token(self):
+        'Cursor token selecting the preceding (newer) page, if any'
+        if self.has_prev and self.objects:
+            return self.get_cursor(self.objects[0])
+
+    @property
+    def next_token(self):
+        'Cursor token selecting the following (older) page, if any'
+        if self.has_next and self.objects:
+            return self.get_cursor(self.objects[-1])
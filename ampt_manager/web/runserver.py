@@ -10,6 +10,7 @@ import os
 import ssl
 import sys
 import logging
+import importlib.util
 import multiprocessing
 
 import gunicorn.app.base
@@ -19,9 +20,12 @@ from flask import __version__ as flask_version
 from . import app
 from .. import settings
 from .. import get_version
+from ..metrics import clear_metrics, mark_process_dead
+from .ingest import recover_queued_probe_logs
+from ..db.models import ampt_db
+from ..db.connection import is_sqlite, close_database
 
 
-MAX_WORKERS = settings.gunicorn_workers_max
 CPU_WORKERS = multiprocessing.cpu_count() * 2 + 1
 
 class StandaloneApplication(gunicorn.app.base.BaseApplication):
@@ -44,9 +48,100 @@ class StandaloneApplication(gunicorn.app.base.BaseApplication):
             self.cfg.set(key.lower(), value)
 
     def load(self):
+        # Loaded once in the master process if the app is preloaded, so that
+        # workers share the compiled templates
+        load_templates()
         return self.application
 
 
+def load_templates():
+    'Compile all app templates into the template cache'
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+
+def worker_forked(server, worker):
+    '''
+    Gunicorn hook closing any database connection inherited from the master
+    process, so that new worker processes open their own connections
+
+    '''
+    close_database(ampt_db)
+
+
+def worker_exited(server, worker):
+    'Gunicorn hook discarding live metrics of exited worker processes'
+    mark_process_dead(worker.pid)
+
+
+def async_worker_initialized(worker):
+    '''
+    Gunicorn hook making PostgreSQL queries of gevent workers cooperative,
+    so that a query waiting on the database does not block the worker's
+    other connections
+
+    '''
+    if worker.cfg.worker_class_str != 'gevent' or is_sqlite(ampt_db):
+        return
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        app.logger.warning('psycogreen package is not installed; database '
+                           'queries will block gevent worker connections')
+        return
+    patch_psycopg()
+
+
+def _get_option(args, name, setting):
+    'Return command line argument, or app configuration setting if not set'
+    value = getattr(args, name)
+    return app.config[setting] if value is None else value
+
+
+def get_worker_options(args):
+    '''
+    Return Gunicorn worker options from command line arguments, falling back
+    to the app configuration
+
+    '''
+    worker_class = _get_option(args, 'worker_class', 'SERVER_WORKER_CLASS')
+    if worker_class not in settings.gunicorn_worker_classes:
+        sys.exit('error: unsupported server worker class {cls} (choose from '
+                 '{choices})'.format(cls=worker_class, choices=', '.join(
+                     sorted(settings.gunicorn_worker_classes))))
+    requirement = settings.gunicorn_worker_classes[worker_class]
+    if requirement and importlib.util.find_spec(requirement) is None:
+        sys.exit('error: {cls} server workers require the {pkg} package'
+                 .format(cls=worker_class, pkg=requirement))
+
+    options = {
+        'workers': (_get_option(args, 'workers', 'SERVER_WORKERS')
+                    or CPU_WORKERS),
+        'worker_class': worker_class,
+        'threads': _get_option(args, 'threads', 'SERVER_THREADS'),
+        'worker_connections': _get_option(args, 'worker_connections',
+                                          'SERVER_WORKER_CONNECTIONS'),
+        'keepalive': _get_option(args, 'keepalive', 'SERVER_KEEPALIVE'),
+        'backlog': _get_option(args, 'backlog', 'SERVER_BACKLOG'),
+        'max_requests': _get_option(args, 'max_requests',
+                                    'SERVER_MAX_REQUESTS'),
+        'max_requests_jitter': _get_option(args, 'max_requests_jitter',
+                                           'SERVER_MAX_REQUESTS_JITTER'),
+        'timeout': _get_option(args, 'timeout', 'SERVER_TIMEOUT'),
+        'graceful_timeout': _get_option(args, 'graceful_timeout',
+                                        'SERVER_GRACEFUL_TIMEOUT'),
+        'preload_app': _get_option(args, 'preload', 'SERVER_PRELOAD'),
+        'post_fork': worker_forked,
+    }
+    for name in ('workers', 'threads', 'worker_connections', 'backlog'):
+        if options[name] < 1:
+            sys.exit('error: server {name} must be at least 1'.format(
+                name=name.replace('_', ' ')))
+    if worker_class in ('gevent', 'eventlet'):
+        options['post_worker_init'] = async_worker_initialized
+    return options
+
+
 def run_server(args):
     'Load app in a standalone Gunicorn container'
 
@@ -76,12 +171,11 @@ def run_server(args):
     # The server's access logs are always written to the app instance's
     # access logs and not sent to stdout. Error/etc. logs are always sent
     # to stdout.
-    # Workers option: allow the number of workers to scale based on available
-    # CPU count, but no more than a conservative MAX_WORKERS
+    # Worker options: unless configured, the number of workers scales with
+    # the available CPU count
     options = {
         'bind': '%s:%s' % (args.listen_address or app.config['LISTEN_ADDRESS'],
                            args.listen_port or app.config['LISTEN_PORT']),
-        'workers': CPU_WORKERS if CPU_WORKERS < MAX_WORKERS else MAX_WORKERS,
         'proc_name': 'ampt-manager',
         'certfile': app.config['SERVER_CERTIFICATE'],
         'keyfile': app.config['SERVER_PRIVATE_KEY'],
@@ -89,7 +183,17 @@ def run_server(args):
         'accesslog': app.config.get('ACCESS_LOGFILE') or '-',
         'errorlog': '-',
         'loglevel': args.loglevel or app.config['LOGLEVEL'],
+        'child_exit': worker_exited,
     }
+    options.update(get_worker_options(args))
+
+    # Metrics of earlier server runs would otherwise be summed with the
+    # metrics of the new worker processes
+    clear_metrics()
+    # Store probe logs left in the write-behind queue by an earlier server
+    # run, without sharing the database connection with worker processes
+    recover_queued_probe_logs()
+    close_database(ampt_db)
 
     sa = StandaloneApplication(app, options)
 
@@ -101,5 +205,8 @@ def run_server(args):
     app.logger.info('starting %s', get_version())
     app.logger.debug(ver_dep_msg, py_version, flask_version)
     app.logger.info(crypto_msg, ssl_version, ssl.OPENSSL_VERSION)
+    app.logger.info('serving with %d %s workers (%d threads, %d connections '
+                    'each)', sa.cfg.workers, sa.cfg.worker_class_str,
+                    sa.cfg.threads, sa.cfg.worker_connections)
 
     sa.run()
@@ -5,16 +5,14 @@ AMPT Manager form custom validators
 import copy
 import hmac
 import json
-import os
-import os.path
 from datetime import date, datetime
-from shutil import chown
 
 from wtforms.validators import ValidationError
 
 from . import app
-from .. import settings
-from ..db.models import EventMonitor
+from .cache import get_event_monitor
+from ..db.models import ReplayCounter
+from ..metrics import HMAC_FAILURES, COUNTER_REJECTIONS
 
 
 class VerifiedHMAC():
@@ -49,7 +47,7 @@ class VerifiedHMAC():
         monitor_id = int(form['monitor'].data)
         hmac_hash = app.config['HMAC_DIGEST']
 
-        monitor_auth_key = EventMonitor.get(EventMonitor.id == monitor_id).auth_key
+        monitor_auth_key = get_event_monitor(monitor_id).auth_key
 
         if self.message is None:
             self.message = 'HMAC digest failed verification'
@@ -71,6 +69,7 @@ class VerifiedHMAC():
 
         # Fail out if HMAC comparison unsuccessful
         if not hmac.compare_digest(req_digest, computed_digest):
+            HMAC_FAILURES.inc()
             raise ValidationError(self.message)
         app.logger.debug('received event log HMAC verified successfully')
 
@@ -82,10 +81,17 @@ class VerifiedCounter():
 
     Request messages contain the core packet dispatch parameters as well as
     a per-request counter in the form of a timestamp, included to allow for
-    a basic level of replay protection. After a request is validated, the
-    counter (a decimal timestamp value) is stored in the counter
-    database. Future requests ensure that the counter in the validated
-    message is greater than the stored counter from the previous message.
+    a basic level of replay protection. When a request is validated, the
+    counter (a decimal timestamp value) must be greater than the counter
+    stored in the database from the previous message of the same event
+    monitor, and it replaces the stored counter in the same atomic
+    operation. Counters are kept per event monitor so that monitors with
+    slightly skewed clocks do not reject each other's messages.
+
+    The counter is only checked and advanced for messages whose other fields
+    (including the HMAC digest) validated successfully, so that rejected
+    messages cannot consume counter values. This relies on the counter being
+    the last field on the form.
 
     :param message:
         Error message to raise in case of a validation error. If not provided,
@@ -104,29 +110,17 @@ class VerifiedCounter():
         if self.message is None:
             self.message = 'Replay counter comparison failed verification'
 
+        if any(f.errors for f in form if f is not field):
+            return
+
         # Compare stored counter to request counter. The counter is valid if it is
         # greater than the previously stored one.
-        with open(app.config['COUNTER_PATH'], 'r') as f:
-            if not float(req_ts) > float(f.read()):
-                raise ValidationError(self.message)
-            app.logger.debug('received event log replay counter verified '
-                             'successfully')
-
-
-def persist_counter(db_path, ctr=settings.counter_db_init_val):
-    '''Store value into counter file.
-
-    :param ctr:
-        Counter value to write to file. This value should increase with every
-        request, so a numeric timestamp is used. May be omitted to write an
-        initialization value to the file (typically 0).
-
-    '''
-    with open(db_path, 'w') as f:
-        f.write(str(ctr))
-        if ctr == settings.counter_db_init_val:
-            app.logger.debug('initialized counter database with base '
-                             'value of %d', settings.counter_db_init_val)
+        monitor_id = int(form['monitor'].data)
+        if not ReplayCounter.advance(monitor_id, float(req_ts)):
+            COUNTER_REJECTIONS.inc()
+            raise ValidationError(self.message)
+        app.logger.debug('received event log replay counter verified '
+                         'successfully')
 
 
 def json_serial(obj):
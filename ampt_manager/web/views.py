@@ -5,9 +5,10 @@ AMPT Manager application views
 import datetime
 
 from peewee import fn, JOIN, IntegrityError
-from playhouse.flask_utils import get_object_or_404, object_list
+from playhouse.flask_utils import get_object_or_404
+from playhouse.shortcuts import model_to_dict
 from flask import render_template, request, url_for, redirect, flash
-from flask import abort, jsonify
+from flask import abort, jsonify, Response, stream_with_context
 from flask.views import View
 from flask_login import login_required, login_user, logout_user
 from flask_login import current_user
@@ -19,9 +20,20 @@ from .forms import *
 from .. import settings
 from ..db.database import get_generator_choices
 from ..db.models import *
+from ..db.models import ampt_db
+from ..db.correlation import correlate_probe_logs
 from .crypt import bcrypt
-from .validators import persist_counter
+from .cache import (get_event_monitor, get_monitored_segment,
+                    invalidate_lookup_cache, get_dashboard_context,
+                    invalidate_dashboard_cache)
+from .ingest import (ingest_probe_log_batch, queue_probe_logs,
+                     validate_probe_log_form, EVENT_FIELDS)
+from .api import search_received_logs
+from ..export import (EXPORT_LOG_TYPES, EXPORT_FORMATS, parse_export_time,
+                      export_probe_log_chunks)
+from .pagination import KeysetPagination, get_cached_count
 from ..exceptions import InvalidUsage
+from ..metrics import PROBE_LOGS, DB_WRITE_SECONDS
 
 
 class GeneratorView(FlaskView):
@@ -45,6 +57,7 @@ class GeneratorView(FlaskView):
             generator.created_by = generator.last_modified_by = current_user.id
             try:
                 generator.save()
+                invalidate_dashboard_cache()
                 msg = 'Added probe generator "{name}"'
                 flash(msg.format(name=generator.name), 'success')
                 logmsg = 'ProbeGenerator {generator} (ID: {generator_id}) added by user {user}'
@@ -71,6 +84,7 @@ class GeneratorView(FlaskView):
             generator.modified_date = datetime.datetime.utcnow()
             generator.last_modified_by = current_user.id
             generator.save()
+            invalidate_dashboard_cache()
             msg = 'Updated probe generator "{name}"'
             flash(msg.format(name=generator.name), 'success')
             logmsg = 'ProbeGenerator {generator} (ID: {generator_id}) modified by user {user}'
@@ -90,6 +104,7 @@ class GeneratorView(FlaskView):
         form = AMPTObjectDeleteForm()
         if form.validate_on_submit():
             generator.delete_instance()
+            invalidate_dashboard_cache()
             msg = 'Deleted probe generator "{name}"'
             flash(msg.format(name=generator.name), 'success')
             logmsg = 'ProbeGenerator {generator} (ID: {generator_id}) deleted by user {user}'
@@ -138,6 +153,8 @@ class SegmentView(FlaskView):
             segment.created_by = segment.last_modified_by = current_user.id
             try:
                 segment.save()
+                invalidate_lookup_cache()
+                invalidate_dashboard_cache()
                 msg = 'Added segment "{segment}"'
                 flash(msg.format(segment=segment.name), 'success')
                 logmsg = 'MonitoredSegment {segment} (ID: {segment_id}) added by user {user}'
@@ -176,6 +193,8 @@ class SegmentView(FlaskView):
             segment.modified_date = datetime.datetime.utcnow()
             segment.last_modified_by = current_user.id
             segment.save()
+            invalidate_lookup_cache()
+            invalidate_dashboard_cache()
             msg = 'Updated monitored segment "{name}"'
             flash(msg.format(name=segment.name), 'success')
             logmsg = 'MonitoredSegment {segment} (ID: {segment_id}) modified by user {user}'
@@ -192,7 +211,17 @@ class SegmentView(FlaskView):
         segment = get_object_or_404(MonitoredSegment, MonitoredSegment.id==id)
         form = AMPTObjectDeleteForm()
         if form.validate_on_submit():
-            segment.delete_instance()
+            # Summaries referencing the segment are deleted first, since
+            # the database may enforce their foreign keys
+            with ampt_db.atomic():
+                SegmentHealth.delete_by_id(segment.id)
+                (SegmentDailySummary
+                 .delete()
+                 .where(SegmentDailySummary.segment == segment.id)
+                 .execute())
+                segment.delete_instance()
+            invalidate_lookup_cache()
+            invalidate_dashboard_cache()
             msg = 'Deleted monitored segment "{name}"'
             flash(msg.format(name=segment.name), 'success')
             logmsg = 'MonitoredSegment {segment} (ID: {segment_id}) deleted by user {user}'
@@ -228,6 +257,8 @@ class MonitorView(FlaskView):
             monitor.created_by = monitor.last_modified_by = current_user.id
             try:
                 monitor.save()
+                invalidate_lookup_cache()
+                invalidate_dashboard_cache()
                 msg = 'Added event monitor "{monitor}" ({type})'
                 flash(msg.format(monitor=monitor.hostname, type=monitor.type), 'success')
                 logmsg = 'EventMonitor {monitor} (ID: {monitor_id}) added by user {user}'
@@ -253,6 +284,8 @@ class MonitorView(FlaskView):
             monitor.modified_date = datetime.datetime.utcnow()
             monitor.last_modified_by = current_user.id
             monitor.save()
+            invalidate_lookup_cache()
+            invalidate_dashboard_cache()
             msg = 'Updated event monitor "{name}"'
             flash(msg.format(name=monitor.hostname), 'success')
             logmsg = 'EventMonitor {monitor} (ID: {monitor_id}) modified by user {user}'
@@ -270,6 +303,9 @@ class MonitorView(FlaskView):
         form = AMPTObjectDeleteForm()
         if form.validate_on_submit():
             monitor.delete_instance()
+            ReplayCounter.delete_by_id(monitor.id)
+            invalidate_lookup_cache()
+            invalidate_dashboard_cache()
             msg = 'Deleted event monitor "{name}"'
             flash(msg.format(name=monitor.hostname), 'success')
             logmsg = 'EventMonitor {monitor} (ID: {monitor_id}) deleted by user {user}'
@@ -287,20 +323,18 @@ class GeneratedLogView(FlaskView):
     decorators = [login_required]
 
     def index(self):
-        objects = GeneratedProbeLog.select().order_by(
-                  GeneratedProbeLog.send_time.desc())
-        total_objects = objects.count()
-        # flask_utils' object_list raises 404 if the queryset has 0 records,
-        # so short circuit pagination
-        if not total_objects:
-            return render_template('generatedprobelog_list.html',
-                                   objects=objects,
-                                   total_objects=total_objects)
-        return object_list('generatedprobelog_list.html',
-                           query=objects,
-                           context_variable='objects',
-                           paginate_by=settings.PAGINATION_CNT_LOGS,
-                           total_objects=total_objects)
+        try:
+            pagination = KeysetPagination(GeneratedProbeLog.select(),
+                                          GeneratedProbeLog.send_time,
+                                          settings.PAGINATION_CNT_LOGS,
+                                          before=request.args.get('before'),
+                                          after=request.args.get('after'))
+        except ValueError:
+            abort(400)
+        return render_template('generatedprobelog_list.html',
+                               objects=pagination.objects,
+                               pagination=pagination,
+                               total_objects=get_cached_count(GeneratedProbeLog))
 
 
 class ReceivedLogView(FlaskView):
@@ -308,20 +342,18 @@ class ReceivedLogView(FlaskView):
 
     @login_required
     def index(self):
-        objects = ReceivedProbeLog.select().order_by(
-                  ReceivedProbeLog.recv_time.desc())
-        total_objects = objects.count()
-        # flask_utils' object_list raises 404 if the queryset has 0 records,
-        # so short circuit pagination
-        if not total_objects:
-            return render_template('receivedprobelog_list.html',
-                                   objects=objects,
-                                   total_objects=total_objects)
-        return object_list('receivedprobelog_list.html',
-                           query=objects,
-                           context_variable='objects',
-                           paginate_by=settings.PAGINATION_CNT_LOGS,
-                           total_objects=total_objects)
+        try:
+            pagination = KeysetPagination(ReceivedProbeLog.select(),
+                                          ReceivedProbeLog.recv_time,
+                                          settings.PAGINATION_CNT_LOGS,
+                                          before=request.args.get('before'),
+                                          after=request.args.get('after'))
+        except ValueError:
+            abort(400)
+        return render_template('receivedprobelog_list.html',
+                               objects=pagination.objects,
+                               pagination=pagination,
+                               total_objects=get_cached_count(ReceivedProbeLog))
 
     def post(self):
         '''
@@ -336,58 +368,82 @@ class ReceivedLogView(FlaskView):
 
         '''
         app.logger.debug('new inbound probe log submission request')
-        form = ReceivedProbeLogForm()
-        if form.validate_on_submit():
-            # Submitted data passed validation, update counter file
-            persist_counter(app.config['COUNTER_PATH'], ctr=form.ts.data)
-
+        if (app.config['INGEST_FAST_VALIDATION'] and request.form
+                and not request.files):
+            data, errors = validate_probe_log_form(request.form)
+        else:
+            form = ReceivedProbeLogForm()
+            form.validate_on_submit()
+            data, errors = form.data, form.errors
+        if not errors:
             # Match the monitor ID to a configured Event Monitor instance
             try:
-                matched_monitor = EventMonitor.get(
-                    EventMonitor.id == int(form.monitor.data))
+                matched_monitor = get_event_monitor(data['monitor'])
             except EventMonitor.DoesNotExist:
                 logmsg = ('rejected probe log received from {host} [{ip}] '
                           'with unknown monitor ID {id}')
-                app.logger.warning(logmsg.format(host=form.hostname.data,
+                app.logger.warning(logmsg.format(host=data['hostname'],
                                                  ip=request.remote_addr,
-                                                 id=form.monitor.data))
+                                                 id=data['monitor']))
                 errmsg = 'rejected probe log from unknown monitor ID {id}'
-                raise InvalidUsage(errmsg.format(id=form.monitor.data))
+                PROBE_LOGS.labels(result='rejected').inc()
+                raise InvalidUsage(errmsg.format(id=data['monitor']))
             # Match the destination IP and port to a configured Monitored
             # Segment instance
             try:
-                matched_segment = MonitoredSegment.get(
-                    MonitoredSegment.dest_addr == form.dest_addr.data,
-                    MonitoredSegment.dest_port == form.dest_port.data)
+                matched_segment = get_monitored_segment(data['dest_addr'],
+                                                        data['dest_port'])
             except MonitoredSegment.DoesNotExist:
                 logmsg = ('rejected probe log from {host} [{ip}] with unknown '
                           'monitored segment parameters (dest_addr={dest_addr} '
                           'and dest_port={dest_port})')
-                logmsg = logmsg.format(dest_addr=form.dest_addr.data,
-                                       dest_port=form.dest_port.data,
+                logmsg = logmsg.format(dest_addr=data['dest_addr'],
+                                       dest_port=data['dest_port'],
                                        ip=request.remote_addr,
-                                       host=form.hostname.data)
+                                       host=data['hostname'])
                 app.logger.warn(logmsg)
                 errmsg = ('rejected probe log with unknown monitored segment '
                           'destination {dest_addr}:{dest_port}')
-                errmsg = errmsg.format(dest_addr=form.dest_addr.data,
-                                       dest_port=form.dest_port.data)
+                errmsg = errmsg.format(dest_addr=data['dest_addr'],
+                                       dest_port=data['dest_port'])
+                PROBE_LOGS.labels(result='rejected').inc()
                 raise InvalidUsage(errmsg)
 
             eventlog = ReceivedProbeLog()
-            form.populate_obj(eventlog)
+            for name, _ in EVENT_FIELDS:
+                setattr(eventlog, name, data[name])
             eventlog.monitor = matched_monitor
             eventlog.segment = matched_segment
 
-            # Store new received event log instance
+            # Store new received event log instance, along with the health
+            # summary of the matched segment, and correlate it with the probe
+            # that caused it (or queue it to be stored in the background if
+            # write-behind is enabled)
             try:
-                eventlog.save()
+                if app.config['WRITE_BEHIND']:
+                    queue_probe_logs([model_to_dict(
+                        eventlog, recurse=False,
+                        exclude=[ReceivedProbeLog.id])])
+                    response_msg = 'accepted event log (queued)'
+                else:
+                    with DB_WRITE_SECONDS.labels(operation='received').time(), \
+                            ampt_db.atomic():
+                        eventlog.save()
+                        SegmentHealth.record(matched_segment.id,
+                                             received_count=1,
+                                             last_recv_time=eventlog.recv_time,
+                                             last_alert_time=eventlog.alert_time)
+                        correlate_probe_logs([(matched_segment.id,
+                                               eventlog.src_port,
+                                               eventlog.recv_time)])
+                    invalidate_dashboard_cache(logs=True)
+                    response_msg = 'accepted event log (id={id})'.format(id=eventlog.id)
+                PROBE_LOGS.labels(result='accepted').inc()
                 logmsg = 'probe log event accepted for monitor ID {monitor} from {plugin} on {host}[{ip}]'
                 app.logger.info(logmsg.format(monitor=matched_monitor,
-                                              host=form.hostname.data,
+                                              host=data['hostname'],
                                               ip=request.remote_addr,
-                                              plugin=form.plugin_name.data))
-                response_msg = 'accepted event log (id={id})'.format(id=eventlog.id)
+                                              plugin=data['plugin_name']))
                 return jsonify({
                     'message': response_msg,
                 })
@@ -396,7 +452,7 @@ class ReceivedLogView(FlaskView):
                 # without exception details
                 logmsg = ('failed to record probe log event from {host} [{ip}] '
                           '{monitor} due to error: {err}')
-                app.logger.error(logmsg.format(host=form.hostname.data,
+                app.logger.error(logmsg.format(host=data['hostname'],
                                                ip=request.remote_addr,
                                                monitor=matched_monitor,
                                                err=e))
@@ -404,36 +460,145 @@ class ReceivedLogView(FlaskView):
             # Submitted form did not validate
             errmsg = ('errors occurred in validating submission '
                       'from {host} [{ip}]: {errors}')
-            errmsg = errmsg.format(host=form.hostname.data,
+            errmsg = errmsg.format(host=data.get('hostname'),
                                    ip=request.remote_addr,
-                                   errors=form.errors)
+                                   errors=errors)
             app.logger.warning(errmsg)
+            PROBE_LOGS.labels(result='rejected').inc()
             raise InvalidUsage(errmsg)
 
+        PROBE_LOGS.labels(result='error').inc()
         raise InvalidUsage('Error processing probe log submission',
                            status_code=500)
 
+    @route('/search/')
+    @login_required
+    def search(self):
+        '''
+        Search received event logs, returning matching logs as JSON.
+
+        See the api module for the supported filters and response format.
+
+        '''
+        chunks = search_received_logs(request.args)
+        return Response(stream_with_context(chunks),
+                        mimetype='application/json')
+
+    @route('/batch/', methods=['POST'])
+    def batch(self):
+        '''
+        Receive and create batches of event logs from event monitors.
+
+        Submission requires a signed JSON envelope carrying an array of probe
+        events (see the ingest module for the format). The response reports
+        whether each event was accepted or rejected.
+
+        This view does not require a login session to access (submissions
+        are authenticated by HMAC digest).
+
+        '''
+        app.logger.debug('new inbound probe log batch submission request')
+        envelope = request.get_json(silent=True)
+        return jsonify(ingest_probe_log_batch(envelope, request.remote_addr))
+
+class ExportView(FlaskView):
+    route_prefix = '/log/'
+    decorators = [login_required]
+
+    def get(self, log_type):
+        '''
+        Stream export of received or generated probe logs.
+
+        Supports `format` (csv or ndjson), `gzip` (1 to compress) and
+        `start`/`end` (YYYY-MM-DDTHH:MM:SS) query string parameters.
+
+        '''
+        if log_type not in EXPORT_LOG_TYPES:
+            abort(404)
+        fmt = request.args.get('format', 'csv')
+        if fmt not in EXPORT_FORMATS:
+            abort(400)
+        compress = request.args.get('gzip') == '1'
+        try:
+            start = end = None
+            if request.args.get('start'):
+                start = parse_export_time(request.args['start'])
+            if request.args.get('end'):
+                end = parse_export_time(request.args['end'])
+        except ValueError:
+            abort(400)
+
+        filename = '{log_type}_probe_logs.{ext}'.format(log_type=log_type,
+                                                        ext=fmt)
+        mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+        if compress:
+            filename += '.gz'
+            mimetype = 'application/gzip'
+        logmsg = 'export of {log_type} probe logs requested by user {user}'
+        app.logger.info(logmsg.format(log_type=log_type,
+                                      user=current_user.username))
+        chunks = export_probe_log_chunks(log_type, fmt, start=start, end=end,
+                                         compress=compress)
+        disposition = 'attachment; filename={name}'.format(name=filename)
+        return Response(stream_with_context(chunks), mimetype=mimetype,
+                        headers={'Content-Disposition': disposition})
+
+
 GeneratorView.register(app)
 SegmentView.register(app)
 MonitorView.register(app)
 GeneratedLogView.register(app)
 ReceivedLogView.register(app)
+ExportView.register(app)
 
 
-@app.route('/')
-@login_required
-def index():
-    # Segments for which we have not yet received probe events from
-    # monitors will have None set for the 'latest_log_time' annotated field
-    # due to the join. See Jinja template for specifics.
-    # Update 2018-08-21: .annotate() dropped in 3.x, query restructured
+def get_health_rates(segment):
+    '''
+    Return mean probe latency and loss rate (None if no probes were
+    correlated yet) for segment selected with its health summary counts
+
+    '''
+    health = SegmentHealth(matched_count=segment.matched_count or 0,
+                           lost_count=segment.lost_count or 0,
+                           latency_total=segment.latency_total or 0)
+    return dict(mean_latency=health.get_mean_latency(),
+                loss_rate=health.get_loss_rate())
+
+
+def build_dashboard_context():
+    '''
+    Return template context for index page.
+
+    Query results are evaluated into lists of dicts holding the fields
+    (including those of related objects and counts) rendered on the page,
+    so that the context can be cached as JSON and rendered without further
+    queries.
+
+    '''
+    # Latest receipt time, probe log counts and probe correlation results
+    # are read from the segment health summaries rather than aggregated
+    # over the probe log tables. Segments for which we have not yet received
+    # probe events from monitors will have None set for the 'latest_log_time'
+    # field and segments without a health summary yet will have None counts
+    # due to the join. See Jinja template for specifics. The summary fields
+    # are set on the MonitoredSegment objects themselves.
     monitored_segments = (MonitoredSegment
                           .select(MonitoredSegment,
-                                  fn.MAX(ReceivedProbeLog.recv_time)
-                                  .alias('latest_log_time'))
-                          .join(ReceivedProbeLog, JOIN.LEFT_OUTER)
-                          .group_by(MonitoredSegment)
-                          .order_by(MonitoredSegment.name))
+                                  SegmentHealth.last_recv_time
+                                  .alias('latest_log_time'),
+                                  SegmentHealth.received_count
+                                  .alias('received_count'),
+                                  SegmentHealth.generated_count
+                                  .alias('generated_count'),
+                                  SegmentHealth.matched_count
+                                  .alias('matched_count'),
+                                  SegmentHealth.lost_count
+                                  .alias('lost_count'),
+                                  SegmentHealth.latency_total
+                                  .alias('latency_total'))
+                          .join(SegmentHealth, JOIN.LEFT_OUTER)
+                          .order_by(MonitoredSegment.name)
+                          .objects())
     # Apply configured limit on number of monitored segments rendered on
     # index page. By default no limit is imposed to allow the user to see
     # information about all segments. As the number of configured segments
@@ -444,37 +609,83 @@ def index():
         segment_limit = int(segment_limit)
         if segment_limit > 0:
             monitored_segments = monitored_segments.limit(segment_limit)
+    monitored_segments = [dict(id=s.id, name=s.name,
+                               description=s.description, active=s.active,
+                               latest_log_time=s.latest_log_time,
+                               received_count=s.received_count,
+                               generated_count=s.generated_count,
+                               **get_health_rates(s))
+                          for s in monitored_segments]
     total_monitored_segments = MonitoredSegment.select().count()
 
-    probe_generators = (ProbeGenerator
-                        .select()
-                        .order_by(ProbeGenerator.name)
-                        .limit(5))
+    # Probe log counts of the listed generators and monitors are counted
+    # once they are selected, so that only their logs are scanned
+    probe_generators = list(ProbeGenerator
+                            .select()
+                            .order_by(ProbeGenerator.name)
+                            .limit(5))
+    dispatch_counts = dict(GeneratedProbeLog
+                           .select(GeneratedProbeLog.probe_generator,
+                                   fn.COUNT(GeneratedProbeLog.id))
+                           .where(GeneratedProbeLog.probe_generator.in_(
+                               [g.id for g in probe_generators]))
+                           .group_by(GeneratedProbeLog.probe_generator)
+                           .tuples())
+    probe_generators = [dict(id=g.id, name=g.name, active=g.active,
+                             dispatch_count=dispatch_counts.get(g.id, 0))
+                        for g in probe_generators]
     total_probe_generators = ProbeGenerator.select().count()
 
-    event_monitors = (EventMonitor
-                      .select()
-                      .order_by(EventMonitor.hostname)
-                      .limit(5))
+    event_monitors = list(EventMonitor
+                          .select()
+                          .order_by(EventMonitor.hostname)
+                          .limit(5))
+    event_counts = dict(ReceivedProbeLog
+                        .select(ReceivedProbeLog.monitor,
+                                fn.COUNT(ReceivedProbeLog.id))
+                        .where(ReceivedProbeLog.monitor.in_(
+                            [m.id for m in event_monitors]))
+                        .group_by(ReceivedProbeLog.monitor)
+                        .tuples())
+    event_monitors = [dict(id=m.id, hostname=m.hostname,
+                           type_label=m.get_type_label(), active=m.active,
+                           event_count=event_counts.get(m.id, 0))
+                      for m in event_monitors]
     total_event_monitors = EventMonitor.select().count()
 
     received_logs = (ReceivedProbeLog
-                     .select()
+                     .select(ReceivedProbeLog, EventMonitor, MonitoredSegment)
+                     .join_from(ReceivedProbeLog, EventMonitor)
+                     .join_from(ReceivedProbeLog, MonitoredSegment)
                      .order_by(ReceivedProbeLog.recv_time.desc())
                      .limit(5))
+    received_logs = [dict(recv_time=l.recv_time, alert_time=l.alert_time,
+                          plugin_name=l.plugin_name,
+                          monitor=dict(id=l.monitor.id,
+                                       hostname=l.monitor.hostname,
+                                       type_label=l.monitor.get_type_label()),
+                          segment=dict(id=l.segment.id, name=l.segment.name))
+                     for l in received_logs]
     total_received_logs = ReceivedProbeLog.select().count()
 
-    return render_template('index_page.html',
-                           received_logs=received_logs,
-                           total_received_logs=total_received_logs,
-                           monitored_segments=monitored_segments,
-                           total_monitored_segments=total_monitored_segments,
-                           probe_generators=probe_generators,
-                           total_probe_generators=total_probe_generators,
-                           event_monitors=event_monitors,
-                           total_event_monitors=total_event_monitors,
-                           ampt_mgr_version=get_version(),
-                          )
+    return dict(received_logs=received_logs,
+                total_received_logs=total_received_logs,
+                monitored_segments=monitored_segments,
+                total_monitored_segments=total_monitored_segments,
+                probe_generators=probe_generators,
+                total_probe_generators=total_probe_generators,
+                event_monitors=event_monitors,
+                total_event_monitors=total_event_monitors,
+                ampt_mgr_version=get_version())
+
+
+@app.route('/')
+@login_required
+def index():
+    # Dashboard content is shared by all users and cached across server
+    # processes; see the cache module for invalidation
+    context = get_dashboard_context(build_dashboard_context)
+    return render_template('index_page.html', **context)
 
 @app.route('/login/', methods=['GET', 'POST'])
 def login():
@@ -0,0 +1,349 @@
+'''
+AMPT Manager write-behind queue for received probe logs
+
+When WRITE_BEHIND is enabled, validated probe logs are appended to a local
+queue file and acknowledged to the event monitor as soon as they are
+written to disk, rather than after they are committed to the database. A
+background thread in each server process periodically stores the queued
+logs in the database in one transaction per queue file.
+
+Each server process appends to its own queue files, named after its
+process ID and a sequence number (`<pid>-<seq>.queue`), one JSON encoded
+probe log per line. The flusher closes the file being appended to before
+storing it, and removes it once stored. Queue files left behind by
+processes that exited without flushing them (for instance after a crash)
+are stored when the server starts, and are claimed (by renaming them) and
+stored by a running server process otherwise.
+
+Queued logs are stored at least once: logs in a queue file being stored
+when the server process crashed may be stored again when the file is
+recovered. If storing the logs of a queue file together fails, they are
+stored one at a time, and logs that cannot be stored (for instance because
+their segment or monitor was deleted meanwhile) are moved to a dead-letter
+file (`<pid>-<seq>.failed`) for inspection. Queue files none of whose logs
+can be stored are retried, and moved to a dead-letter file after
+`max_attempts` failed flushes.
+
+'''
+import os
+import json
+import atexit
+import datetime
+import threading
+
+from . import app
+from .validators import json_serial
+from ..metrics import pid_alive
+
+
+# Probe log fields holding timestamps, serialized in ISO 8601 format
+QUEUE_TIME_FIELDS = ('alert_time', 'recv_time')
+QUEUE_TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+def get_write_behind_path():
+    '''
+    Return directory for write-behind queue files: WRITE_BEHIND_DIR if set,
+    otherwise a `queue` directory alongside the app configuration file
+
+    '''
+    if app.config.get('WRITE_BEHIND_DIR'):
+        return app.config['WRITE_BEHIND_DIR']
+    configfile = os.environ.get('AMPT_MANAGER_SETTINGS')
+    if configfile:
+        return os.path.join(os.path.dirname(os.path.abspath(configfile)),
+                            'queue')
+    return None
+
+
+def _parse_time(value):
+    for fmt in QUEUE_TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('invalid timestamp {value}'.format(value=value))
+
+
+class WriteBehindQueue(object):
+    '''
+    Durable queue of probe logs stored in the database in the background.
+
+    :param path:
+        Directory to store queue files in (created if missing).
+    :param store:
+        Function storing a list of probe log rows in the database.
+    :param interval:
+        Seconds between flushes of queued logs to the database.
+    :param sync:
+        Whether queued logs are synced to disk before they are
+        acknowledged, so that they survive a system crash rather than only
+        a server process crash.
+    :param max_attempts:
+        Number of failed flushes of a queue file after which it is moved
+        to a dead-letter file.
+
+    '''
+    def __init__(self, path, store, interval=1.0, sync=True, max_attempts=5):
+        self.path = path
+        self.store = store
+        self.interval = interval
+        self.sync = sync
+        self.max_attempts = max_attempts
+        self._attempts = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._active_seq = None
+        self._next_seq = 0
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def _queue_file(self, pid, seq):
+        return os.path.join(self.path, '{pid}-{seq:08d}.queue'.format(
+            pid=pid, seq=seq))
+
+    def _list_queue_files(self, extensions=('.queue',)):
+        '''
+        Return list of (pid, seq, filename) tuples of queue files (or of
+        files with other `extensions`, such as dead-letter files)
+
+        '''
+        files = []
+        for name in os.listdir(self.path):
+            base, ext = os.path.splitext(name)
+            try:
+                pid, seq = [int(n) for n in base.split('-')]
+            except ValueError:
+                continue
+            if ext in extensions:
+                files.append((pid, seq, os.path.join(self.path, name)))
+        return sorted(files)
+
+    def _start(self):
+        '''
+        Prepare queue for use by the current process, starting its flusher
+        thread. Called with the queue lock held.
+
+        '''
+        if self._pid == os.getpid():
+            return
+        # First use in this process, which may be a forked copy of a process
+        # that already used the queue
+        self._pid = os.getpid()
+        self._fd = None
+        self._active_seq = None
+        os.makedirs(self.path, exist_ok=True)
+        # Process IDs may be reused, so continue after any files left by an
+        # earlier process with the same ID
+        self._next_seq = max([seq + 1 for pid, seq, _
+                              in self._list_queue_files(('.queue', '.failed'))
+                              if pid == self._pid] or [0])
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='ampt-write-behind',
+                                        daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _allocate_seq(self):
+        'Return next sequence number for queue file. Called with lock held.'
+        seq = self._next_seq
+        self._next_seq += 1
+        return seq
+
+    def put(self, rows):
+        '''
+        Append probe logs (dicts of ReceivedProbeLog fields, with foreign
+        keys as IDs) to the queue. Returns once the logs are written to the
+        queue file.
+
+        '''
+        data = ''.join(json.dumps(row, default=json_serial) + '\n'
+                       for row in rows).encode('utf-8')
+        with self._lock:
+            self._start()
+            if self._fd is None:
+                self._active_seq = self._allocate_seq()
+                self._fd = os.open(self._queue_file(self._pid,
+                                                    self._active_seq),
+                                   os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                                   0o600)
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self._fd, view):]
+            if self.sync:
+                os.fsync(self._fd)
+
+    def _rotate(self):
+        'Close the queue file being appended to, so that it can be stored'
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+                self._active_seq = None
+
+    def _claim_orphaned_files(self):
+        '''
+        Take over queue files of processes that are no longer running by
+        renaming them as files of this process
+
+        '''
+        for pid, seq, filename in self._list_queue_files():
+            if pid == self._pid or pid_alive(pid):
+                continue
+            with self._lock:
+                claimed = self._queue_file(self._pid, self._allocate_seq())
+            try:
+                os.rename(filename, claimed)
+            except FileNotFoundError:
+                # Claimed by another process
+                continue
+            logmsg = 'recovering queued probe logs of exited process {pid}'
+            app.logger.info(logmsg.format(pid=pid))
+
+    def _read_queue_file(self, filename):
+        'Return probe log rows stored in queue file'
+        rows = []
+        with open(filename, 'rb') as f:
+            for lineno, line in enumerate(f, 1):
+                try:
+                    row = json.loads(line.decode('utf-8'))
+                    for field in QUEUE_TIME_FIELDS:
+                        row[field] = _parse_time(row[field])
+                except (ValueError, KeyError) as e:
+                    # Only the last line can be incomplete, if the process
+                    # crashed while appending to the file; the logs on it
+                    # were never acknowledged
+                    logmsg = ('skipping invalid queued probe log at {file} '
+                              'line {lineno}: {err}')
+                    app.logger.warning(logmsg.format(file=filename,
+                                                     lineno=lineno, err=e))
+                    continue
+                rows.append(row)
+        return rows
+
+    def _dead_letter_file(self, filename):
+        return os.path.splitext(filename)[0] + '.failed'
+
+    def _store_rows(self, filename, rows):
+        '''
+        Store probe logs read from queue file, one at a time if storing them
+        together fails, moving logs that cannot be stored to a dead-letter
+        file. Returns number of logs stored. Raises the error storing the
+        logs together if none of them can be stored.
+
+        '''
+        try:
+            self.store(rows)
+            return len(rows)
+        except Exception as e:
+            error = e
+        failed = []
+        for row in rows:
+            try:
+                self.store([row])
+            except Exception:
+                failed.append(row)
+        if len(failed) == len(rows):
+            raise error
+        dead_letter_file = self._dead_letter_file(filename)
+        with open(dead_letter_file, 'a') as f:
+            for row in failed:
+                f.write(json.dumps(row, default=json_serial) + '\n')
+        logmsg = ('failed to store {cnt} queued probe logs from {file}, '
+                  'moved them to {dead_letter_file}: {err}')
+        app.logger.error(logmsg.format(cnt=len(failed), file=filename,
+                                       dead_letter_file=dead_letter_file,
+                                       err=error))
+        return len(rows) - len(failed)
+
+    def _store_queue_files(self, filenames):
+        'Store and remove queue files. Returns number of logs stored.'
+        stored = 0
+        for filename in filenames:
+            try:
+                rows = self._read_queue_file(filename)
+                file_stored = self._store_rows(filename, rows) if rows else 0
+                os.remove(filename)
+            except Exception as e:
+                attempts = self._attempts.get(filename, 0) + 1
+                if attempts < self.max_attempts:
+                    # Keep the file to retry storing it on the next flush
+                    self._attempts[filename] = attempts
+                    logmsg = ('failed to store queued probe logs from {file}: '
+                              '{err}')
+                    app.logger.error(logmsg.format(file=filename, err=e))
+                    continue
+                self._attempts.pop(filename, None)
+                dead_letter_file = self._dead_letter_file(filename)
+                logmsg = ('failed to store queued probe logs from {file} '
+                          '{attempts} times, moving it to {dead_letter_file}: '
+                          '{err}')
+                app.logger.error(logmsg.format(
+                    file=filename, attempts=attempts,
+                    dead_letter_file=dead_letter_file, err=e))
+                try:
+                    os.rename(filename, dead_letter_file)
+                except OSError as e:
+                    logmsg = 'failed to move {file}: {err}'
+                    app.logger.error(logmsg.format(file=filename, err=e))
+                continue
+            self._attempts.pop(filename, None)
+            stored += file_stored
+        return stored
+
+    def flush(self):
+        '''
+        Store all probe logs queued by this process (and logs recovered
+        from exited processes) in the database. Returns number of logs
+        stored.
+
+        '''
+        with self._flush_lock:
+            self._rotate()
+            self._claim_orphaned_files()
+            with self._lock:
+                active_seq = self._active_seq
+            filenames = [filename for pid, seq, filename
+                         in self._list_queue_files()
+                         if pid == self._pid and seq != active_seq]
+            stored = self._store_queue_files(filenames)
+        if stored:
+            app.logger.debug('stored {cnt} queued probe logs'.format(
+                cnt=stored))
+        return stored
+
+    def recover(self):
+        '''
+        Store probe logs left in queue files by processes that are no
+        longer running. Returns number of logs stored.
+
+        '''
+        if not os.path.isdir(self.path):
+            return 0
+        filenames = [filename for pid, seq, filename
+                     in self._list_queue_files()
+                     if pid != os.getpid() and not pid_alive(pid)]
+        stored = self._store_queue_files(filenames)
+        if stored:
+            logmsg = 'recovered {cnt} queued probe logs from {files} files'
+            app.logger.info(logmsg.format(cnt=stored, files=len(filenames)))
+        return stored
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                app.logger.error('write-behind flush failed: {err}'.format(
+                    err=e))
+
+    def close(self):
+        'Stop the flusher thread and store remaining queued probe logs'
+        if self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._thread.join(timeout=self.interval + 5)
+        self.flush()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+'''
+Benchmark probe log submission validation: WTForms form vs fast path.
+
+Sets up a throwaway AMPT manager instance (SQLite in a temporary
+directory), checks that the ReceivedProbeLogForm and the lightweight
+ingest validation accept and reject the same submissions (including valid
+and invalid variations of every field, with and without valid HMAC
+digests, and the resulting replay counter), then measures submissions per
+second for validation alone and for complete requests to the probe log
+submission view.
+
+Example:
+
+    python devel/benchmark/ingest_validation.py --requests 5000
+
+'''
+import os
+import sys
+import hmac
+import json
+import time
+import argparse
+import tempfile
+
+
+def setup_instance(tmpdir):
+    'Write temporary app configuration and create database tables'
+    configfile = os.path.join(tmpdir, 'ampt_manager.conf')
+    with open(configfile, 'w') as f:
+        f.write('DATABASE = "{db}"\n'.format(
+            db=os.path.join(tmpdir, 'ampt_manager.db')))
+        f.write('SECRET_KEY = {key}\n'.format(key=os.urandom(24)))
+        f.write('LOGLEVEL = "critical"\n')
+        f.write('METRICS_ENABLED = False\n')
+        f.write('DASHBOARD_CACHE_TTL = 0\n')
+    os.environ['AMPT_MANAGER_SETTINGS'] = configfile
+
+    from ampt_manager.web import app
+    from ampt_manager.db.database import MODEL_LIST
+    from ampt_manager.db.models import (ampt_db, User, ProbeGenerator,
+                                        EventMonitor, MonitoredSegment)
+    app.logger.setLevel('CRITICAL')
+    ampt_db.create_tables(MODEL_LIST)
+    user = User.create(username='bench', display_name='Bench',
+                       password='-', email='bench@localhost')
+    generator = ProbeGenerator.create(name='bench', address='127.0.0.1',
+                                      auth_key='bench', created_by=user,
+                                      last_modified_by=user)
+    monitor = EventMonitor.create(hostname='bench', description='bench',
+                                  type='suricata', auth_key='bench-key',
+                                  created_by=user, last_modified_by=user)
+    MonitoredSegment.create(name='bench', description='bench',
+                            dest_addr='10.0.0.1', dest_port=80,
+                            protocol='tcp', generator=generator,
+                            created_by=user, last_modified_by=user)
+    ampt_db.close()
+    return monitor.id, monitor.auth_key
+
+
+def sign(fields, auth_key):
+    '''
+    Return HMAC digest of submission as computed by an event monitor:
+    over the converted field values, where they are valid
+
+    '''
+    from ampt_manager.web.ingest import FORM_FIELDS
+    from ampt_manager.web.validators import json_serial
+    converters = dict(FORM_FIELDS)
+    message = {}
+    for name, value in fields.items():
+        if name == 'h':
+            continue
+        try:
+            message[name] = converters[name](value)
+        except (KeyError, TypeError, ValueError):
+            message[name] = value
+    j = json.dumps(message, default=json_serial, sort_keys=True)
+    return hmac.new(auth_key.encode('utf-8'), j.encode('utf-8'),
+                    'sha256').hexdigest()
+
+
+def make_submission(monitor_id, auth_key, counter, **overrides):
+    '''
+    Return list of form (name, value) pairs of signed submission. Fields
+    overridden with None are left out, and fields overridden with a list
+    are repeated.
+
+    '''
+    fields = {
+        'monitor': str(monitor_id),
+        'src_addr': '192.0.2.1',
+        'dest_addr': '10.0.0.1',
+        'src_port': '51234',
+        'dest_port': '80',
+        'protocol': 'tcp',
+        'alert_time': '2018-08-31T01:20:00',
+        'hostname': 'sensor01',
+        'plugin_name': 'suricata',
+        'ts': '{:.6f}'.format(counter),
+    }
+    sign_fields = dict(fields)
+    for name, value in overrides.items():
+        if name == 'h':
+            continue
+        if value is None:
+            del fields[name]
+            sign_fields.pop(name, None)
+        else:
+            fields[name] = value
+            sign_fields[name] = (' '.join(value) if isinstance(value, list)
+                                 and name == 'alert_time' else
+                                 value[0] if isinstance(value, list)
+                                 else value)
+    fields['h'] = overrides.get('h', sign(sign_fields, auth_key))
+    if fields['h'] is None:
+        del fields['h']
+    pairs = []
+    for name, value in fields.items():
+        for v in (value if isinstance(value, list) else [value]):
+            pairs.append((name, v))
+    return pairs
+
+
+# Field variations checked for identical decisions
+VARIATIONS = {
+    'monitor': ['0', '-1', '1.0', 'abc', ' 1', '+1', '01', '99', '', None,
+                ['1', 'x']],
+    'src_addr': ['256.1.1.1', '::1', ' 192.0.2.1', '192.0.2.1 ', '192.0.2',
+                 'host', '', None, ['192.0.2.1', 'x']],
+    'dest_addr': ['10.0.0.2', '010.0.0.1', '10.0.0.1\n', '', None],
+    'src_port': ['65535', '65536', '0', '-1', '80.0', ' 80', '8_0', '',
+                 None, ['80', 'x']],
+    'dest_port': ['8080', '080', '65536', 'http', '', None],
+    'protocol': ['udp', 'unspecified', 'TCP', 'icmp', ' tcp', '', None,
+                 ['tcp', 'udp']],
+    'alert_time': ['2018-8-31T1:20:0', '2018-08-31 01:20:00',
+                   '2018-08-31T01:20:00Z', '2018-02-30T01:20:00',
+                   '2018-08-31T01:20:00.5', '', None,
+                   ['2018-08-31T01:20:00', '2018-08-31T01:20:00'],
+                   ['', '2018-08-31T01:20:00'], ['2018-08-31', '01:20:00']],
+    'hostname': ['sensor 02', ' ', 'é', '', None],
+    'plugin_name': ['zeek', '', None],
+    'h': ['0' * 64, 'abc', 'é', '', None],
+    'ts': ['abc', 'nan', 'inf', '-1', '0', '1e400', '', None],
+}
+
+
+def get_decision(app, pairs, fast):
+    '''
+    Return whether submission is accepted (valid and replay counter
+    advanced) by the form or the fast path validation, and the time in
+    seconds spent validating it (excluding setting up the request and
+    connecting to the database)
+
+    '''
+    from flask import request
+    from werkzeug.datastructures import MultiDict
+    from ampt_manager.db.models import ampt_db
+    from ampt_manager.web.forms import ReceivedProbeLogForm
+    from ampt_manager.web.ingest import validate_probe_log_form
+    with app.test_request_context('/log/receivedlog/', method='POST',
+                                  data=MultiDict(pairs)):
+        request.form
+        ampt_db.connect(reuse_if_open=True)
+        start = time.perf_counter()
+        try:
+            if fast:
+                _, errors = validate_probe_log_form(request.form)
+                accepted = not errors
+            else:
+                accepted = ReceivedProbeLogForm().validate_on_submit()
+        except Exception:
+            # The form raises on some invalid submissions (e.g. unknown
+            # monitor IDs), which are then rejected with a server error
+            accepted = False
+        return accepted, time.perf_counter() - start
+
+
+def check_decisions(app, monitor_id, auth_key):
+    'Check form and fast path decisions match. Returns number of mismatches.'
+    from ampt_manager.db.models import ReplayCounter
+    cases = [{}]
+    for name, values in VARIATIONS.items():
+        for value in values:
+            cases.append({name: value})
+            # The same variation with an invalid digest
+            if name != 'h':
+                cases.append({name: value, 'h': '0' * 64})
+    mismatches = 0
+    accepted_cnt = 0
+    for overrides in cases:
+        results = []
+        for fast in (False, True):
+            ReplayCounter.delete().execute()
+            pairs = make_submission(monitor_id, auth_key, 1000.0, **overrides)
+            accepted, _ = get_decision(app, pairs, fast)
+            counter = ReplayCounter.get_or_none(
+                ReplayCounter.scope == monitor_id)
+            results.append((accepted, counter and counter.value))
+        accepted_cnt += results[0][0]
+        if results[0] != results[1]:
+            mismatches += 1
+            print('MISMATCH {overrides}: form={form} fast={fast}'.format(
+                overrides=overrides, form=results[0], fast=results[1]))
+    print('checked {cnt} submission variations ({accepted} accepted): '
+          '{mismatches} mismatches'.format(cnt=len(cases),
+                                           accepted=accepted_cnt,
+                                           mismatches=mismatches))
+    return mismatches
+
+
+def time_rate(func, submissions):
+    'Return submissions per second processed by `func`'
+    start = time.perf_counter()
+    for pairs in submissions:
+        func(pairs)
+    return len(submissions) / (time.perf_counter() - start)
+
+
+def run(requests):
+    with tempfile.TemporaryDirectory(prefix='ampt-bench-') as tmpdir:
+        monitor_id, auth_key = setup_instance(tmpdir)
+        from ampt_manager.web import app
+        from ampt_manager.db.models import ampt_db
+
+        mismatches = check_decisions(app, monitor_id, auth_key)
+
+        counter = [2000.0]
+
+        def submissions():
+            subs = []
+            for _ in range(requests):
+                counter[0] += 1
+                subs.append(make_submission(monitor_id, auth_key, counter[0]))
+            return subs
+
+        def validation_rate(fast):
+            elapsed = sum(get_decision(app, pairs, fast)[1]
+                          for pairs in submissions())
+            return requests / elapsed
+
+        results = {fast: validation_rate(fast) for fast in (False, True)}
+        # Without the replay counter database update, which both paths share
+        from ampt_manager.db.models import ReplayCounter
+        advance = ReplayCounter.advance
+        ReplayCounter.advance = classmethod(lambda cls, scope, value: True)
+        cpu_results = {fast: validation_rate(fast) for fast in (False, True)}
+        ReplayCounter.advance = advance
+
+        from werkzeug.datastructures import MultiDict
+        client = app.test_client()
+        request_results = {}
+        for fast in (False, True):
+            app.config['INGEST_FAST_VALIDATION'] = fast
+
+            def post(pairs):
+                r = client.post('/log/receivedlog/', data=MultiDict(pairs))
+                assert r.status_code == 200, r.get_data(as_text=True)
+            request_results[fast] = time_rate(post, submissions())
+        ampt_db.close()
+
+        print('{:<24} {:>14} {:>14} {:>8}'.format(
+            'submissions/sec ({})'.format(requests), 'form', 'fast path',
+            'speedup'))
+        for name, rates in (('validation, no counter', cpu_results),
+                            ('validation only', results),
+                            ('complete request', request_results)):
+            print('{:<24} {:>14.0f} {:>14.0f} {:>7.1f}x'.format(
+                name, rates[False], rates[True], rates[True] / rates[False]))
+        return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-r', '--requests', type=int, default=2000,
+                        help='number of timed submissions per path '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+    sys.exit(1 if run(args.requests) else 0)
+
+
+if __name__ == '__main__':
+    main()
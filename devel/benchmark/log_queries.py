@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+'''
+Benchmark hot ReceivedProbeLog queries with and without the model indexes.
+
+Populates a throwaway AMPT manager database (SQLite in a temporary
+directory) with the requested number of received probe log rows, then
+times the segment verification, dashboard and log listing queries before
+and after creating the ReceivedProbeLog indexes.
+
+Example:
+
+    python devel/benchmark/log_queries.py --rows 1000000 --rows 10000000
+
+'''
+import os
+import sys
+import time
+import random
+import argparse
+import datetime
+import tempfile
+import statistics
+
+# ReceivedProbeLog indexes backing the benchmarked queries
+LOG_QUERY_INDEXES = (
+    ('segment', 'alert_time'),
+    ('segment', 'recv_time'),
+    ('recv_time',),
+)
+
+
+def setup_instance(tmpdir):
+    'Write temporary app configuration and create database tables'
+    configfile = os.path.join(tmpdir, 'ampt_manager.conf')
+    with open(configfile, 'w') as f:
+        f.write('DATABASE = "{db}"\n'.format(
+            db=os.path.join(tmpdir, 'ampt_manager.db')))
+        f.write('SECRET_KEY = {key}\n'.format(key=os.urandom(24)))
+        f.write('LOGLEVEL = "warning"\n')
+    os.environ['AMPT_MANAGER_SETTINGS'] = configfile
+
+    from ampt_manager.web import app
+    from ampt_manager.db.database import MODEL_LIST
+    from ampt_manager.db.models import ampt_db
+    ampt_db.create_tables(MODEL_LIST)
+
+
+def populate(rows, segments):
+    'Create monitored segments and `rows` received probe logs'
+    from ampt_manager.db.models import (ampt_db, User, ProbeGenerator,
+                                        EventMonitor, MonitoredSegment,
+                                        ReceivedProbeLog)
+    user = User.create(username='bench', display_name='Bench',
+                       password='-', email='bench@localhost')
+    generator = ProbeGenerator.create(name='bench', address='127.0.0.1',
+                                      auth_key='bench', created_by=user,
+                                      last_modified_by=user)
+    monitor = EventMonitor.create(hostname='bench', description='bench',
+                                  type='suricata', auth_key='bench',
+                                  created_by=user, last_modified_by=user)
+    segment_ids = []
+    for i in range(segments):
+        segment = MonitoredSegment.create(
+            name='segment-{}'.format(i), description='bench',
+            dest_addr='10.{}.{}.1'.format(i // 256, i % 256), dest_port=80,
+            protocol='tcp', generator=generator, created_by=user,
+            last_modified_by=user)
+        segment_ids.append(segment.id)
+
+    # Spread logs evenly over the past 30 days, oldest first, inserting
+    # directly through the DB-API cursor to keep population time down
+    now = datetime.datetime.utcnow()
+    step = datetime.timedelta(days=30) / rows
+    sql = ('INSERT INTO receivedprobelog (monitor_id, src_addr, dest_addr, '
+           'src_port, dest_port, protocol, hostname, plugin_name, '
+           'recv_time, alert_time, segment_id) '
+           'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+    batch = 50000
+    conn = ampt_db.connection()
+    for start in range(0, rows, batch):
+        values = []
+        for n in range(start, min(start + batch, rows)):
+            recv_time = now - step * (rows - n)
+            values.append((monitor.id, '192.0.2.1', '10.0.0.1',
+                           random.randrange(49152, 65535), 80, 'tcp',
+                           'bench', 'bench', recv_time,
+                           recv_time - datetime.timedelta(seconds=2),
+                           random.choice(segment_ids)))
+        with ampt_db.atomic():
+            conn.executemany(sql, values)
+
+
+def time_query(func, repeat):
+    'Return median run time of `func` in milliseconds'
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def get_queries():
+    'Return mapping of query names to callables executing them'
+    from peewee import fn, JOIN
+    from ampt_manager.db.models import MonitoredSegment, ReceivedProbeLog
+    from ampt_manager.verifier import get_segment_verifications
+
+    def verify():
+        end_time = datetime.datetime.utcnow()
+        get_segment_verifications(end_time - datetime.timedelta(minutes=30),
+                                  end_time)
+
+    def dashboard_latest_per_segment():
+        list(MonitoredSegment
+             .select(MonitoredSegment,
+                     fn.MAX(ReceivedProbeLog.recv_time).alias('latest_log_time'))
+             .join(ReceivedProbeLog, JOIN.LEFT_OUTER)
+             .group_by(MonitoredSegment))
+
+    def log_list_first_page():
+        list(ReceivedProbeLog.select()
+             .order_by(ReceivedProbeLog.recv_time.desc())
+             .limit(50))
+
+    return [
+        ('verify (30 min window)', verify),
+        ('dashboard MAX(recv_time) per segment', dashboard_latest_per_segment),
+        ('log list first page', log_list_first_page),
+    ]
+
+
+def run(rows, segments, repeat):
+    'Run benchmark for `rows` log rows and print results'
+    with tempfile.TemporaryDirectory(prefix='ampt-bench-') as tmpdir:
+        setup_instance(tmpdir)
+        from peewee import ModelIndex
+        from ampt_manager.db.models import ampt_db, ReceivedProbeLog
+
+        start = time.perf_counter()
+        populate(rows, segments)
+        print('populated {rows} rows for {segments} segments in {secs:.1f}s'
+              .format(rows=rows, segments=segments,
+                      secs=time.perf_counter() - start))
+
+        # Only the benchmarked query indexes are dropped, keeping the foreign
+        # key indexes the tables were created with
+        indexes = [ModelIndex(ReceivedProbeLog,
+                              [getattr(ReceivedProbeLog, name)
+                               for name in fields])._name
+                   for fields in LOG_QUERY_INDEXES]
+        indexes = [i.name for i in ampt_db.get_indexes('receivedprobelog')
+                   if i.name in indexes]
+        queries = get_queries()
+
+        results = {}
+        for name in indexes:
+            ampt_db.execute_sql('DROP INDEX {}'.format(name))
+        ampt_db.execute_sql('ANALYZE')
+        for query_name, func in queries:
+            results[query_name] = [time_query(func, repeat)]
+        ReceivedProbeLog._schema.create_indexes(safe=True)
+        ampt_db.execute_sql('ANALYZE')
+        for query_name, func in queries:
+            results[query_name].append(time_query(func, repeat))
+
+        print('{:<40} {:>14} {:>14}'.format('query ({} rows)'.format(rows),
+                                            'no index (ms)', 'indexed (ms)'))
+        for query_name, _ in queries:
+            before, after = results[query_name]
+            print('{:<40} {:>14.2f} {:>14.2f}'.format(query_name, before,
+                                                      after))
+        ampt_db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-r', '--rows', type=int, action='append',
+                        help='number of received probe log rows '
+                             '(may be repeated; default: 1000000)')
+    parser.add_argument('-s', '--segments', type=int, default=200,
+                        help='number of monitored segments '
+                             '(default: %(default)s)')
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+                        help='number of timed runs per query '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    # Each run needs a fresh database, and the app binds the database
+    # when first imported, so run each row count in a child process
+    row_counts = args.rows or [1000000]
+    if len(row_counts) > 1:
+        import subprocess
+        for rows in row_counts:
+            subprocess.check_call([sys.executable, __file__,
+                                   '--rows', str(rows),
+                                   '--segments', str(args.segments),
+                                   '--repeat', str(args.repeat)])
+        return
+    run(row_counts[0], args.segments, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
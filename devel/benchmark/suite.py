@@ -0,0 +1,685 @@
+#!/usr/bin/env python
+'''
+Benchmark probe log ingestion, HMAC verification, dispatch and dashboard.
+
+Each benchmark case runs in a child process against a throwaway AMPT
+manager instance (SQLite in a temporary directory):
+
+ingest      Serves the app with `ampt-manager run` (TLS, Gunicorn workers)
+            and submits signed probe logs to the probe log submission view
+            (ReceivedLogView.post) from concurrent clients, one event
+            monitor per client. Reports requests per second and p50/p99
+            latency for each concurrency.
+hmac        Times HMAC digest verification of a probe log submission for
+            each digest: computing and comparing the digest alone, and
+            together with building the message from the submitted fields.
+dispatch    Dispatches probe requests for the monitored segments to a local
+            stand-in probe generator, batched and individually. Reports
+            segments dispatched per second for each number of segments.
+dashboard   Populates the database with received probe logs and times
+            building the dashboard content and rendering the (uncached)
+            dashboard page for each number of log rows.
+
+Results are written as JSON with `--output`, and compared with the results
+of an earlier run with `--compare`, which exits with status 1 if any
+metric is more than `--tolerance` worse than in the earlier run. App
+settings may be overridden for all cases with `--setting`, for instance to
+compare ingestion with write-behind enabled.
+
+Example:
+
+    python devel/benchmark/suite.py -o before.json
+    python devel/benchmark/suite.py -o after.json --compare before.json
+    python devel/benchmark/suite.py -b ingest -c 1 -c 32 -s WRITE_BEHIND=True
+
+'''
+import os
+import sys
+import hmac
+import json
+import time
+import socket
+import timeit
+import argparse
+import datetime
+import platform
+import shutil
+import tempfile
+import threading
+import statistics
+import subprocess
+
+# Helpers shared with the other benchmarks in this directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+BENCHMARKS = ('ingest', 'hmac', 'dispatch', 'dashboard')
+# Metrics compared between runs, and whether higher values are better
+COMPARED_METRICS = {
+    'ingest': (('requests_per_sec', True), ('p50_ms', False),
+               ('p99_ms', False)),
+    'hmac': (('digest_us', False), ('verify_us', False)),
+    'dispatch': (('segments_per_sec', True),),
+    'dashboard': (('context_ms', False), ('request_ms', False)),
+}
+
+
+def setup_instance(tmpdir, settings, server=False):
+    '''
+    Write temporary app configuration, with `settings` (list of NAME=VALUE
+    strings) appended, and create database tables. With `server`, a
+    self-signed certificate is created for serving the app.
+
+    '''
+    configfile = os.path.join(tmpdir, 'ampt_manager.conf')
+    with open(configfile, 'w') as f:
+        f.write('DATABASE = "{db}"\n'.format(
+            db=os.path.join(tmpdir, 'ampt_manager.db')))
+        f.write('SECRET_KEY = {key}\n'.format(key=os.urandom(24)))
+        f.write('LOGLEVEL = "critical"\n')
+        f.write('LOGFILE = "{log}"\n'.format(
+            log=os.path.join(tmpdir, 'ampt_manager.log')))
+        f.write('ACCESS_LOGFILE = "{log}"\n'.format(
+            log=os.path.join(tmpdir, 'access.log')))
+        f.write('SEGMENT_LIMIT_INDEX = 0\n')
+        f.write('DASHBOARD_CACHE_TTL = 0\n')
+        if server:
+            from ampt_manager.appinit.certificate import (
+                create_self_signed_cert, CERT_FILE, KEY_FILE)
+            create_self_signed_cert(tmpdir)
+            f.write('SERVER_CERTIFICATE = "{cert}"\n'.format(
+                cert=os.path.join(tmpdir, CERT_FILE)))
+            f.write('SERVER_PRIVATE_KEY = "{key}"\n'.format(
+                key=os.path.join(tmpdir, KEY_FILE)))
+        for setting in settings:
+            f.write(setting + '\n')
+    os.environ['AMPT_MANAGER_SETTINGS'] = configfile
+
+    from ampt_manager.web import app
+    from ampt_manager.db.database import MODEL_LIST
+    from ampt_manager.db.models import ampt_db
+    app.logger.setLevel('CRITICAL')
+    ampt_db.create_tables(MODEL_LIST)
+    return configfile
+
+
+def create_objects(monitors=0, segments=0, generator_ports=(5000,)):
+    '''
+    Create user, probe generators (one at 127.0.0.1 for each of
+    `generator_ports`), event monitors and monitored segments (spread
+    across the generators). Returns lists of the (ID, auth key) of the
+    monitors and of the segment IDs.
+
+    '''
+    from ampt_manager.db.models import (User, ProbeGenerator, EventMonitor,
+                                        MonitoredSegment)
+    user = User.create(username='bench', display_name='Bench',
+                       password='-', email='bench@localhost')
+    generator_list = [ProbeGenerator.create(name='bench-{}'.format(i),
+                                            address='127.0.0.1',
+                                            port=port, auth_key='bench',
+                                            created_by=user,
+                                            last_modified_by=user)
+                      for i, port in enumerate(generator_ports)]
+    monitor_list = []
+    for i in range(monitors):
+        monitor = EventMonitor.create(hostname='bench-{}'.format(i),
+                                      description='bench', type='suricata',
+                                      auth_key='bench-key-{}'.format(i),
+                                      created_by=user, last_modified_by=user)
+        monitor_list.append((monitor.id, monitor.auth_key))
+    segment_list = []
+    for i in range(segments):
+        segment = MonitoredSegment.create(
+            name='segment-{}'.format(i), description='bench',
+            dest_addr='10.{}.{}.1'.format(i // 256, i % 256), dest_port=80,
+            protocol='tcp', generator=generator_list[i % len(generator_list)],
+            created_by=user, last_modified_by=user)
+        segment_list.append(segment.id)
+    return monitor_list, segment_list
+
+
+def get_free_port():
+    'Return unused local TCP port'
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, pct):
+    'Return `pct` percentile of values, interpolating between closest ranks'
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+class StandInGenerator(object):
+    '''
+    Local stand-in for a probe generator, accepting every probe request
+    (individual and batched) after an optional delay.
+
+    '''
+    def __init__(self, delay=0.0):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        generator = self
+        self.delay = delay
+        self.requests = 0
+        self._lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def send_json(self, data):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                generator.count()
+                self.send_json({'status': 'ok'})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                probes = json.loads(self.rfile.read(length))['probes']
+                generator.count()
+                self.send_json({'results': [{'accepted': True}
+                                            for _ in probes]})
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        daemon=True)
+
+    def count(self):
+        if self.delay:
+            time.sleep(self.delay)
+        with self._lock:
+            self.requests += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def start_server(configfile, port, workers, worker_class):
+    'Start app server and wait for it to accept requests'
+    import requests
+    logfile = os.path.join(os.path.dirname(configfile), 'server.out')
+    cmd = [sys.executable, '-c', 'from ampt_manager.cli import main; main()',
+           'run', configfile, '-L', '127.0.0.1', '-p', str(port)]
+    if workers:
+        cmd += ['-w', str(workers)]
+    if worker_class:
+        cmd += ['-k', worker_class]
+    with open(logfile, 'w') as f:
+        server = subprocess.Popen(cmd, stdout=f, stderr=subprocess.STDOUT)
+    session = requests.Session()
+    session.trust_env = False
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            break
+        try:
+            session.get('https://127.0.0.1:{port}/login/'.format(port=port),
+                        verify=False, timeout=5)
+            session.close()
+            return server
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.2)
+    server.kill()
+    # The log is removed with the case's temporary directory
+    with open(logfile) as f:
+        sys.stderr.write(f.read())
+    sys.exit('error: app server failed to start')
+
+
+def bench_ingest(params, settings, tmpdir):
+    '''
+    Submit probe logs to a served app from concurrent clients. The case
+    fails if any submission fails, rather than timing failed submissions.
+
+    '''
+    import requests
+    import urllib3
+    from ingest_validation import make_submission
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    concurrency = params['concurrency']
+    configfile = setup_instance(tmpdir, settings, server=True)
+    monitors, _ = create_objects(monitors=concurrency, segments=1)
+    from ampt_manager.db.models import ampt_db, ReceivedProbeLog
+    ampt_db.close()
+
+    # Submissions are signed up front so that signing is not timed, with
+    # increasing counters per monitor (each client submits in order)
+    warmup = 5
+    per_client = max(1, params['requests'] // concurrency)
+    submissions = [[make_submission(monitor_id, auth_key, 1000.0 + n)
+                    for n in range(warmup + per_client)]
+                   for monitor_id, auth_key in monitors]
+
+    port = get_free_port()
+    url = 'https://127.0.0.1:{port}/log/receivedlog/'.format(port=port)
+    server = start_server(configfile, port, params['workers'],
+                          params['worker_class'])
+    latencies = []
+    failures = []
+    barrier = threading.Barrier(concurrency + 1)
+
+    def client(client_submissions):
+        session = requests.Session()
+        # Ignore CA bundles and proxies configured in the environment, as
+        # when waiting for the server to start
+        session.trust_env = False
+        session.verify = False
+        if not params['keepalive']:
+            session.headers['Connection'] = 'close'
+        client_latencies = []
+        client_failures = []
+        try:
+            for pairs in client_submissions[:warmup]:
+                session.post(url, data=pairs)
+        except requests.exceptions.RequestException:
+            pass
+        barrier.wait()
+        for pairs in client_submissions[warmup:]:
+            start = time.perf_counter()
+            try:
+                r = session.post(url, data=pairs)
+                if r.status_code != 200:
+                    client_failures.append('HTTP {}'.format(r.status_code))
+            except requests.exceptions.RequestException as e:
+                client_failures.append(str(e))
+            client_latencies.append(time.perf_counter() - start)
+        session.close()
+        latencies.extend(client_latencies)
+        failures.extend(client_failures)
+
+    try:
+        threads = [threading.Thread(target=client, args=(s,))
+                   for s in submissions]
+        for t in threads:
+            t.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+    if failures:
+        sys.exit('error: {failed} of {requests} submissions failed '
+                 '(first: {failure})'.format(failed=len(failures),
+                                            requests=len(latencies),
+                                            failure=failures[0]))
+    stored = ReceivedProbeLog.select().count()
+    ampt_db.close()
+    return {
+        'requests': len(latencies),
+        'stored': stored,
+        'requests_per_sec': len(latencies) / elapsed,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def bench_hmac(params, settings, tmpdir):
+    'Time HMAC digest verification of a probe log submission'
+    from ingest_validation import make_submission
+    setup_instance(tmpdir, settings)
+    from ampt_manager.web.ingest import FORM_FIELDS
+    from ampt_manager.web.validators import json_serial
+
+    digest = params['digest']
+    auth_key = b'bench-key'
+    # Converted fields of a submission, as verified by the ingest path
+    converters = dict(FORM_FIELDS)
+    data = {name: converters[name](value) for name, value
+            in make_submission(1, 'bench-key', 1000.0) if name != 'h'}
+    message = json.dumps(data, default=json_serial, sort_keys=True)
+    submitted = hmac.new(auth_key, message.encode('utf-8'),
+                         digest).hexdigest().encode('utf-8')
+
+    def verify_digest():
+        computed = hmac.new(auth_key, message.encode('utf-8'),
+                            digest).hexdigest()
+        return hmac.compare_digest(submitted, computed.encode('utf-8'))
+
+    def verify_message():
+        j = json.dumps(data, default=json_serial, sort_keys=True)
+        computed = hmac.new(auth_key, j.encode('utf-8'), digest).hexdigest()
+        return hmac.compare_digest(submitted, computed.encode('utf-8'))
+
+    assert verify_digest() and verify_message()
+    number = params['number']
+
+    def time_per_call(func):
+        # Best of several runs, as timeit does, in microseconds
+        return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+    return {
+        'digest_us': time_per_call(verify_digest),
+        'verify_us': time_per_call(verify_message),
+    }
+
+
+def bench_dispatch(params, settings, tmpdir):
+    'Dispatch probe requests for monitored segments to stand-in generators'
+    from contextlib import ExitStack
+    from concurrent.futures import ThreadPoolExecutor
+    delay = params['generator_delay_ms'] / 1000.0
+    with ExitStack() as stack:
+        generators = [stack.enter_context(StandInGenerator(delay))
+                      for _ in range(params['generators'])]
+        setup_instance(tmpdir, settings)
+        create_objects(segments=params['segments'],
+                       generator_ports=[g.port for g in generators])
+        from ampt_manager.web import app
+        from ampt_manager.db.models import ampt_db, GeneratedProbeLog
+        from ampt_manager.dispatcher import (dispatch_segments,
+                                             get_active_segments,
+                                             close_generator_sessions)
+        app.config['DISPATCH_BATCH'] = params['batch']
+        concurrency = app.config['DISPATCH_CONCURRENCY']
+
+        start = time.perf_counter()
+        segments = get_active_segments()
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            dispatch_segments(segments, executor)
+        elapsed = time.perf_counter() - start
+        close_generator_sessions()
+
+        dispatched = GeneratedProbeLog.select().count()
+        ampt_db.close()
+        return {
+            'dispatched': dispatched,
+            'generator_requests': sum(g.requests for g in generators),
+            'elapsed_sec': elapsed,
+            'segments_per_sec': params['segments'] / elapsed,
+        }
+
+
+def bench_dashboard(params, settings, tmpdir):
+    'Time dashboard content and page rendering for populated database'
+    from log_queries import populate, time_query
+    setup_instance(tmpdir, settings)
+    from ampt_manager.web import app
+    from ampt_manager.web.views import build_dashboard_context
+    from ampt_manager.db.models import ampt_db, User
+    from ampt_manager.db.database import backfill_segment_health
+
+    start = time.perf_counter()
+    populate(params['rows'], params['segments'])
+    backfill_segment_health()
+    ampt_db.execute_sql('ANALYZE')
+    populate_sec = time.perf_counter() - start
+
+    # Raise errors rendering the dashboard rather than responding with them
+    app.config['PROPAGATE_EXCEPTIONS'] = True
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(User.get(User.username == 'bench').id)
+        session['_fresh'] = True
+
+    def get_dashboard():
+        r = client.get('/')
+        assert r.status_code == 200, r.status
+
+    context_ms = time_query(build_dashboard_context, params['repeat'])
+    # Requests open their own database connection, as in the server
+    ampt_db.close()
+    request_ms = time_query(get_dashboard, params['repeat'])
+    return {
+        'populate_sec': populate_sec,
+        'context_ms': context_ms,
+        'request_ms': request_ms,
+    }
+
+
+def get_cases(args):
+    'Return list of (benchmark, params) cases selected by arguments'
+    cases = []
+    for benchmark in args.benchmarks or BENCHMARKS:
+        if benchmark == 'ingest':
+            for concurrency in args.concurrency or [1, 8, 32]:
+                cases.append((benchmark, {
+                    'concurrency': concurrency,
+                    'requests': args.requests,
+                    'workers': args.workers,
+                    'worker_class': args.worker_class,
+                    'keepalive': args.keepalive,
+                }))
+        elif benchmark == 'hmac':
+            for digest in args.digests or ['sha1', 'sha256', 'sha512']:
+                cases.append((benchmark, {'digest': digest,
+                                          'number': args.number}))
+        elif benchmark == 'dispatch':
+            for segments in args.dispatch_segments or [100, 1000]:
+                for batch in (True, False):
+                    cases.append((benchmark, {
+                        'segments': segments,
+                        'generators': args.generators,
+                        'batch': batch,
+                        'generator_delay_ms': args.generator_delay,
+                    }))
+        elif benchmark == 'dashboard':
+            for rows in args.rows or [10000, 1000000]:
+                cases.append((benchmark, {'rows': rows,
+                                          'segments': args.segments,
+                                          'repeat': args.repeat}))
+    return cases
+
+
+def run_case(benchmark, params, settings):
+    '''
+    Run benchmark case in a child process, since each case needs a fresh
+    database and the app binds the database when first imported. Returns
+    the case metrics.
+
+    '''
+    with tempfile.NamedTemporaryFile('r', suffix='.json') as f:
+        returncode = subprocess.call(
+            [sys.executable, __file__,
+             '--run-case', json.dumps([benchmark, params]),
+             '--case-output', f.name]
+            + ['--setting={}'.format(s) for s in settings])
+        if returncode:
+            sys.exit('error: {benchmark} case {params} failed'.format(
+                benchmark=benchmark, params=format_params(params)))
+        return json.load(f)
+
+
+def get_run_info(settings):
+    'Return description of the benchmarked software and environment'
+    from ampt_manager import get_version
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'version': get_version(),
+        'commit': commit,
+        'time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'settings': settings,
+    }
+
+
+def format_params(params):
+    return ' '.join('{}={}'.format(k, v) for k, v in sorted(params.items()))
+
+
+def print_result(result):
+    print('{benchmark:<10} {params}\n{pad:<10} {metrics}'.format(
+        benchmark=result['benchmark'], params=format_params(result['params']),
+        pad='', metrics=' '.join('{}={:.6g}'.format(k, v) for k, v
+                                 in sorted(result['metrics'].items()))),
+          flush=True)
+
+
+def compare_results(results, baseline, tolerance):
+    '''
+    Print change of compared metrics from baseline results. Returns number
+    of metrics worse than baseline by more than `tolerance` (a fraction).
+
+    '''
+    def key(result):
+        return (result['benchmark'],
+                json.dumps(result['params'], sort_keys=True))
+
+    baseline_results = {key(r): r for r in baseline['results']}
+    width = max([len(format_params(r['params'])) for r in results] or [0])
+    regressions = 0
+    print('\ncompared with {commit} ({time}):'.format(
+        commit=baseline['info'].get('commit'), time=baseline['info']['time']))
+    for result in results:
+        old = baseline_results.get(key(result))
+        if old is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS[result['benchmark']]:
+            before = old['metrics'].get(metric)
+            after = result['metrics'][metric]
+            if not before:
+                continue
+            change = (after - before) / before
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > tolerance:
+                flag = 'REGRESSION'
+                regressions += 1
+            print('{benchmark:<10} {params:<{width}} {metric:<17} '
+                  '{before:>10.4g} {after:>10.4g} {change:>+7.1%} {flag}'
+                  .format(benchmark=result['benchmark'],
+                          params=format_params(result['params']),
+                          width=width, metric=metric, before=before,
+                          after=after, change=change, flag=flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.split('\n')[3:]))
+    parser.add_argument('-b', '--benchmark', dest='benchmarks',
+                        choices=BENCHMARKS, action='append',
+                        help='benchmark to run (may be repeated; '
+                             'default: all)')
+    parser.add_argument('-o', '--output',
+                        help='file to write JSON results to')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='JSON results of earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='fraction by which compared metrics may be '
+                             'worse than baseline (default: %(default)s)')
+    parser.add_argument('-s', '--setting', dest='settings', default=[],
+                        action='append', metavar='NAME=VALUE',
+                        help='app setting appended to the configuration of '
+                             'each case (may be repeated)')
+    group = parser.add_argument_group('ingest')
+    group.add_argument('-c', '--concurrency', type=int, action='append',
+                       help='number of concurrent clients (may be repeated; '
+                            'default: 1, 8 and 32)')
+    group.add_argument('-r', '--requests', type=int, default=2000,
+                       help='number of timed submissions per concurrency '
+                            '(default: %(default)s)')
+    group.add_argument('-w', '--workers', type=int,
+                       help='number of server workers (default: from '
+                            'settings)')
+    group.add_argument('-k', '--worker-class',
+                       help='server worker class (default: from settings)')
+    group.add_argument('--no-keepalive', dest='keepalive',
+                       action='store_false',
+                       help='open a new connection for each submission')
+    group = parser.add_argument_group('hmac')
+    group.add_argument('-d', '--digest', dest='digests', action='append',
+                       help='HMAC digest name (may be repeated; default: '
+                            'sha1, sha256 and sha512)')
+    group.add_argument('--number', type=int, default=20000,
+                       help='number of verifications per timed run '
+                            '(default: %(default)s)')
+    group = parser.add_argument_group('dispatch')
+    group.add_argument('--dispatch-segments', type=int, action='append',
+                       metavar='SEGMENTS',
+                       help='number of monitored segments to dispatch probe '
+                            'requests for (may be repeated; default: 100 '
+                            'and 1000)')
+    group.add_argument('--generators', type=int, default=4,
+                       help='number of probe generators the segments are '
+                            'spread across (default: %(default)s)')
+    group.add_argument('--generator-delay', type=float, default=0,
+                       metavar='MS',
+                       help='stand-in generator response delay in '
+                            'milliseconds (default: %(default)s)')
+    group = parser.add_argument_group('dashboard')
+    group.add_argument('--rows', type=int, action='append',
+                       help='number of received probe log rows (may be '
+                            'repeated; default: 10000 and 1000000)')
+    group.add_argument('--segments', type=int, default=200,
+                       help='number of monitored segments '
+                            '(default: %(default)s)')
+    group.add_argument('-n', '--repeat', type=int, default=5,
+                       help='number of timed renders (default: %(default)s)')
+    # Internal arguments for running a case in a child process
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    parser.add_argument('--case-output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        benchmark, params = json.loads(args.run_case)
+        func = globals()['bench_' + benchmark]
+        tmpdir = tempfile.mkdtemp(prefix='ampt-bench-')
+        try:
+            metrics = func(params, args.settings, tmpdir)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        with open(args.case_output, 'w') as f:
+            json.dump(metrics, f)
+        return
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = []
+    for benchmark, params in get_cases(args):
+        metrics = run_case(benchmark, params, args.settings)
+        result = {'benchmark': benchmark, 'params': params,
+                  'metrics': metrics}
+        print_result(result)
+        results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'info': get_run_info(args.settings),
+                       'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if baseline is not None:
+        regressions = compare_results(results, baseline, args.tolerance)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -56,6 +56,12 @@ setup(
         'setproctitle',
         'WTForms',
     ],
+    extras_require={
+        'postgresql': ['psycopg2'],
+        'metrics': ['prometheus_client'],
+        'gevent': ['gevent', 'psycogreen'],
+        'eventlet': ['eventlet'],
+    },
     entry_points={
         'console_scripts': [
             'ampt-manager=ampt_manager.cli:main',